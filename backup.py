@@ -2,33 +2,45 @@ import json
 import logging
 import multiprocessing
 import os
+import sqlite3
+import threading
 import time
+from functools import partial
 from http.client import CannotSendRequest
 from multiprocessing.pool import Pool
 
 import yaml
 
+from handlers import host
+from handlers.inventory import Inventory, get_cache_file
 from handlers.pool import Pool as XenPool
 from handlers.vm import get_vms_to_backup
-from lib import XenAPI
+from lib import XenAPI, checksum, chunkstore, compression, fileio, retention, stream, vhd
+from lib.functions import get_master_url
+from lib.scheduler import Scheduler
 
 logger = logging.getLogger("Xen backup")
 
+# Settings that can be given globally in the config file or per pool
+pool_settings = ("rpc_connections", "vdi_workers", "vm_workers", "host_streams", "sr_streams")
+
 
 def do_backup(name, master, username, password, delta, backup_new_snap=True, excluded_vms=None, vm_uuid_list=None,
-              base_folder=".", backups_to_retain=1):
+              base_folder=".", backups_to_retain=1, cache_dir=None, rpc_connections=1, vdi_workers=1,
+              vm_workers=1, host_streams=None, sr_streams=None):
     return_status = {}
-    master_url = "https://" + master
+    master_url = get_master_url(master)
 
-    session = XenAPI.Session(master_url, ignore_ssl=True)
+    # Parallel VM and VDI exports share the session
+    session = XenAPI.Session(master_url, ignore_ssl=True, pool_size=max(rpc_connections, vm_workers * vdi_workers))
     try:
         session.xenapi.login_with_password(username, password)
     except (CannotSendRequest, XenAPI.Failure) as e:
         logger.exception("Error logging in Xen host")
         return_status["error"] = e.details
     else:
+        xapi = Inventory(session.xenapi, cache_file=get_cache_file(cache_dir, master))
         try:
-            xapi = session.xenapi
             session_id = session.handle
 
             pool = XenPool(xapi)
@@ -38,13 +50,34 @@ def do_backup(name, master, username, password, delta, backup_new_snap=True, exc
             logger.info("Backing up %d VMs in pool %s", num_vms, pool.get_label())
 
             return_status["failed_vms"] = {}
-            for v, vm in enumerate(vms):
-                if delta:
-                    vm.backup_delta(return_status["failed_vms"], base_folder, v, num_vms)
-                    vm.clean_delta_backups(base_folder, backups_to_retain)
-                else:
-                    vm.backup(return_status["failed_vms"], base_folder, v, num_vms, backup_new_snap)
-                    vm.clean_backups(base_folder, backups_to_retain)
+            failed_vms_lock = threading.Lock()
+
+            def backup_vm(vm, v, abort):
+                # Errors of this VM, merged once it is done (jobs run in parallel)
+                failed_vms = {}
+                try:
+                    if delta:
+                        vm.backup_delta(failed_vms, base_folder, v, num_vms, vdi_workers, abort)
+                        clean_backups = vm.clean_delta_backups
+                    else:
+                        vm.backup(failed_vms, base_folder, v, num_vms, backup_new_snap, abort)
+                        clean_backups = vm.clean_backups
+                    try:
+                        clean_backups(base_folder, backups_to_retain)
+                    except sqlite3.Error as e:
+                        logger.error("Retention of VM %s failed: %s", vm.get_label(), str(e))
+                        failed_vms.setdefault(vm.ref, "Error cleaning backups of VM {} ({}). Catalog error: {}".format(
+                            vm.get_label(), vm.get_uuid(), e))
+                finally:
+                    with failed_vms_lock:
+                        return_status["failed_vms"].update(failed_vms)
+                deleter.wake()
+
+            # Retention deletes the discarded files in the background, the exports don't wait for it
+            with retention.Deleter(base_folder) as deleter:
+                scheduler = Scheduler(vm_workers, {"host": host_streams, "SR": sr_streams})
+                scheduler.run((vm.get_backup_resources(), partial(backup_vm, vm, v)) for v, vm in enumerate(vms))
+            return_status["reclaimed"] = deleter.reclaimed
 
             if len(return_status["failed_vms"]) == 0:
                 logger.info("Backup of %d VMs in pool %s completed", num_vms, pool.get_label())
@@ -52,17 +85,26 @@ def do_backup(name, master, username, password, delta, backup_new_snap=True, exc
                 logger.error("Backup of %d VMs in pool %s completed with errors:", num_vms, pool.get_label())
                 for vm_error in return_status["failed_vms"].values():
                     logger.error(vm_error)
-        except (IOError, XenAPI.Failure) as e:
+            logger.debug("Inventory of pool %s: %d getters answered from memory, %d round trips",
+                         name, xapi.stats["hits"], xapi.stats["misses"])
+        except (IOError, XenAPI.Failure, sqlite3.Error) as e:
             return_status["error"] = str(e)
             logger.warning("Backup of pool %s aborted. Error: %s", name, str(e))
         except SystemExit:
             logger.warning("Backup of pool %s aborted  on external request", name)
         finally:
+            try:
+                xapi.save()
+            except (OSError, XenAPI.Failure) as e:
+                logger.error("Error saving inventory cache: %s", str(e))
             try:
                 session.xenapi.session.logout()
             except (CannotSendRequest, XenAPI.Failure) as e:
                 logger.error("Xen logout failed: %s", str(e))
 
+            return_status["rpc_stats"] = session.stats.to_dict()
+            logger.debug("%d XenAPI calls performed in pool %s", session.stats.total_calls(), name)
+
     return return_status
 
 
@@ -99,6 +141,43 @@ def backup(args):
     backups_to_retain = args.backups_to_retain if args.backups_to_retain is not None else config[
         args.type + "_backups_to_retain"] if args.type + "_backups_to_retain" in config else None
 
+    cache_dir = args.cache_dir if args.cache_dir is not None else config[
+        "cache_dir"] if "cache_dir" in config else None
+
+    if "block_size" in config:
+        stream.default_block_size = config["block_size"]
+    if "pipeline_depth" in config:
+        stream.default_depth = config["pipeline_depth"]
+    if "compression" in config:
+        compression.default_codec = config["compression"]
+        compression.default_level = config.get("compression_level")
+    if "compression_workers" in config:
+        compression.default_workers = config["compression_workers"]
+    if "checksum" in config:
+        checksum.enabled = config["checksum"]
+    if "checksum_algorithm" in config:
+        checksum.algorithm = config["checksum_algorithm"]
+    if "checksum_blocks" in config:
+        checksum.store_blocks = config["checksum_blocks"]
+    if "drop_zero_blocks" in config:
+        vhd.drop_zero_blocks = config["drop_zero_blocks"]
+    if args.io_mode is not None or "io_mode" in config:
+        fileio.io_mode = args.io_mode if args.io_mode is not None else config["io_mode"]
+    if "direct_transfers" in config:
+        host.direct_transfers = config["direct_transfers"]
+    if "writeback_size" in config:
+        fileio.writeback_size = config["writeback_size"]
+    if "dedup" in config:
+        chunkstore.enabled = config["dedup"]
+    if "retention_workers" in config:
+        retention.workers = config["retention_workers"]
+    if "truncate_step" in config:
+        retention.truncate_step = config["truncate_step"]
+        retention.truncate_pause = config.get("truncate_pause", 0.0)
+    if "xva_compression" in config:
+        compression.xva_compression = config["xva_compression"]
+        compression.xva_level = config.get("xva_compression_level")
+
     logger.info("Backing up %d Xen pool(s)", len(config["pools"]))
 
     backup_procs = {}
@@ -113,6 +192,11 @@ def backup(args):
             pool_config["backups_to_retain"] = backups_to_retain
         if args.uuid is not None:
             pool_config["vm_uuid_list"] = args.uuid
+        if cache_dir is not None:
+            pool_config["cache_dir"] = cache_dir
+        for setting in pool_settings:
+            if setting in config and setting not in pool_config:
+                pool_config[setting] = config[setting]
 
         backup_procs[pool_config["name"]] = proc_pool.apply_async(do_backup, kwds=pool_config)
 
@@ -136,7 +220,9 @@ def backup(args):
         else:
             mail_pool_content = {
                 "errors": [],
-                "vms": []
+                "vms": [],
+                "rpc_stats": backup_status.get("rpc_stats", {}),
+                "reclaimed": backup_status.get("reclaimed", 0)
             }
             if "error" in backup_status:
                 error = True
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""Benchmarks of the export, restore and retention hot paths, run against the in-process XAPI simulator.
+
+    ./benchmark.py -o results.json
+    ./benchmark.py -o new.json --compare results.json
+
+Results are written as JSON; with --compare the run fails if any benchmark got slower than --max-regression.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from handlers import vm as vm_handler
+from handlers.inventory import Inventory
+from handlers.vdi import VDI
+from handlers.vm import VM, get_vms_to_backup
+from lib import XenAPI, compression, stream
+from lib.catalog import Catalog
+from lib.simulator import XapiSimulator
+
+logger = logging.getLogger("Benchmark")
+
+
+class Run(object):
+    """Simulated pool plus a logged in session and a scratch directory."""
+
+    def __init__(self, rpc_latency=0.0, **options):
+        self.simulator = XapiSimulator(rpc_latency=rpc_latency, **options).start()
+        self.session = XenAPI.Session(self.simulator.url)
+        self.session.xenapi.login_with_password("root", "")
+        self.xapi = Inventory(self.session.xenapi)
+        self.work_dir = tempfile.mkdtemp(prefix="xen-backup-benchmark")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.session.xenapi.session.logout()
+        self.simulator.stop()
+        shutil.rmtree(self.work_dir)
+
+    def vm(self, vm_ref):
+        return VM(self.xapi, self.simulator.url, self.session.handle, vm_ref)
+
+    def vdi(self, vdi_ref=None, params=None):
+        return VDI(self.xapi, self.simulator.url, self.session.handle, vdi_ref, params)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def throughput(size, seconds):
+    return {"bytes": size, "seconds": round(seconds, 6), "bytes_per_sec": round(size / seconds) if seconds else None}
+
+
+def bench_vm_export(size, rpc_latency):
+    with Run(rpc_latency, xva_size=size) as run:
+        snapshot = run.vm(run.simulator.add_vm("bench vm", fill=0)).snapshot("bench")
+        xva_file, export_time = timed(snapshot.export, run.work_dir)
+        _, restore_time = timed(vm_handler.restore, run.xapi, run.simulator.url, run.session.handle, xva_file)
+        xva_size = os.path.getsize(xva_file)
+    return {"VM.export": throughput(xva_size, export_time), "vm.restore": throughput(xva_size, restore_time)}
+
+
+def bench_vdi_export(size, rpc_latency):
+    with Run(rpc_latency) as run:
+        snapshot = run.vm(run.simulator.add_vm("bench vm", disks=[size])).snapshot("bench")
+        vdi = next(snapshot.get_vdis(disk_only=True))
+        vdi_file, export_time = timed(vdi.export, run.work_dir, "vdi")
+        vdi_file = os.path.join(run.work_dir, vdi_file)
+
+        record = vdi.get_record()
+        new_vdi = run.vdi(params={"name_label": "bench restore", "SR": record["SR"],
+                                  "virtual_size": record["virtual_size"], "type": "user"})
+        _, import_time = timed(new_vdi.import_data, "bench restore", vdi_file, "full")
+        vdi_size = os.path.getsize(vdi_file)
+    return {"VDI.export": throughput(vdi_size, export_time), "VDI.import_data": throughput(vdi_size, import_time)}
+
+
+def bench_get_vms_to_backup(num_vms, rpc_latency):
+    with Run(rpc_latency) as run:
+        for v in range(num_vms):
+            run.simulator.add_vm("bench vm {}".format(v), fill=0)
+
+        def list_vms():
+            vms, _ = get_vms_to_backup(run.xapi, run.simulator.url, run.session.handle)
+            for vm in vms:
+                vm.get_uuid()
+                vm.get_label()
+                next(vm.get_backup_snapshots("base"), None)
+
+        calls = run.session.stats.total_calls()
+        _, seconds = timed(list_vms)
+        return {"get_vms_to_backup[{}]".format(num_vms): {
+            "vms": num_vms, "rpc_calls": run.session.stats.total_calls() - calls, "seconds": round(seconds, 6)}}
+
+
+def bench_clean_delta_backups(num_files, rpc_latency):
+    with Run(rpc_latency) as run:
+        vm = run.vm(run.simulator.add_vm("bench vm", fill=0))
+        vm_back_dir = vm.get_vm_back_dir()
+        vdi_back_dir = os.path.join(vm_back_dir, "vdi_bench")
+        os.makedirs(os.path.join(run.work_dir, vdi_back_dir))
+
+        base_file = os.path.join(vdi_back_dir, "20200101T000000_full.vhd")
+        open(os.path.join(run.work_dir, base_file), "w").close()
+        for f in range(num_files):
+            timestamp = "20200101T{:06d}".format(f + 1)
+            vdi_file = os.path.join(vdi_back_dir, timestamp + "_delta.vhd")
+            open(os.path.join(run.work_dir, vdi_file), "w").close()
+            with open(os.path.join(run.work_dir, vm_back_dir, timestamp + ".json"), "w") as vm_def_file:
+                json.dump({"vm": {"name_label": "bench vm - backup " + timestamp},
+                           "vdis": {"OpaqueRef:bench": {"backup_file": vdi_file, "backup_base_file": base_file}}},
+                          vm_def_file)
+
+        # First-time indexing of the folder apart: retention runs from an indexed catalog
+        with Catalog(run.work_dir) as backup_catalog:
+            _, index_seconds = timed(backup_catalog.index_vm_dir, vm_back_dir)
+        _, seconds = timed(vm.clean_delta_backups, run.work_dir, num_files // 2)
+        return {"Catalog.index_vm_dir[{}]".format(num_files): {
+                    "definition_files": num_files, "seconds": round(index_seconds, 6)},
+                "VM.clean_delta_backups[{}]".format(num_files): {
+                    "definition_files": num_files, "seconds": round(seconds, 6)}}
+
+
+def run_benchmarks(args):
+    benchmarks = [("VM.export vm.restore", bench_vm_export, args.size * 2 ** 20),
+                  ("VDI.export VDI.import_data", bench_vdi_export, args.size * 2 ** 20)]
+    benchmarks += [("get_vms_to_backup", bench_get_vms_to_backup, num_vms) for num_vms in args.vms]
+    benchmarks.append(("VM.clean_delta_backups Catalog.index_vm_dir", bench_clean_delta_backups, args.definition_files))
+
+    results = {}
+    for names, benchmark, param in benchmarks:
+        if args.only is not None and not any(only in names for only in args.only):
+            continue
+        for _ in range(args.repeat):
+            for name, result in benchmark(param, args.rpc_latency).items():
+                results.setdefault(name, []).append(result)
+
+    # Keep the median run of each benchmark
+    summary = {}
+    for name, runs in results.items():
+        runs.sort(key=lambda run: run["seconds"])
+        summary[name] = dict(runs[len(runs) // 2], runs=[run["seconds"] for run in runs])
+        logger.info("%s: %s", name, summary[name])
+    return summary
+
+
+def compare(results, baseline, max_regression):
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline or not baseline[name]["seconds"]:
+            continue
+        ratio = result["seconds"] / baseline[name]["seconds"]
+        print("{:40} {:>12.4f}s {:>12.4f}s {:>+8.1%}".format(name, baseline[name]["seconds"], result["seconds"],
+                                                             ratio - 1))
+        if ratio - 1 > max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backup hot paths against a simulated pool")
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json", help="Results file (JSON)")
+    parser.add_argument("--size", type=int, default=256, help="Size of exported VMs/VDIs (MiB)")
+    parser.add_argument("--vms", type=int, nargs="+", default=[10, 100, 1000], help="Pool sizes")
+    parser.add_argument("--definition-files", type=int, default=10000,
+                        help="Definition files in the delta backup repository")
+    parser.add_argument("--rpc-latency", type=float, default=0.0, help="Seconds added to every XenAPI call")
+    parser.add_argument("--block-size", type=int, default=stream.default_block_size, help="Transfer buffer size")
+    parser.add_argument("--pipeline-depth", type=int, default=stream.default_depth,
+                        help="Buffers read ahead during transfers (0: lock-step)")
+    parser.add_argument("--xva-compression", type=str, default=compression.xva_compression,
+                        choices=["host", "gzip", "zstd", "none"], help="Compression of the VM exports")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of every benchmark (the median is kept)")
+    parser.add_argument("--only", type=str, action="append", help="Run only the benchmarks containing this string")
+    parser.add_argument("--compare", type=str, help="Baseline results file")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Fail if a benchmark is slower than the baseline by more than this fraction")
+    args = parser.parse_args()
+
+    stream.default_block_size = args.block_size
+    stream.default_depth = args.pipeline_depth
+    compression.xva_compression = args.xva_compression
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    logging.getLogger("VM").setLevel(logging.WARNING)
+    logging.getLogger("VDI").setLevel(logging.WARNING)
+
+    results = {
+        "revision": get_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {"size": args.size, "rpc_latency": args.rpc_latency, "repeat": args.repeat,
+                       "block_size": args.block_size, "pipeline_depth": args.pipeline_depth,
+                       "xva_compression": args.xva_compression},
+        "results": run_benchmarks(args)
+    }
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=4)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results["results"], json.load(baseline_file)["results"], args.max_regression)
+        if regressions:
+            sys.exit("Regressions: " + ", ".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
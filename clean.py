@@ -5,16 +5,18 @@ from multiprocessing.pool import Pool
 
 import yaml
 
+from handlers.inventory import Inventory, get_cache_file
 from handlers.vm import get_vms_to_backup
 from lib import XenAPI
+from lib.functions import get_master_url
 
 logger = logging.getLogger("Xen backup")
 
 max_subproc = 2
 
 
-def clean_all(name, master, username, password, excluded_vms=None):
-    master_url = "https://" + master
+def clean_all(name, master, username, password, excluded_vms=None, cache_dir=None):
+    master_url = get_master_url(master)
 
     session = XenAPI.Session(master_url, ignore_ssl=True)
     try:
@@ -23,9 +25,9 @@ def clean_all(name, master, username, password, excluded_vms=None):
         logger.error("Error logging in Xen host")
         raise e
     else:
+        xapi = Inventory(session.xenapi, cache_file=get_cache_file(cache_dir, master))
         try:
             logger.info("Cleaning backup snapshots in pool %s", name)
-            xapi = session.xenapi
             session_id = session.handle
 
             vms, _ = get_vms_to_backup(xapi, master_url, session_id, excluded_vms)
@@ -35,6 +37,10 @@ def clean_all(name, master, username, password, excluded_vms=None):
 
             logger.info("Cleaning backup snapshots in pool %s completed", name)
         finally:
+            try:
+                xapi.save()
+            except (OSError, XenAPI.Failure) as e:
+                logger.error("Error saving inventory cache: %s", str(e))
             try:
                 session.xenapi.session.logout()
             except (CannotSendRequest, XenAPI.Failure):
@@ -52,11 +58,16 @@ def clean(args):
             logger.error("Error opening config file : %s", e)
             raise e
 
+        cache_dir = args.cache_dir if args.cache_dir is not None else config[
+            "cache_dir"] if "cache_dir" in config else None
+
         logger.info("Cleaning %d Xen pool(s)", len(config["pools"]))
 
         backup_procs = []
         proc_pool = Pool(processes=max_subproc)
         for pool_config in config["pools"]:
+            if cache_dir is not None:
+                pool_config["cache_dir"] = cache_dir
             backup_procs.append(
                 {"name": pool_config["name"], "result": proc_pool.apply_async(clean_all, kwds=pool_config)})
 
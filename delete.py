@@ -2,6 +2,7 @@ import logging
 from http.client import CannotSendRequest
 
 import lib.XenAPI as XenAPI
+from lib.functions import get_master_url
 from handlers.common import get_by_uuid
 from handlers.vm import VM
 
@@ -11,7 +12,7 @@ def delete(args):
 
     logger = logging.getLogger("Xen delete")
 
-    master_url = "https://" + args.master
+    master_url = get_master_url(args.master)
 
     session = XenAPI.Session(master_url, ignore_ssl=True)
     try:
@@ -7,7 +7,7 @@ from urllib.error import HTTPError
 from handlers.common import get_by_uuid, get_by_label
 from handlers.vm import VM
 from lib import XenAPI
-from lib.functions import datetime_to_timestamp
+from lib.functions import datetime_to_timestamp, get_master_url
 
 logger = logging.getLogger("Xen export")
 
@@ -20,7 +20,7 @@ def export(args):
     if args.uuid is None and args.vm_name is None:
         raise ValueError("VM UUID or name required!")
 
-    master_url = "https://" + args.master
+    master_url = get_master_url(args.master)
 
     session = XenAPI.Session(master_url, ignore_ssl=True)
     try:
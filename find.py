@@ -0,0 +1,102 @@
+import logging
+import os
+from datetime import datetime
+
+import yaml
+
+from lib.catalog import Catalog
+from lib.functions import datetime_to_timestamp, get_saned_string
+
+logger = logging.getLogger("Xen find")
+
+
+def list_backups(args):
+    """Restore points of the VMs given by UUID or name, a summary of all the VMs without them.
+
+    With --totals the sizes per backup chain (a full VDI file with its deltas, or an XVA file) are listed too.
+    """
+    with open_catalog(args) as backup_catalog:
+        vm_uuids = get_vm_uuids(backup_catalog, args)
+        if vm_uuids is None:
+            print("{:36}  {:30}  {:>6}  {:15}  {:15}  {:>10}".format("VM", "Name", "Points", "First", "Last", "Size"))
+            for vm_totals in backup_catalog.get_vm_totals():
+                print("{vm_uuid:36}  {vm_name:30.30}  {restore_points:6}  {first:15}  {last:15}  {0:>10}".format(
+                    format_size(vm_totals["size"]), **vm_totals))
+            print("Total: {}".format(format_size(backup_catalog.get_total_size())))
+            return
+
+        before = get_before(args)
+        for vm_uuid in vm_uuids:
+            for restore_point in backup_catalog.get_restore_points(vm_uuid, before=before):
+                print("{timestamp:15}  {type:5}  {0:>10}  {1}".format(
+                    format_size(restore_point["size"]), os.path.join(backup_catalog.base_folder, restore_point["path"]),
+                    **restore_point))
+            if args.totals:
+                for chain in backup_catalog.get_chain_totals(vm_uuid):
+                    print("Chain {chain}: {files} files, {0}".format(format_size(chain["size"]), **chain))
+
+
+def find(args):
+    """Print the last restore point of the VMs given by UUID or name, before --before if given."""
+    with open_catalog(args) as backup_catalog:
+        vm_uuids = get_vm_uuids(backup_catalog, args)
+        if vm_uuids is None:
+            raise ValueError("VM UUID or name required!")
+
+        before = get_before(args)
+        not_found = []
+        for vm_uuid in vm_uuids:
+            restore_point = backup_catalog.get_latest_restore_point(vm_uuid, before)
+            if restore_point is None:
+                not_found.append(vm_uuid)
+            else:
+                print(os.path.join(backup_catalog.base_folder, restore_point["path"]))
+        if not_found:
+            raise ValueError("No backup found for VM(s) {}".format(", ".join(not_found)))
+
+
+def open_catalog(args):
+    """Catalog of the backups directory (-d, or the one of the backup type in the config file), synced."""
+    base_folder = args.base_dir
+    if base_folder is None:
+        try:
+            with open(args.config, "r") as config_file:
+                config = yaml.load(config_file)
+        except OSError as e:
+            logger.error("Error opening config file : %s", e)
+            raise e
+        base_folder = config[args.type + "_backup_dir"]
+    if not os.path.isdir(base_folder):
+        raise ValueError("Backups directory {} not found".format(base_folder))
+
+    backup_catalog = Catalog(base_folder)
+    backup_catalog.sync()
+    return backup_catalog
+
+
+def get_vm_uuids(backup_catalog, args):
+    if args.uuid is not None:
+        return args.uuid
+    if args.vm_name is not None:
+        vm_uuids = backup_catalog.find_vm_uuids([args.vm_name, get_saned_string(args.vm_name)])
+        if not vm_uuids:
+            raise ValueError("No backup found for VM '{}'".format(args.vm_name))
+        return vm_uuids
+    return None
+
+
+def get_before(args):
+    """--before as a backup timestamp, given as such (20200131T235900) or in ISO format (2020-01-31 23:59)."""
+    if args.before is None:
+        return None
+    try:
+        return datetime_to_timestamp(datetime.strptime(args.before, "%Y%m%dT%H%M%S"))
+    except ValueError:
+        return datetime_to_timestamp(datetime.fromisoformat(args.before))
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if size < 1024 or unit == "TiB":
+            return "{:.1f} {}".format(size, unit) if unit != "B" else "{} B".format(int(size))
+        size /= 1024
@@ -53,7 +53,7 @@ class CommonEntities(Common):
         self.session_id = session_id
 
     def get_allowed_operations(self):
-        self.xapi.get_allowed_operations(self.ref)
+        return self.xapi.get_allowed_operations(self.ref)
 
     def get_snapshots(self):
         return (self.__class__(self._xapi, self.master_url, self.session_id, snap_ref) for snap_ref in
@@ -1,19 +1,89 @@
+import logging
+import threading
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit, urlunsplit
+
 from handlers.common import Common
-from handlers.vm import VM
+from handlers.sr import SR
+from lib.XenAPI import Failure
+
+logger = logging.getLogger("Host")
+
+# Transfer the data of VDIs on local SRs straight from/to their host instead of through the master, set from the
+# direct_transfers setting
+direct_transfers = True
+
+# (master URL, SR ref) -> URL of the host transferring its data
+_sr_urls = {}
+_sr_urls_lock = threading.Lock()
 
 
 class Host(Common):
+    _type = "host"
+
+    def __init__(self, xapi, ref=None, params=None):
+        super().__init__(xapi, ref, params)
+
+    def get_address(self):
+        return self.xapi.get_address(self.ref)
+
+    def is_enabled(self):
+        return self.xapi.get_enabled(self.ref)
+
+    def get_url(self, master_url):
+        """master_url pointing to the management address of the host."""
+        url = urlsplit(master_url)
+        address = self.get_address()
+        netloc = "[{}]".format(address) if ":" in address else address
+        if url.port is not None:
+            netloc = "{}:{}".format(netloc, url.port)
+        return urlunsplit((url.scheme, netloc, url.path, "", ""))
+
+
+def get_transfer_url(xapi, master_url, sr_refs):
+    """URL to transfer the data of VDIs on sr_refs.
+
+    The host the SRs are attached to when they are all local to the same (enabled) host, so that the master does not
+    proxy the data; master_url otherwise.
+    """
+    if not direct_transfers:
+        return master_url
+    urls = {_get_sr_url(xapi, master_url, sr_ref) for sr_ref in sr_refs}
+    return urls.pop() if len(urls) == 1 else master_url
+
+
+def transfer(master_url, transfer_url, function):
+    """function(url) with the transfer_url of get_transfer_url, called again with master_url if the host can't be
+    connected to (URLError, raised by urllib and lib.upload before anything is transferred)."""
+    try:
+        return function(transfer_url)
+    except URLError as e:
+        if isinstance(e, HTTPError) or transfer_url == master_url:
+            raise e
+        fall_back_to_master(master_url, transfer_url)
+    return function(master_url)
+
 
-    def __init__(self, xapi, master_url, session_id):
-        pools = self.xapi.pool.get_all_refs()
-        if len(pools) == 0:
-            raise Exception("Host is not a pool member")
-        super().__init__(pools[0], xapi.pool, master_url, session_id)
+def fall_back_to_master(master_url, url):
+    """Stop transferring data from/to the host at url (e.g. not reachable by the backup server)."""
+    logger.warning("Host %s not reachable, transferring through the master", url)
+    with _sr_urls_lock:
+        for key, sr_url in _sr_urls.items():
+            if key[0] == master_url and sr_url == url:
+                _sr_urls[key] = master_url
 
-        self.ntw = xapi.network
-        self.sr = xapi.SR
 
-        self.vm = xapi.VM
-        self.vif = xapi.VIF
-        self.vbd = xapi.VBD
-        self.vdi = xapi.VDI
+def _get_sr_url(xapi, master_url, sr_ref):
+    with _sr_urls_lock:
+        if (master_url, sr_ref) not in _sr_urls:
+            url = master_url
+            try:
+                host_ref = SR(xapi, sr_ref).get_local_host_ref()
+                if host_ref is not None:
+                    host = Host(xapi, host_ref)
+                    if host.is_enabled():
+                        url = host.get_url(master_url)
+            except Failure as e:
+                logger.warning("Host of SR %s not found, transferring through the master: %s", sr_ref, e)
+            _sr_urls[(master_url, sr_ref)] = url
+        return _sr_urls[(master_url, sr_ref)]
@@ -0,0 +1,371 @@
+import copy
+import json
+import logging
+import os
+import threading
+from xmlrpc.client import DateTime
+
+from lib.XenAPI import Failure
+from lib.functions import get_saned_string
+
+NULL_REF = "OpaqueRef:NULL"
+
+
+class Inventory(object):
+    """Read-through view of the pool built from one get_all_records call per class.
+
+    Wraps session.xenapi: getters (get_<field>, get_record, get_all, get_all_records, get_by_uuid and
+    get_by_name_label) of the inventoried classes are answered from memory, everything else is forwarded to the
+    master. Objects touched by a forwarded call (and their direct neighbours) are re-read on next access.
+
+    With a cache file the records are persisted together with an event.from token, so that the next run only
+    fetches the changes happened in the meantime.
+
+    Safe to share between threads: lock guards the records and is never held during XenAPI calls, load_lock lets one
+    thread at a time (re)load them while the others keep reading.
+    """
+    classes = ("VM", "VBD", "VDI", "VIF", "SR", "network")
+    _cache_version = 1
+
+    def __init__(self, xapi, classes=None, cache_file=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self._xapi = xapi
+        self.lock = threading.RLock()
+        self.load_lock = threading.RLock()
+        # Getters answered from the records / needing a round trip
+        self.stats = {"hits": 0, "misses": 0}
+        self._classes = {name: InventoryClass(self, name) for name in (classes or self.classes)}
+        self._event_classes = {name.lower(): name for name in self._classes.keys()}
+
+        self.cache_file = cache_file
+        self._token = None
+        # Cached records must be brought up to date before being served
+        self.synced = cache_file is None
+        if cache_file is not None:
+            self._load_cache()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name in self._classes:
+            return self._classes[name]
+        return getattr(self._xapi, name)
+
+    def load(self, classes=None):
+        with self.load_lock:
+            if self.cache_file is not None:
+                self.update()
+            else:
+                for name in (classes or self._classes.keys()):
+                    self._classes[name].load()
+
+    def update(self):
+        """Apply the changes happened since the last event.from token (or read everything without a token)."""
+        with self.load_lock:
+            self._update()
+
+    def _update(self):
+        try:
+            events = getattr(self._xapi.event, "from")(list(self._event_classes.keys()), self._token or "", 0.0)
+        except Failure as e:
+            if self._token is None:
+                raise e
+            self.logger.warning("Discarding inventory cache: %s", e)
+            self._token = None
+            return self._update()
+
+        with self.lock:
+            if self._token is None:
+                for inventory_class in self._classes.values():
+                    inventory_class.clear()
+
+            for event in events["events"]:
+                name = self._event_classes.get(event["class"].lower())
+                if name is not None:
+                    self._classes[name].apply(event)
+
+            for inventory_class in self._classes.values():
+                inventory_class.dirty = False
+
+            self._token = events["token"]
+            self.synced = True
+        self.logger.debug("Inventory updated with %d events", len(events["events"]))
+
+    def save(self):
+        if self.cache_file is None:
+            return
+
+        with self.load_lock:
+            self.update()
+            cache = {
+                "version": self._cache_version,
+                "token": self._token,
+                "classes": {name: inventory_class.get_loaded_records()
+                            for name, inventory_class in self._classes.items()}
+            }
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), 0o755, True)
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w") as cache_file:
+            json.dump(cache, cache_file, default=_encode_value)
+        os.replace(tmp_file, self.cache_file)
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file) as cache_file:
+                cache = json.load(cache_file, object_hook=_decode_value)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.warning("Error reading inventory cache %s: %s", self.cache_file, e)
+            return
+
+        if cache.get("version") != self._cache_version or set(cache["classes"]) != set(self._classes):
+            return
+        for name, records in cache["classes"].items():
+            self._classes[name].clear()
+            for ref, record in records.items():
+                self._classes[name].apply({"operation": "add", "ref": ref, "snapshot": record})
+        self._token = cache["token"]
+
+    def invalidate(self, ref, neighbours=True):
+        with self.lock:
+            for inventory_class in self._classes.values():
+                related = inventory_class.invalidate(ref)
+                if neighbours:
+                    for related_ref in related:
+                        self.invalidate(related_ref, False)
+
+    def set_dirty(self):
+        with self.lock:
+            for inventory_class in self._classes.values():
+                inventory_class.dirty = True
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+
+class InventoryClass(object):
+    _getters = ("get_all", "get_all_records", "get_record", "get_by_uuid", "get_by_name_label")
+
+    def __init__(self, inventory, name):
+        self._inventory = inventory
+        self._name = name
+
+        # ref -> record, None marks a known object whose record must be re-read
+        self._records = None
+        self._by_uuid = {}
+        self._by_label = {}
+        self.dirty = False
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        if method in self._getters:
+            return getattr(self, "_" + method)
+        if method.startswith("get_"):
+            return lambda *params: self._get_field(method, params)
+        return lambda *params: self._call(method, params)
+
+    @property
+    def _xapi(self):
+        return getattr(self._inventory._xapi, self._name)
+
+    def load(self):
+        if self._inventory.cache_file is not None:
+            # Tracked through events, this also refreshes the other classes
+            self._inventory.update()
+            return
+
+        self._inventory.logger.debug("Loading %s records", self._name)
+        records = self._xapi.get_all_records()
+        with self._inventory.lock:
+            self.clear()
+            for ref, record in records.items():
+                self.apply({"operation": "add", "ref": ref, "snapshot": record})
+
+    def clear(self):
+        self._records = {}
+        self._by_uuid = {}
+        self._by_label = {}
+        self.dirty = False
+
+    def apply(self, event):
+        ref = event["ref"]
+        if self._records is None:
+            self._records = {}
+
+        old_record = self._records.pop(ref, None)
+        if old_record is not None:
+            self._unindex(ref, old_record)
+        if event["operation"] != "del":
+            self._records[ref] = event["snapshot"]
+            self._index(ref, event["snapshot"])
+
+    def get_loaded_records(self):
+        """Copy of the records, with the invalidated ones re-read."""
+        self._fetch_missing()
+        with self._inventory.lock:
+            return copy.deepcopy(self._records or {})
+
+    def invalidate(self, ref):
+        related = []
+        if self._records is not None and ref in self._records:
+            record = self._records[ref]
+            if record is not None:
+                self._unindex(ref, record)
+                related = list(_find_refs(record))
+            self._records[ref] = None
+        return related
+
+    def _index(self, ref, record):
+        self._by_uuid[record["uuid"]] = ref
+        # VBDs and VIFs have no label
+        if "name_label" in record:
+            self._by_label.setdefault(record["name_label"], []).append(ref)
+
+    def _unindex(self, ref, record):
+        self._by_uuid.pop(record["uuid"], None)
+        label_refs = self._by_label.get(record.get("name_label"), [])
+        if ref in label_refs:
+            label_refs.remove(ref)
+
+    def _needs_load(self, fresh):
+        return self._records is None or not self._inventory.synced or (fresh and self.dirty)
+
+    def _ensure_loaded(self, fresh=False):
+        with self._inventory.lock:
+            needs_load = self._needs_load(fresh)
+        if needs_load:
+            with self._inventory.load_lock:
+                # Unless loaded by another thread in the meantime
+                with self._inventory.lock:
+                    needs_load = self._needs_load(fresh)
+                if needs_load:
+                    self.load()
+        if fresh:
+            self._fetch_missing()
+
+    def _fetch_missing(self):
+        with self._inventory.lock:
+            missing = [ref for ref, record in (self._records or {}).items() if record is None]
+        for ref in missing:
+            self._fetch(ref)
+
+    def _fetch(self, ref):
+        record = self._xapi.get_record(ref)
+        with self._inventory.lock:
+            if self._records is not None:
+                old_record = self._records.get(ref)
+                if old_record is not None:
+                    self._unindex(ref, old_record)
+                self._records[ref] = record
+                self._index(ref, record)
+            return copy.deepcopy(record)
+
+    def _get_field(self, method, params):
+        field = method[len("get_"):]
+        if len(params) == 1 and _is_ref(params[0]):
+            self._ensure_loaded()
+            with self._inventory.lock:
+                record = self._records.get(params[0])
+                if record is not None and field in record:
+                    self._inventory.stats["hits"] += 1
+                    return copy.deepcopy(record[field])
+            if record is None:
+                self._inventory.count("misses")
+                record = self._fetch(params[0])
+                if field in record:
+                    return record[field]
+        self._inventory.count("misses")
+        return getattr(self._xapi, method)(*params)
+
+    def _get_record(self, ref):
+        self._ensure_loaded()
+        with self._inventory.lock:
+            record = self._records.get(ref)
+            if record is not None:
+                self._inventory.stats["hits"] += 1
+                return copy.deepcopy(record)
+        self._inventory.count("misses")
+        return self._fetch(ref)
+
+    def _get_all(self):
+        self._ensure_loaded(True)
+        with self._inventory.lock:
+            return list(self._records.keys())
+
+    def _get_all_records(self):
+        self._ensure_loaded(True)
+        with self._inventory.lock:
+            return copy.deepcopy(self._records)
+
+    def _get_by_uuid(self, uuid):
+        self._ensure_loaded(True)
+        with self._inventory.lock:
+            if uuid in self._by_uuid:
+                return self._by_uuid[uuid]
+        # Let the master raise the usual UUID_INVALID failure
+        return self._xapi.get_by_uuid(uuid)
+
+    def _get_by_name_label(self, label):
+        self._ensure_loaded(True)
+        with self._inventory.lock:
+            return list(self._by_label.get(label, []))
+
+    def _call(self, method, params):
+        result = getattr(self._xapi, method)(*params)
+        with self._inventory.lock:
+            self._written(method, params, result)
+        return result
+
+    def _written(self, method, params, result):
+        field = method[len("set_"):]
+        record = self._records.get(params[0]) if self._records is not None and len(params) == 2 else None
+        if method.startswith("set_") and record is not None and field in record and not _is_ref(params[1]):
+            # Plain field setters are written through
+            self._unindex(params[0], record)
+            record[field] = copy.deepcopy(params[1])
+            self._index(params[0], record)
+            return
+
+        for ref in _find_refs(params):
+            self._inventory.invalidate(ref)
+        if method == "destroy" or _is_ref(result):
+            # Objects have been created or destroyed, membership must be re-read
+            self._inventory.set_dirty()
+
+
+def _is_ref(value):
+    return isinstance(value, str) and value.startswith("OpaqueRef:") and value != NULL_REF
+
+
+def _find_refs(value):
+    if _is_ref(value):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _find_refs(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _find_refs(item)
+
+
+def _encode_value(value):
+    if isinstance(value, DateTime):
+        return {"__datetime__": value.value}
+    raise TypeError("Cannot encode {}".format(type(value)))
+
+
+def _decode_value(value):
+    if len(value) == 1 and "__datetime__" in value:
+        return DateTime(value["__datetime__"])
+    return value
+
+
+def get_cache_file(cache_dir, master):
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, "inventory_{}.json".format(get_saned_string(master)))
@@ -0,0 +1,17 @@
+from handlers.common import Common
+
+
+class PBD(Common):
+    _type = "PBD"
+
+    def __init__(self, xapi, ref=None, params=None):
+        super().__init__(xapi, ref, params)
+
+    def get_host_ref(self):
+        return self.xapi.get_host(self.ref)
+
+    def get_sr_ref(self):
+        return self.xapi.get_SR(self.ref)
+
+    def is_attached(self):
+        return self.xapi.get_currently_attached(self.ref)
@@ -1,4 +1,5 @@
 from handlers.common import Common
+from handlers.pbd import PBD
 
 
 class SR(Common):
@@ -6,3 +7,14 @@ class SR(Common):
 
     def __init__(self, xapi, ref=None, params=None):
         super().__init__(xapi, ref, params)
+
+    def is_shared(self):
+        return self.xapi.get_shared(self.ref)
+
+    def get_local_host_ref(self):
+        """Host the SR is attached to if it is local to a single host, None otherwise."""
+        if self.is_shared():
+            return None
+        host_refs = {pbd.get_host_ref() for pbd in (PBD(self._xapi, ref) for ref in self.xapi.get_PBDs(self.ref))
+                     if pbd.is_attached()}
+        return host_refs.pop() if len(host_refs) == 1 else None
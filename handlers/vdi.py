@@ -2,19 +2,27 @@ import errno
 import logging
 import os
 import re
-import shutil
+import sqlite3
 import ssl
 import time
 from urllib import request
-from urllib.error import HTTPError
+from urllib.error import HTTPError, URLError
 
-from handlers import common
+from handlers import common, host
 from handlers.common import CommonEntities, get_by_uuid, get_by_label
 from handlers.pool import Pool
 from handlers.sr import SR
 from handlers.task import Task
 from handlers.vbd import VBD
+from lib import checksum, chunkstore, compression, fileio, retention, vhd
 from lib.XenAPI import Failure
+from lib.catalog import Catalog
+from lib.checksum import HashingWriter
+from lib.chunkstore import ChunkStore, ChunkWriter, ManifestReader
+from lib.compression import CompressedWriter, DecompressingReader
+from lib.stream import TransferStats, copy_stream, preallocate
+from lib.upload import put_file, put_stream
+from lib.vhd import MergedVhd, VhdFile, ZeroBlockFilter
 
 ctx = ssl.create_default_context()
 ctx.check_hostname = False
@@ -32,51 +40,96 @@ class VDI(CommonEntities):
     def __init__(self, xapi, master_url, session_id, ref=None, params=None):
         super().__init__(xapi, master_url, session_id, ref, params)
 
+        # Codec, ratio and raw size of the last compressed export
+        self.compression = None
+        # Raw and written size of the last export to the chunk store
+        self.dedup = None
+        # Checksum of the last export (not for the chunk store, whose chunks are named by their hash)
+        self.checksum = None
+
     def get_type(self):
         return self.xapi.get_type(self.ref)
 
+    def get_sr_ref(self):
+        return self.xapi.get_SR(self.ref)
+
     def get_vbds(self):
         return (VBD(self._xapi, vbd_ref) for vbd_ref in self.xapi.get_VBDs(self.ref))
 
-    def get_export_file(self, vdi_back_dir, export_type="full"):
+    def get_export_file(self, vdi_back_dir, export_type="full", codec_name=None):
         return os.path.join(
             vdi_back_dir,
-            "{}_{}.{}".format(self.get_snapshot_time(ts_format="%Y%m%dT%H%M00"), export_type, self.vdi_file_format))
+            "{}_{}.{}{}".format(self.get_snapshot_time(ts_format="%Y%m%dT%H%M00"), export_type, self.vdi_file_format,
+                                "." + codec_name if codec_name else ""))
+
+    def find_export_file(self, base_back_dir, vdi_back_dir, export_type="full"):
+        """Existing export of the VDI, whatever its compression."""
+        for codec_name in [None, chunkstore.manifest_extension] + sorted(compression.codecs):
+            file_name = self.get_export_file(vdi_back_dir, export_type, codec_name)
+            if os.path.exists(os.path.join(base_back_dir, file_name)):
+                return file_name
 
     def import_data(self, vdi_name, vdi_fn, export_type):
+        def upload(url, stats):
+            if chunkstore.is_manifest(vdi_fn):
+                manifest = chunkstore.read_manifest(vdi_fn)
+                with ChunkStore.from_manifest(vdi_fn, manifest) as store:
+                    put_stream(url, ManifestReader(store, manifest), manifest["size"], stats)
+            elif compression.is_compressed(vdi_fn):
+                with fileio.open_input(vdi_fn) as vdi_file, DecompressingReader(vdi_file) as data_file:
+                    put_stream(url, data_file, DecompressingReader.get_raw_size(vdi_fn), stats)
+            else:
+                put_file(url, vdi_fn, stats)
+
+        self._import(vdi_name, "Importing {} VDI {}".format(export_type, vdi_name), upload)
+
+    def import_merged(self, vdi_name, base_vdi_fn, delta_vdi_fn):
+        """Import a delta backup merged with its base in a single upload."""
+        def upload(url, stats):
+            with VhdFile(base_vdi_fn) as base, VhdFile(delta_vdi_fn) as delta, MergedVhd(base, delta) as merged:
+                put_stream(url, merged, merged.size, stats)
+                self.logger.debug("%d blocks imported, %d from the delta backup", merged.blocks, merged.delta_blocks)
 
-        task = Task(self._xapi, params=[vdi_name + " import", "Importing {} VDI {}".format(export_type, vdi_name)])
+        self._import(vdi_name, "Importing merged full and delta VDI {}".format(vdi_name), upload)
+
+    def _import(self, vdi_name, description, upload):
+        task = Task(self._xapi, params=[vdi_name + " import", description])
 
         self.logger.debug("Importing VDI data of %s", vdi_name)
 
-        url = "{}/import_raw_vdi?session_id={}&task_id={}&format={}&vdi={}".format(
-            self.master_url, self.session_id, task.ref, self.vdi_file_format, self.ref)
+        def upload_to(transfer_url):
+            upload("{}/import_raw_vdi?session_id={}&task_id={}&format={}&vdi={}".format(
+                transfer_url, self.session_id, task.ref, self.vdi_file_format, self.ref), stats)
 
-        with open(vdi_fn, 'rb') as vdi_file:
-            req = request.Request(url, data=vdi_file, method="PUT")
-            req.add_header("Content-Length", str(os.path.getsize(vdi_fn)))
+        stats = TransferStats()
+        try:
+            host.transfer(self.master_url, host.get_transfer_url(self._xapi, self.master_url, [self.get_sr_ref()]),
+                          upload_to)
+        except (HTTPError, IOError, SystemExit, ValueError) as e:
             try:
-                request.urlopen(req, context=ctx)
-            except (HTTPError, IOError, SystemExit) as e:
-                try:
-                    task.cancel()
-                except Failure:
-                    self.logger.exception("Error cancelling import task")
-                raise e
-            else:
-                self.logger.debug("VDI data import completed")
+                task.cancel()
+            except Failure:
+                self.logger.exception("Error cancelling import task")
+            raise e
+        else:
+            self.logger.debug("VDI data import completed (%s)", stats)
 
-    def export(self, base_back_dir, vdi_back_dir, base_vdi=None, overwrite=True, clean_on_failure=True):
+    def export(self, base_back_dir, vdi_back_dir, base_vdi=None, overwrite=True, clean_on_failure=True, abort=None):
         export_done = False
         export_retries = self._export_retries
 
         vdi_name = self.get_label()
         export_type = "full" if base_vdi is None else "delta"
 
-        file_name = self.get_export_file(vdi_back_dir, export_type)
+        codec = compression.get_codec() if compression.default_codec and not chunkstore.enabled else None
+        file_name = self.get_export_file(
+            vdi_back_dir, export_type,
+            chunkstore.manifest_extension if chunkstore.enabled else codec.name if codec is not None else None)
         full_file_name = os.path.join(base_back_dir, file_name)
 
-        if overwrite or not os.path.exists(full_file_name):
+        if not overwrite:
+            file_name = self.find_export_file(base_back_dir, vdi_back_dir, export_type) or file_name
+        if overwrite or not os.path.exists(os.path.join(base_back_dir, file_name)):
             while not export_done:
                 export_retries -= 1
 
@@ -88,14 +141,19 @@ class VDI(CommonEntities):
 
                 os.makedirs(os.path.join(base_back_dir, vdi_back_dir), 0o755, True)
 
+                transfer_url = host.get_transfer_url(self._xapi, self.master_url, [self.get_sr_ref()])
                 url = "{}/export_raw_vdi?session_id={}&task_id={}&format={}&vdi={}".format(
-                    self.master_url, self.session_id, task.ref, self.vdi_file_format, self.ref)
+                    transfer_url, self.session_id, task.ref, self.vdi_file_format, self.ref)
                 if base_vdi is not None:
                     url = "{}&base={}".format(url, base_vdi.ref)
 
+                stats = TransferStats()
                 try:
-                    with request.urlopen(url, context=ctx) as response, open(full_file_name, 'wb') as out_file:
-                        shutil.copyfileobj(response, out_file)
+                    with request.urlopen(url, context=ctx) as response:
+                        if chunkstore.enabled:
+                            self._export_chunks(response, base_back_dir, full_file_name, abort, stats)
+                        else:
+                            self._export_file(response, full_file_name, codec, base_vdi is None, abort, stats)
                 except (HTTPError, IOError, SystemExit) as e:
                     try:
                         task.cancel()
@@ -103,9 +161,12 @@ class VDI(CommonEntities):
                         self.logger.error("Error cancelling export task")
                     if os.path.exists(full_file_name) and clean_on_failure:
                         try:
-                            os.remove(full_file_name)
+                            retention.remove_file(full_file_name, gradual=False)
                         except IOError:
                             self.logger.error("Error failed deleting VDI %s", vdi_name)
+                    # Host not reachable: retried through the master
+                    if isinstance(e, URLError) and not isinstance(e, HTTPError) and transfer_url != self.master_url:
+                        host.fall_back_to_master(self.master_url, transfer_url)
                     # Retry if error is IOError but no insufficient space
                     if isinstance(e, IOError) and e.errno != errno.ENOSPC and export_retries > 0:
                         self.logger.warning("Error exporting VDI %s (%s). Retrying", vdi_name, e)
@@ -113,11 +174,48 @@ class VDI(CommonEntities):
                         self.logger.error("VDI export failed: %s", e)
                         raise e
                 else:
+                    self.logger.debug("VDI %s export completed (%s)", vdi_name, stats)
                     export_done = True
 
         return file_name
 
-    def backup(self, base_folder, vm_back_dir, backup_vdis_map=None):
+    def _export_file(self, response, file_name, codec, full, abort, stats):
+        with fileio.open_output(file_name) as out_file:
+            out = HashingWriter(out_file) if checksum.enabled else out_file
+            if codec is None and full and vhd.drop_zero_blocks:
+                if response.length:
+                    preallocate(out_file, response.length)
+                zero_filter = ZeroBlockFilter(out)
+                copy_stream(response, zero_filter, abort=abort, stats=stats)
+                zero_filter.close()
+                self.logger.debug("%d zero blocks dropped, %d bytes saved", zero_filter.zero_blocks,
+                                  zero_filter.bytes_saved)
+            elif codec is None:
+                copy_stream(response, out, response.length, abort, stats=stats)
+            else:
+                with CompressedWriter(out, codec) as compressed_file:
+                    copy_stream(response, compressed_file, abort=abort, stats=stats)
+                self.compression = {"codec": codec.name, "ratio": compressed_file.get_ratio(),
+                                    "raw_size": compressed_file.raw_size}
+        if checksum.enabled:
+            self.checksum = out.get_checksum()
+            # The base of the deltas outlives the definition recording its checksum
+            if full:
+                checksum.write_sidecar(file_name, self.checksum)
+
+    def _export_chunks(self, response, base_back_dir, manifest_file, abort, stats):
+        with ChunkStore(os.path.join(base_back_dir, chunkstore.store_dir)) as store:
+            writer = ChunkWriter(store)
+            try:
+                copy_stream(response, writer, abort=abort, stats=stats)
+                chunkstore.write_manifest(manifest_file, store, writer.close())
+            except BaseException:
+                writer.discard()
+                raise
+        self.dedup = {"raw_size": writer.raw_size, "stored_size": writer.stored_size}
+        self.logger.debug("%d of %d bytes written to the chunk store", writer.stored_size, writer.raw_size)
+
+    def backup(self, base_folder, vm_back_dir, backup_vdis_map=None, abort=None):
         base_vdi = None
         base_vdi_file_name = None
 
@@ -128,15 +226,34 @@ class VDI(CommonEntities):
         if backup_vdis_map is not None and vm_vdi.ref in backup_vdis_map:
             base_vdi = backup_vdis_map[vm_vdi.ref]
             # if base vdi export is missing re-export it
-            base_vdi_file_name = base_vdi.export(base_folder, vdi_back_dir, overwrite=False)
+            base_vdi_file_name = base_vdi.export(base_folder, vdi_back_dir, overwrite=False, abort=abort)
 
-        vdi_file_name = self.export(base_folder, vdi_back_dir, base_vdi)
+        vdi_file_name = self.export(base_folder, vdi_back_dir, base_vdi, abort=abort)
 
         vdi_record = self.get_record()
         vdi_record["SR_label"] = SR(self._xapi, vdi_record["SR"]).get_label()
         vdi_record["backup_file"] = vdi_file_name
+        if self.compression is not None:
+            vdi_record["compression"] = self.compression["codec"]
+            vdi_record["compression_ratio"] = self.compression["ratio"]
+            vdi_record["raw_size"] = self.compression["raw_size"]
+        if self.dedup is not None:
+            vdi_record["raw_size"] = self.dedup["raw_size"]
+            vdi_record["stored_size"] = self.dedup["stored_size"]
+        if self.checksum is not None:
+            vdi_record["checksum"] = self.checksum
         if base_vdi_file_name is not None:
             vdi_record["backup_base_file"] = base_vdi_file_name
+            # The base file was missing and exported again
+            if base_vdi.checksum is not None:
+                vdi_record["backup_base_checksum"] = base_vdi.checksum
+
+        try:
+            with Catalog(base_folder) as backup_catalog:
+                backup_catalog.add_vdi_backup(vdi_record)
+        except sqlite3.Error as e:
+            # Recorded with the definition using it
+            self.logger.error("Error recording VDI backup %s in the catalog: %s", vdi_file_name, e)
 
         return vdi_record
 
@@ -173,14 +290,16 @@ def restore(xapi, master_url, session_id, vdi_record, base_back_dir, sr_map=None
     vdi = VDI(xapi, master_url, session_id, params=vdi_record)
     vdi_name = vdi.get_label()
 
+    vdi_file = os.path.join(base_back_dir, vdi_record["backup_file"])
+    base_vdi_file = os.path.join(base_back_dir, vdi_record["backup_base_file"]) if delta_restore else None
     try:
-        if delta_restore:
-            vdi_file = os.path.join(base_back_dir, vdi_record["backup_base_file"])
-            vdi.import_data(vdi_name, vdi_file, "full")
-
-        vdi_file = os.path.join(base_back_dir, vdi_record["backup_file"])
-        vdi.import_data(vdi_name, vdi_file, "delta" if delta_restore else "full")
-    except (HTTPError, IOError, SystemExit) as e:
+        if delta_restore and vhd.merge_restores and vhd.can_merge(base_vdi_file, vdi_file):
+            vdi.import_merged(vdi_name, base_vdi_file, vdi_file)
+        else:
+            if delta_restore:
+                vdi.import_data(vdi_name, base_vdi_file, "full")
+            vdi.import_data(vdi_name, vdi_file, "delta" if delta_restore else "full")
+    except (HTTPError, IOError, SystemExit, ValueError) as e:
         logger.error("Error importing VDI %s", str(e))
         vdi.destroy()
         raise e
@@ -188,35 +307,18 @@ def restore(xapi, master_url, session_id, vdi_record, base_back_dir, sr_map=None
     return vdi.ref
 
 
-def clean(vdi_record, base_folder, delete):
+def remove_files(base_folder, vdi_files):
+    """Delete VDI files (paths relative to base_folder), returns the ones gone."""
     logger = logging.getLogger("VDI")
-    used_vdi_files = []
-    if delete:
+    removed = []
+    for vdi_file in vdi_files:
         try:
-            os.remove(os.path.join(base_folder, vdi_record["backup_file"]))
+            retention.remove_file(os.path.join(base_folder, vdi_file), gradual=False)
         except IOError as e:
-            logger.error("Error deleting VDI file %s %s", vdi_record["backup_file"], str(e))
+            logger.error("Error deleting VDI file %s %s", vdi_file, str(e))
         else:
-            logger.debug("VDI file %s deleted", vdi_record["backup_file"])
-    else:
-        if "backup_base_file" in vdi_record:
-            used_vdi_files.append(os.path.join(base_folder, vdi_record["backup_base_file"]))
-        used_vdi_files.append(os.path.join(base_folder, vdi_record["backup_file"]))
-    return used_vdi_files
-
-
-def clean_unused(vm_back_dir, used_vdi_files):
-    logger = logging.getLogger("VDI")
-
-    for dp, dn, filenames in os.walk(vm_back_dir):
-        for filename in filenames:
-            if filename.endswith(VDI.vdi_file_format) and os.path.join(dp, filename) not in used_vdi_files:
-                try:
-                    os.remove(os.path.join(dp, filename))
-                except IOError as e:
-                    logger.error("Error deleting VDI file %s %s", os.path.join(dp, filename), str(e))
-                else:
-                    logger.debug("VDI file %s deleted", os.path.join(dp, filename))
+            removed.append(vdi_file)
+    return removed
 
 
 def get_orphan_vdis(xapi):
@@ -226,7 +328,7 @@ def get_orphan_vdis(xapi):
         VDI(xapi, None, None, vdi_ref) for vdi_ref in common.get_all_refs(xapi.VDI)
     )
         if vdi.get_type() == 'user'
-           and len(vdi.get_vbds()) == 0
+           and len(vdi.xapi.get_VBDs(vdi.ref)) == 0
            and "destroy" in vdi.get_allowed_operations()
            and not regex.match(vdi.get_label())
     )
@@ -1,21 +1,30 @@
 import errno
-import json
 import logging
 import os
-import shutil
+import sqlite3
 import ssl
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, CancelledError, as_completed
 from _ssl import CERT_NONE
 from urllib import request
 from urllib.error import HTTPError
 
-from handlers import vdi, vif
-from handlers.common import CommonEntities, get_by_uuid, get_by_label, get_all_refs
+from handlers import host, vdi, vif
+from handlers.common import CommonEntities, get_by_uuid, get_by_label
+from handlers.pool import Pool
 from handlers.task import Task
 from handlers.vbd import VBD
-from handlers.vdi import VDI
+from handlers.vdi import VDI, remove_files as remove_vdi_files
 from handlers.vif import VIF
+from lib import checksum, compression, fileio, retention
 from lib.XenAPI import Failure
+from lib.catalog import Catalog
+from lib.checksum import HashingWriter
+from lib.compression import ZstdReader, ZstdWriter
 from lib.functions import get_saned_string, get_timestamp, vm_definition_to_file, vm_definition_from_file
+from lib.stream import TransferStats, copy_stream
+from lib.upload import put_file, put_stream
 
 ctx = ssl.create_default_context()
 ctx.check_hostname = False
@@ -63,6 +72,20 @@ class VM(CommonEntities):
     def is_suspended(self):
         return self.get_power_state() == 'Suspended'
 
+    def get_host_ref(self):
+        host_ref = self.xapi.get_resident_on(self.ref)
+        if host_ref == "OpaqueRef:NULL":
+            host_ref = self.xapi.get_affinity(self.ref)
+        return host_ref if host_ref != "OpaqueRef:NULL" else None
+
+    def get_backup_resources(self):
+        """Host and SRs streaming the VM data during its backup, as lib.scheduler resources."""
+        resources = {("SR", vdi.get_sr_ref()) for vdi in self.get_vdis(disk_only=True)}
+        host_ref = self.get_host_ref()
+        if host_ref is not None:
+            resources.add(("host", host_ref))
+        return resources
+
     def can_export(self):
         return "export" in self.xapi.get_allowed_operations(self.ref)
 
@@ -131,7 +154,7 @@ class VM(CommonEntities):
 
         super().destroy()
 
-    def export(self, base_back_dir, base_vm_name=None, vm_name=None, clean_on_failure=True):
+    def export(self, base_back_dir, base_vm_name=None, vm_name=None, clean_on_failure=True, abort=None):
         if vm_name is None:
             vm_name = (self.get_snapshot_of() if self.is_snapshot() else self).get_label()
         if base_vm_name is None:
@@ -141,37 +164,62 @@ class VM(CommonEntities):
                 get_saned_string(vm_name)
             )
 
-        file_name = base_vm_name + ".xva"
+        writer_class = compression.get_xva_writer_class()
+        file_name = base_vm_name + ".xva" + (writer_class.extension if writer_class is not None else "")
         full_file_name = os.path.join(base_back_dir, file_name)
 
         desc = self.export_template.format("full", "VM", vm_name, full_file_name)
         self.logger.debug(desc)
 
-        task = Task(self._xapi, params=[vm_name + " export", desc])
-
-        url = "{}/export?session_id={}&task_id={}&ref={}&use_compression=true".format(
-            self.master_url, self.session_id, task.ref, self.ref)
-
+        stats = TransferStats()
         try:
-            with request.urlopen(url, context=ctx) as response, open(full_file_name, 'wb') as out_file:
-                shutil.copyfileobj(response, out_file)
+            # Compressing on the host costs dom0 CPU time, the local writers compress on the backup server instead
+            with self.open_export(vm_name, desc, compression.xva_compression == "host") as response, \
+                    fileio.open_output(full_file_name) as out_file:
+                out = HashingWriter(out_file) if checksum.enabled else out_file
+                if writer_class is None:
+                    copy_stream(response, out, response.length, abort, stats=stats)
+                else:
+                    with writer_class(out, compression.xva_level) as compressed_file:
+                        copy_stream(response, compressed_file, abort=abort, stats=stats)
+                    self.logger.debug("VM %s export compressed, ratio %.2f", vm_name, compressed_file.get_ratio())
+            if checksum.enabled:
+                checksum.write_sidecar(full_file_name, out.get_checksum())
         except (HTTPError, IOError, SystemExit) as e:
             self.logger.error("VM export failed: %s", e)
-            try:
-                task.cancel()
-            except Failure:
-                self.logger.exception("Error cancelling export task")
             if os.path.exists(full_file_name) and clean_on_failure:
                 try:
-                    os.remove(full_file_name)
+                    retention.remove_file(full_file_name, gradual=False)
                 except IOError:
                     self.logger.exception("Error deleting failed VM export file %s", full_file_name)
             raise e
 
-        self.logger.debug("VM %s export completed", vm_name)
+        self.logger.debug("VM %s export completed (%s)", vm_name, stats)
 
         return full_file_name
 
+    @contextmanager
+    def open_export(self, vm_name, desc, use_compression=True):
+        """HTTP response streaming the XVA export of the VM. The export task is cancelled if the transfer fails."""
+        task = Task(self._xapi, params=[vm_name + " export", desc])
+
+        def open_from(transfer_url):
+            return request.urlopen("{}/export?session_id={}&task_id={}&ref={}&use_compression={}".format(
+                transfer_url, self.session_id, task.ref, self.ref, "true" if use_compression else "false"),
+                context=ctx)
+
+        sr_refs = {disk.get_sr_ref() for disk in self.get_vdis(disk_only=True)}
+        try:
+            with host.transfer(self.master_url, host.get_transfer_url(self._xapi, self.master_url, sr_refs),
+                               open_from) as response:
+                yield response
+        except (HTTPError, IOError, SystemExit, ValueError) as e:
+            try:
+                task.cancel()
+            except Failure:
+                self.logger.exception("Error cancelling export task")
+            raise e
+
     def get_backup_snapshots(self, snap_type=""):
         return (snapshot for snapshot in self.get_snapshots()
                 if snapshot.get_label().startswith(self.backup_snap_prefix + snap_type))
@@ -184,7 +232,7 @@ class VM(CommonEntities):
 
         return backup_snap
 
-    def backup(self, failed_vms, base_folder, num_vm=1, num_vms=1, backup_new_snap=True):
+    def backup(self, failed_vms, base_folder, num_vm=1, num_vms=1, backup_new_snap=True, abort=None):
         vm_uuid = self.get_uuid()
         vm_name = self.get_label()
 
@@ -207,7 +255,7 @@ class VM(CommonEntities):
         backup_snap.set_name(backup_new_name)
 
         try:
-            backup_filename = backup_snap.export(base_folder, vm_name=vm_name)
+            backup_filename = backup_snap.export(base_folder, vm_name=vm_name, abort=abort)
         except Failure as e:
             failed_vms.update({self.ref: self.export_error_template.format("VM", vm_name, vm_uuid, "XenAPI", e)})
             self.logger.error("XenApi error: %s", str(e))
@@ -225,7 +273,15 @@ class VM(CommonEntities):
                 {self.ref: self.export_error_template.format("VM", vm_name, vm_uuid, "Generic", "interrupt")})
             raise e
         else:
-            self.logger.info("Full backup of VM %s successfully completed", vm_name)
+            try:
+                with Catalog(base_folder) as backup_catalog:
+                    backup_catalog.add_full_backup(backup_filename)
+            except sqlite3.Error as e:
+                # The XVA file is kept, the next retention of the VM catalogues it
+                failed_vms.update({self.ref: self.export_error_template.format("VM", vm_name, vm_uuid, "Catalog", e)})
+                self.logger.error("Catalog error: %s", str(e))
+            else:
+                self.logger.info("Full backup of VM %s successfully completed", vm_name)
         finally:
             if delete_snapshot:
                 backup_snap.destroy()
@@ -234,8 +290,47 @@ class VM(CommonEntities):
 
         return backup_filename
 
+    def backup_vdis(self, vdis, base_folder, vm_back_dir, backup_vdis_map=None, backup_vdis=None, vdi_workers=1,
+                    abort=None):
+        """Back up the VDIs with up to vdi_workers exports in parallel.
+
+        The records of the completed VDI backups are added to backup_vdis. At the first error the pending exports
+        are cancelled and the running ones aborted through the abort event (which the caller can set too), then the
+        error is raised.
+        """
+        if backup_vdis is None:
+            backup_vdis = {}
+        error = None
+        if abort is None:
+            abort = threading.Event()
+
+        with ThreadPoolExecutor(max(vdi_workers, 1), thread_name_prefix="vdi-export") as executor:
+            futures = {executor.submit(vdi.backup, base_folder, vm_back_dir, backup_vdis_map, abort): vdi
+                       for vdi in vdis}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        backup_vdis[futures[future].ref] = future.result()
+                    except CancelledError:
+                        pass
+                    except BaseException as e:
+                        if error is None:
+                            error = e
+                            abort.set()
+                            for pending in futures:
+                                pending.cancel()
+            except SystemExit as e:
+                error = e
+                abort.set()
+                for pending in futures:
+                    pending.cancel()
+
+        if error is not None:
+            raise error
+        return backup_vdis
+
     # Perform delta backup of a single VM
-    def backup_delta(self, failed_vms, base_folder, num_vm=1, num_vms=1):
+    def backup_delta(self, failed_vms, base_folder, num_vm=1, num_vms=1, vdi_workers=1, abort=None):
         vm_uuid = self.get_uuid()
         vm_name = self.get_label()
 
@@ -272,21 +367,25 @@ class VM(CommonEntities):
         vm_back_dir = self.get_vm_back_dir()
         os.makedirs(os.path.join(base_folder, vm_back_dir), 0o755, True)
 
+        written = False
         try:
+            vdi_vbds = {}
             for vbd in backup_snap.get_vbds():
                 backup_vbds[vbd.ref] = vbd.get_record()
                 vdi_ref = vbd.get_vdi_ref(disk_only=True)
                 if vdi_ref is not None:
-                    vdi = VDI(self._xapi, self.master_url, self.session_id, vdi_ref)
-                    vdi_record = vdi.backup(base_folder, vm_back_dir, backup_vdis_map)
-                    backup_vdis[vdi.ref] = vdi_record
+                    vdi_vbds[VDI(self._xapi, self.master_url, self.session_id, vdi_ref)] = vbd
+
+            self.backup_vdis(vdi_vbds.keys(), base_folder, vm_back_dir, backup_vdis_map, backup_vdis, vdi_workers,
+                             abort)
 
-                    if backup_vdis_map is not None and vdi.get_snapshot_of().ref not in backup_vdis_map:
-                        vbd_record = vbd.get_record()
-                        vbd_record["VM"] = base_backup_snap.ref
-                        vbd_record["VDI"] = vdi.ref
+            for vdi, vbd in vdi_vbds.items():
+                if backup_vdis_map is not None and vdi.get_snapshot_of().ref not in backup_vdis_map:
+                    vbd_record = vbd.get_record()
+                    vbd_record["VM"] = base_backup_snap.ref
+                    vbd_record["VDI"] = vdi.ref
 
-                        retain_vdis[vdi.ref] = vbd_record
+                    retain_vdis[vdi.ref] = vbd_record
 
         # except XenAPI.Failure as e:
         #     failed_vms.update{vm: self.error_template.format("VDI of VM", vm_name, vm_uuid, "XenAPI", e)}
@@ -316,20 +415,30 @@ class VM(CommonEntities):
                 "vdis": backup_vdis,
                 "vifs": backup_vifs
             }
-            vm_def_fn = vm_definition_to_file(
-                vm_definition, base_folder, vm_back_dir, backup_snap.get_snapshot_time())
-            self.logger.info("Backup of VM %s completed", vm_name)
-            return vm_back_dir, vm_def_fn
+            try:
+                vm_def_fn = vm_definition_to_file(
+                    vm_definition, base_folder, vm_back_dir, backup_snap.get_snapshot_time())
+            except sqlite3.Error as e:
+                # The definition is written, the VDI files are kept
+                written = True
+                failed_vms.update(
+                    {self.ref: self.export_error_template.format("VM", vm_name, vm_uuid, "Catalog", str(e))})
+                self.logger.error("Catalog error %s", str(e))
+            else:
+                self.logger.info("Backup of VM %s completed", vm_name)
+                return vm_back_dir, vm_def_fn
         finally:
-            if self.ref in failed_vms:
+            if self.ref in failed_vms and not written:
                 self.logger.error("Error during backup. %s", failed_vms[self.ref])
                 retain_vdis = {}
-                for backup_vdi_record in backup_vdis.values():
-                    vdi_file = os.path.join(base_folder, backup_vdi_record["backup_file"])
-                    try:
-                        os.remove(vdi_file)
-                    except OSError:
-                        self.logger.exception("Error removing VDI file %s", vdi_file)
+                vdi_files = [backup_vdi_record["backup_file"] for backup_vdi_record in backup_vdis.values()]
+                removed = remove_vdi_files(base_folder, vdi_files)
+                try:
+                    with Catalog(base_folder) as backup_catalog:
+                        backup_catalog.remove_files(removed)
+                except sqlite3.Error as e:
+                    # Forgotten by the next retention, when queued for deletion
+                    self.logger.warning("Error removing the deleted VDI files from the catalog: %s", str(e))
 
             # is delta backup
             if backup_vdis_map is not None:
@@ -345,46 +454,38 @@ class VM(CommonEntities):
                         self.logger.exception("Error creating new VBD for missing backup VDI")
 
     def clean_backups(self, base_folder, num_backups_to_retain):
-        vm_uuid = self.get_uuid()
-        vm_files = [vm_file for vm_file in os.listdir(base_folder) if
-                    vm_file.startswith(vm_uuid) and vm_file.endswith(".xva")]
-        vm_files.sort()
-
-        vm_files_discard = vm_files[:-num_backups_to_retain]
+        """Queue the XVA files of the discarded backups for deletion (see lib.retention)."""
+        with Catalog(base_folder) as backup_catalog:
+            backup_catalog.sync_full_backups(self.get_uuid())
+            restore_points = backup_catalog.get_restore_points(self.get_uuid(), "full")
 
-        for vm_file in vm_files_discard:
-            try:
-                os.remove(os.path.join(base_folder, vm_file))
-            except IOError as e:
-                self.logger.error("Error deleting VM file %s %s", vm_file, str(e))
-            else:
-                self.logger.debug("VM file %s deleted", vm_file)
+            for restore_point in restore_points[:-num_backups_to_retain]:
+                backup_catalog.remove_restore_point(restore_point["path"])
+                backup_catalog.queue_deletion([restore_point["path"]])
+                self.logger.debug("VM file %s queued for deletion", restore_point["path"])
 
     def clean_delta_backups(self, base_folder, num_backups_to_retain):
+        """Delete the discarded VM definitions, queue their VDI files for deletion (see lib.retention)."""
         vm_back_dir = self.get_vm_back_dir()
-        vm_def_files = [vm_file for vm_file in os.listdir(os.path.join(base_folder, vm_back_dir)) if
-                        vm_file.endswith(".json")]
-        vm_def_files.sort()
-
-        vm_def_files_discard = vm_def_files[:-num_backups_to_retain]
-
-        used_base_vdis = []
+        with Catalog(base_folder) as backup_catalog:
+            backup_catalog.sync_vm_dir(vm_back_dir)
+            restore_points = backup_catalog.get_restore_points(self.get_uuid(), "delta")
 
-        for vm_def_file in vm_def_files:
-            discard = vm_def_file in vm_def_files_discard
-            with open(os.path.join(base_folder, vm_back_dir, vm_def_file)) as vm_file:
-                for vdi_record in json.load(vm_file)["vdis"].values():
-                    used_base_vdis = used_base_vdis + vdi.clean(vdi_record, base_folder, discard)
-
-            if discard:
+            for restore_point in restore_points[:-num_backups_to_retain]:
+                vm_def_file = restore_point["path"]
                 try:
-                    os.remove(os.path.join(base_folder, vm_back_dir, vm_def_file))
+                    os.remove(os.path.join(base_folder, vm_def_file))
+                except FileNotFoundError:
+                    pass
                 except IOError as e:
                     self.logger.error("Error deleting VM definition file %s %s", vm_def_file, str(e))
+                    continue
                 else:
-                    self.logger.debug("VM definition file '%s' deleted", os.path.join(vm_back_dir, vm_def_file))
+                    self.logger.debug("VM definition file '%s' deleted", vm_def_file)
+                backup_catalog.remove_restore_point(vm_def_file)
 
-        vdi.clean_unused(os.path.join(base_folder, vm_back_dir), used_base_vdis)
+            # Files of the discarded definitions not used by the retained ones (e.g. the base of their deltas)
+            backup_catalog.queue_deletion(backup_catalog.get_unused_files(self.get_uuid()))
 
 
 """
@@ -395,7 +496,7 @@ class VM(CommonEntities):
 def restore(xapi, master_url, session_id, file_name, sr_map=None, auto_start=False, restore=False):
     logger = logging.getLogger("VM")
 
-    backup_name = os.path.basename(file_name)[:-4]
+    backup_name = os.path.basename(file_name).rsplit(".xva", 1)[0]
     try:
         vm_uuid, backup_ts, vm_name = backup_name.split("__")
     except ValueError:
@@ -404,29 +505,45 @@ def restore(xapi, master_url, session_id, file_name, sr_map=None, auto_start=Fal
 
     logger.info("Restoring VM %s", vm_name)
 
+    # XenServer reads gzip exports but not zstd ones, which are decompressed while uploading
+    def upload(url):
+        if file_name.endswith(ZstdWriter.extension):
+            with fileio.open_input(file_name) as vm_file, ZstdReader(vm_file) as data_file:
+                put_stream(url, data_file, ZstdReader.get_raw_size(file_name))
+        else:
+            put_file(url, file_name)
+
+    import_vm(xapi, master_url, session_id, vm_name, upload, sr_map.get(vm_uuid) if sr_map is not None else None,
+              restore)
+
+    logger.info("VM %s restored", vm_name)
+
+
+def import_vm(xapi, master_url, session_id, vm_name, upload, sr_id=None, restore=False):
+    """Import an XVA, sent by upload(url) (see lib.upload), to the SR with UUID sr_id (default SR if None)."""
+    logger = logging.getLogger("VM")
+
     task = Task(xapi, params=[vm_name + " VM import", "Importing full VM " + vm_name])
 
-    url = "{}/import?session_id={}&task_id={}".format(master_url, session_id, task.ref)
-    if sr_map is not None and vm_uuid in sr_map:
-        url = url + "&sr_id=" + sr_map[vm_uuid]
-    if restore:
-        url = url + "&restore=true"
+    sr_ref = get_by_uuid(xapi.SR, sr_id) if sr_id is not None else Pool(xapi).get_default_sr().ref
+
+    def upload_to(transfer_url):
+        url = "{}/import?session_id={}&task_id={}".format(transfer_url, session_id, task.ref)
+        if sr_id is not None:
+            url = url + "&sr_id=" + sr_ref
+        if restore:
+            url = url + "&restore=true"
+        upload(url)
 
     try:
-        with open(file_name, 'rb') as vm_file:
-            req = request.Request(url, data=vm_file, method="PUT")
-            req.add_header("Content-Length", str(os.path.getsize(file_name)))
-            req.add_header("content-type", "application/octet-stream")
-            request.urlopen(req, context=ctx)
-    except (HTTPError, IOError, SystemExit) as e:
-        logger.error("VM restore failed: %s", e)
+        host.transfer(master_url, host.get_transfer_url(xapi, master_url, [sr_ref]), upload_to)
+    except (HTTPError, IOError, SystemExit, ValueError) as e:
+        logger.error("VM import failed: %s", e)
         try:
             task.cancel()
         except Failure as f:
-            logger.error("Error cancelling export task %s", f.details)
+            logger.error("Error cancelling import task %s", f.details)
         raise e
-    else:
-        logger.info("VM %s restored", vm_name)
 
 
 def restore_delta(xapi, master_url, session_id, vm_def_file, base_folder, sr_map=None, network_map=None,
@@ -452,7 +569,7 @@ def restore_delta(xapi, master_url, session_id, vm_def_file, base_folder, sr_map
             vif_record["VM"] = vm.ref
             vif.restore(xapi, vif_record, network_map, restore)
 
-    except (HTTPError, IOError, SystemExit, Failure) as e:
+    except (HTTPError, IOError, SystemExit, Failure, ValueError) as e:
         logger.error("Error restoring VM '%s' %s", vm.get_label(), str(e))
         vm.destroy()
         raise e
@@ -466,12 +583,11 @@ def restore_delta(xapi, master_url, session_id, vm_def_file, base_folder, sr_map
 
 
 def get_all_vm_refs(xapi, template=False, snapshot=False, control_domain=False):
-    vm_xapi = xapi.VM
     return [
-        vm_ref for vm_ref in get_all_refs(vm_xapi)
-        if (snapshot or not vm_xapi.get_is_a_snapshot(vm_ref))
-           and (template or not vm_xapi.get_is_a_template(vm_ref))
-           and (control_domain or not vm_xapi.get_is_control_domain(vm_ref))
+        vm_ref for vm_ref, vm_record in xapi.VM.get_all_records().items()
+        if (snapshot or not vm_record["is_a_snapshot"])
+           and (template or not vm_record["is_a_template"])
+           and (control_domain or not vm_record["is_control_domain"])
     ]
 
 
@@ -57,8 +57,13 @@
 import gettext
 import six.moves.xmlrpc_client as xmlrpclib
 import six.moves.http_client as httplib
+import six.moves.queue as queue
 import socket
 import sys
+import threading
+import time
+
+from lib.rpc_stats import RpcStats
 
 translation = gettext.translation('xen-xm', fallback=True)
 
@@ -122,6 +127,91 @@ class UDSTransport(xmlrpclib.Transport):
             connection.putheader(key, value)
 
 
+class ResumableHTTPSConnection(httplib.HTTPSConnection):
+    """HTTPSConnection resuming the TLS session of the last connection of its transport."""
+
+    def __init__(self, host, transport, **kwargs):
+        httplib.HTTPSConnection.__init__(self, host, **kwargs)
+        self._transport = transport
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host if self._tunnel_host else self.host
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname,
+                                              session=self._transport.tls_session)
+
+
+class PooledTransport(xmlrpclib.SafeTransport):
+    """Transport keeping up to pool_size persistent (keep-alive) connections, safe to share between threads.
+
+    Every request checks out an idle connection, or opens a new one, and gives it back once the response has been
+    read. With reuse_tls_session new TLS connections resume the session of the previous ones, skipping the full
+    handshake.
+    """
+
+    def __init__(self, pool_size=1, secure=True, reuse_tls_session=True, use_datetime=0, context=None):
+        xmlrpclib.SafeTransport.__init__(self, use_datetime, context=context)
+        self.pool_size = pool_size
+        self.tls_session = None
+        self._secure = secure
+        self._reuse_tls_session = reuse_tls_session
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._idle = queue.LifoQueue()
+        self._local = threading.local()
+
+    def request(self, host, handler, request_body, verbose=False):
+        with self._slots:
+            try:
+                self._local.connection = self._idle.get_nowait()
+            except queue.Empty:
+                self._local.connection = None
+            self._local.active = True
+            self._local.sent_bytes = getattr(self._local, "sent_bytes", 0) + len(request_body)
+            try:
+                return xmlrpclib.SafeTransport.request(self, host, handler, request_body, verbose)
+            finally:
+                connection = self._local.connection
+                self._local.connection = None
+                self._local.active = False
+                if connection is not None:
+                    if self._reuse_tls_session and getattr(connection.sock, "session", None) is not None:
+                        self.tls_session = connection.sock.session
+                    self._idle.put(connection)
+
+    def parse_response(self, response):
+        self._local.received_bytes = getattr(self._local, "received_bytes", 0) + \
+            int(response.getheader("Content-Length", 0) or 0)
+        return xmlrpclib.SafeTransport.parse_response(self, response)
+
+    def get_payload_counters(self):
+        """Bytes sent and received so far by the requests of the calling thread."""
+        return getattr(self._local, "sent_bytes", 0), getattr(self._local, "received_bytes", 0)
+
+    def make_connection(self, host):
+        if self._local.connection is None:
+            chost, self._extra_headers, x509 = self.get_host_info(host)
+            if not self._secure:
+                self._local.connection = httplib.HTTPConnection(chost)
+            elif self._reuse_tls_session:
+                self._local.connection = ResumableHTTPSConnection(chost, self, context=self.context, **(x509 or {}))
+            else:
+                self._local.connection = httplib.HTTPSConnection(chost, context=self.context, **(x509 or {}))
+        return self._local.connection
+
+    def close(self):
+        if getattr(self._local, "active", False):
+            # Request failed, the connection is in an unknown state
+            connection, self._local.connection = self._local.connection, None
+            if connection is not None:
+                connection.close()
+        else:
+            while True:
+                try:
+                    self._idle.get_nowait().close()
+                except queue.Empty:
+                    break
+
+
 class Session(xmlrpclib.ServerProxy):
     """A server proxy and session manager for communicating with xapi using
     the Xen-API.
@@ -132,19 +222,33 @@ class Session(xmlrpclib.ServerProxy):
     session.login_with_password('me', 'mypassword', '1.0', 'xen-api-scripts-xenapi.py')
     session.xenapi.VM.start(vm_uuid)
     session.xenapi.session.logout()
+
+    Unless a transport is given, requests go through a PooledTransport of
+    pool_size connections: the session can then be used by pool_size
+    threads at once, all of them sharing the same login.
+
+    Calls are timed and counted per method in session.stats (RpcStats).
     """
 
     def __init__(self, uri, transport=None, encoding=None, verbose=0,
-                 allow_none=1, ignore_ssl=False):
+                 allow_none=1, ignore_ssl=False, pool_size=1,
+                 reuse_tls_session=True, stats=None):
+        self._login_lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = stats if stats is not None else RpcStats()
 
         # Fix for CA-172901 (+ Python 2.4 compatibility)
         if not (sys.version_info[0] <= 2 and sys.version_info[1] < 7) \
                 and ignore_ssl:
             import ssl
             ctx = ssl._create_unverified_context()
+            if transport is None:
+                transport = PooledTransport(pool_size, uri.startswith("https"), reuse_tls_session, context=ctx)
             xmlrpclib.ServerProxy.__init__(self, uri, transport, encoding,
                                            verbose, allow_none, context=ctx)
         else:
+            if transport is None:
+                transport = PooledTransport(pool_size, uri.startswith("https"), reuse_tls_session)
             xmlrpclib.ServerProxy.__init__(self, uri, transport, encoding,
                                            verbose, allow_none)
         self.transport = transport
@@ -161,21 +265,43 @@ class Session(xmlrpclib.ServerProxy):
             self._logout()
             return None
         else:
-            retry_count = 0
-            while retry_count < 3:
-                full_params = (self._session,) + params
-                result = _parse_result(getattr(self, methodname)(*full_params))
-                if result is _RECONNECT_AND_RETRY:
-                    retry_count += 1
+            start = time.perf_counter()
+            payload = self._get_payload_counters()
+            try:
+                return self._xenapi_request(methodname, params)
+            finally:
+                sent, received = self._get_payload_counters()
+                self.stats.record(methodname, time.perf_counter() - start, self._local.retries,
+                                  sent - payload[0], received - payload[1])
+
+    def _xenapi_request(self, methodname, params):
+        retry_count = 0
+        self._local.retries = 0
+        while retry_count < 3:
+            session = self._session
+            full_params = (session,) + params
+            result = _parse_result(getattr(self, methodname)(*full_params))
+            if result is _RECONNECT_AND_RETRY:
+                retry_count += 1
+                self._local.retries = retry_count
+                with self._login_lock:
+                    # Another thread may have already logged in again
+                    if self._session != session:
+                        continue
                     if self.last_login_method:
                         self._login(self.last_login_method,
                                     self.last_login_params)
                     else:
                         raise xmlrpclib.Fault(401, 'You must log in')
-                else:
-                    return result
-            raise xmlrpclib.Fault(
-                500, 'Tried 3 times to get a valid session, but failed')
+            else:
+                return result
+        raise xmlrpclib.Fault(
+            500, 'Tried 3 times to get a valid session, but failed')
+
+    def _get_payload_counters(self):
+        if isinstance(self.transport, PooledTransport):
+            return self.transport.get_payload_counters()
+        return 0, 0
 
     def _login(self, method, params):
         try:
@@ -0,0 +1,363 @@
+"""Catalog of the backups of a backup folder, in a SQLite database (catalog.db).
+
+Records the restore points (VM definitions of delta backups and XVA files of full backups), the backup files with
+their size, digest and base file, and which restore points use which files. Retention and lookups are indexed
+queries instead of directory scans and JSON parsing. The catalog is updated as files are written and deleted; the
+backups of a VM folder written before the catalog existed are indexed the first time the folder is cleaned, and the
+XVA files of a VM are reconciled at each of its retention runs. sync picks up the changes made behind its back (e.g.
+definitions deleted by hand), reading only the folders modified since the previous sync.
+
+Paths are relative to the backup folder, like the backup_file fields of the VDI records.
+"""
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from lib import checksum
+from lib.compression import ZstdWriter
+
+logger = logging.getLogger("Catalog")
+
+file_name = "catalog.db"
+xva_extensions = (".xva", ".xva" + ZstdWriter.extension)
+
+_schema = (
+    "CREATE TABLE IF NOT EXISTS restore_points (path TEXT PRIMARY KEY, vm_uuid TEXT NOT NULL, vm_name TEXT NOT NULL, "
+    "timestamp TEXT NOT NULL, type TEXT NOT NULL, size INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS restore_points_vm ON restore_points (vm_uuid, type, timestamp)",
+    "CREATE INDEX IF NOT EXISTS restore_points_time ON restore_points (timestamp)",
+    "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, vm_uuid TEXT NOT NULL, type TEXT NOT NULL, base TEXT, "
+    "size INTEGER NOT NULL, digest TEXT)",
+    "CREATE INDEX IF NOT EXISTS files_vm ON files (vm_uuid)",
+    "CREATE TABLE IF NOT EXISTS uses (restore_point TEXT NOT NULL, file TEXT NOT NULL, "
+    "PRIMARY KEY (restore_point, file)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS uses_file ON uses (file)",
+    # Folders whose existing backups have been indexed
+    "CREATE TABLE IF NOT EXISTS indexed (name TEXT PRIMARY KEY) WITHOUT ROWID",
+    # Modification time of the folders at the last sync
+    "CREATE TABLE IF NOT EXISTS folders (name TEXT PRIMARY KEY, mtime INTEGER NOT NULL) WITHOUT ROWID",
+    # Files dropped by retention waiting to be deleted (see lib.retention)
+    "CREATE TABLE IF NOT EXISTS deletions (path TEXT PRIMARY KEY, queued REAL NOT NULL) WITHOUT ROWID",
+    # Definitions that couldn't be read: the files they use are unknown, none of the VM is unused
+    "CREATE TABLE IF NOT EXISTS unreadable (path TEXT PRIMARY KEY, vm_uuid TEXT NOT NULL) WITHOUT ROWID"
+)
+
+
+class Catalog(object):
+    """Catalog of base_folder. One instance per thread (SQLite connections can't be shared)."""
+
+    def __init__(self, base_folder):
+        self.base_folder = base_folder
+        os.makedirs(base_folder, 0o755, True)
+
+        self._db = sqlite3.connect(os.path.join(base_folder, file_name), timeout=300, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        # Rollback journal: WAL relies on shared memory, not shared between the hosts of a network file system
+        self._db.execute("PRAGMA journal_mode=DELETE")
+        for statement in _schema:
+            self._db.execute(statement)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_vdi_backup(self, vdi_record):
+        """Record the files of a VDI backup record, before the definition using them is written."""
+        with self._transaction():
+            self._add_vdi_files(vdi_record, True)
+
+    def add_definition(self, vm_def_file, vm_definition, tmp_file=None):
+        """Record a delta backup restore point. A tmp_file is moved to vm_def_file within the same transaction."""
+        path = self._get_path(vm_def_file)
+        vm_name = vm_definition["vm"]["name_label"].rsplit(" - backup ", 1)[0]
+        with self._transaction():
+            files = []
+            for vdi_record in vm_definition["vdis"].values():
+                self._add_vdi_files(vdi_record, False)
+                files.extend(vdi_record[key] for key in ("backup_base_file", "backup_file") if key in vdi_record)
+            self._add_restore_point(path, get_vm_uuid(path), vm_name, os.path.splitext(os.path.basename(path))[0],
+                                    "delta", files)
+            self._db.execute("DELETE FROM unreadable WHERE path = ?", (path,))
+            if tmp_file is not None:
+                os.replace(tmp_file, vm_def_file)
+
+    def add_full_backup(self, xva_file):
+        """Record a full backup (XVA file named <VM UUID>__<timestamp>__<VM name>.xva[.zst])."""
+        path = self._get_path(xva_file)
+        vm_uuid, timestamp, vm_name = parse_xva_name(path)
+        xva_checksum = checksum.read_sidecar(xva_file)
+        with self._transaction():
+            self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, 'xva', NULL, ?, ?)",
+                             (path, vm_uuid, os.path.getsize(xva_file), xva_checksum and xva_checksum["digest"]))
+            self._add_restore_point(path, vm_uuid, vm_name, timestamp, "full", [path])
+
+    def remove_restore_point(self, path):
+        """Forget a restore point. Its files are left, see get_unused_files."""
+        with self._transaction():
+            self._db.execute("DELETE FROM uses WHERE restore_point = ?", (path,))
+            self._db.execute("DELETE FROM restore_points WHERE path = ?", (path,))
+
+    def remove_files(self, paths):
+        with self._transaction():
+            for path in paths:
+                self._db.execute("DELETE FROM uses WHERE file = ?", (path,))
+                self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def queue_deletion(self, paths):
+        """Forget files and queue them for deletion."""
+        with self._transaction():
+            for path in paths:
+                self._db.execute("DELETE FROM uses WHERE file = ?", (path,))
+                self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+                self._db.execute("INSERT OR IGNORE INTO deletions VALUES (?, ?)", (path, time.time()))
+
+    def get_deletions(self):
+        return [path for path, in self._db.execute("SELECT path FROM deletions ORDER BY queued, path")]
+
+    def remove_deletion(self, path):
+        with self._transaction():
+            self._db.execute("DELETE FROM deletions WHERE path = ?", (path,))
+
+    def get_restore_points(self, vm_uuid=None, backup_type=None, before=None):
+        """Restore points (dicts) by time, of a VM, of a type (full or delta) and before a timestamp."""
+        conditions, params = [], []
+        for condition, param in (("vm_uuid = ?", vm_uuid), ("type = ?", backup_type), ("timestamp < ?", before)):
+            if param is not None:
+                conditions.append(condition)
+                params.append(param)
+        query = "SELECT * FROM restore_points"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return [dict(row) for row in self._db.execute(query + " ORDER BY timestamp, path", params)]
+
+    def get_files(self, restore_point):
+        return [dict(row) for row in self._db.execute(
+            "SELECT files.* FROM uses JOIN files ON files.path = uses.file WHERE uses.restore_point = ? "
+            "ORDER BY files.path", (restore_point,))]
+
+    def get_latest_restore_point(self, vm_uuid, before=None):
+        """Last restore point of a VM before a timestamp, None if there isn't any."""
+        query, params = "SELECT * FROM restore_points WHERE vm_uuid = ?", [vm_uuid]
+        if before is not None:
+            query, params = query + " AND timestamp < ?", params + [before]
+        row = self._db.execute(query + " ORDER BY timestamp DESC, path DESC LIMIT 1", params).fetchone()
+        return dict(row) if row is not None else None
+
+    def find_vm_uuids(self, vm_names):
+        """UUIDs of the VMs with restore points named after any of vm_names."""
+        return [vm_uuid for vm_uuid, in self._db.execute(
+            "SELECT DISTINCT vm_uuid FROM restore_points WHERE vm_name IN ({}) ORDER BY vm_uuid".format(
+                ", ".join("?" * len(vm_names))), list(vm_names))]
+
+    def get_vm_totals(self):
+        """Per VM: name (of the last restore point), restore points, first and last timestamp, files and bytes."""
+        return [dict(row) for row in self._db.execute(
+            "SELECT points.vm_uuid, "
+            "(SELECT vm_name FROM restore_points AS last WHERE last.vm_uuid = points.vm_uuid "
+            "ORDER BY timestamp DESC LIMIT 1) AS vm_name, "
+            "points.restore_points, points.first, points.last, "
+            "(SELECT COUNT(*) FROM files WHERE files.vm_uuid = points.vm_uuid) AS files, "
+            "(SELECT TOTAL(size) FROM files WHERE files.vm_uuid = points.vm_uuid) AS size "
+            "FROM (SELECT vm_uuid, COUNT(*) AS restore_points, MIN(timestamp) AS first, MAX(timestamp) AS last "
+            "FROM restore_points GROUP BY vm_uuid) AS points ORDER BY vm_name, points.vm_uuid")]
+
+    def get_chain_totals(self, vm_uuid=None):
+        """Per chain (a full VDI file with the deltas based on it, or an XVA file): files and bytes."""
+        query = ("SELECT COALESCE(base, path) AS chain, vm_uuid, COUNT(*) AS files, TOTAL(size) AS size FROM files "
+                 "{} GROUP BY chain ORDER BY chain")
+        if vm_uuid is None:
+            return [dict(row) for row in self._db.execute(query.format(""))]
+        return [dict(row) for row in self._db.execute(query.format("WHERE vm_uuid = ?"), (vm_uuid,))]
+
+    def get_total_size(self):
+        return int(self._db.execute("SELECT TOTAL(size) FROM files").fetchone()[0])
+
+    def get_unused_files(self, vm_uuid):
+        """VDI files of a VM not used by any restore point, none while a definition of the VM can't be read."""
+        if self._db.execute("SELECT 1 FROM unreadable WHERE vm_uuid = ?", (vm_uuid,)).fetchone() is not None:
+            logger.warning("VM %s has unreadable definitions, its unused files are kept", vm_uuid)
+            return []
+        return [path for path, in self._db.execute(
+            "SELECT path FROM files WHERE vm_uuid = ? AND type != 'xva' AND "
+            "NOT EXISTS (SELECT 1 FROM uses WHERE uses.file = files.path) ORDER BY path", (vm_uuid,))]
+
+    def sync_vm_dir(self, vm_back_dir):
+        """Reconcile the delta backups of a VM folder with its definitions (indexing the folder the first time)."""
+        if self._is_indexed(vm_back_dir):
+            self._sync_definitions(vm_back_dir)
+        else:
+            self.index_vm_dir(vm_back_dir)
+
+    def index_vm_dir(self, vm_back_dir):
+        """Index the delta backups of a VM folder written before the catalog existed (once per folder)."""
+        if self._is_indexed(vm_back_dir):
+            return
+        vm_dir = os.path.join(self.base_folder, vm_back_dir)
+        logger.info("Indexing backups of %s", vm_dir)
+        for dir_path, _, file_names in os.walk(vm_dir):
+            if dir_path == vm_dir:
+                for vm_def_file in sorted(name for name in file_names if name.endswith(".json")):
+                    self._read_definition(os.path.join(vm_back_dir, vm_def_file))
+            else:
+                # Files not used by any definition are deleted by the next retention
+                with self._transaction():
+                    for name in file_names:
+                        if not name.endswith((".tmp", checksum.sidecar_extension)):
+                            self._add_file(os.path.relpath(os.path.join(dir_path, name), self.base_folder), False)
+        self._set_indexed(vm_back_dir)
+
+    def sync_full_backups(self, vm_uuid=None):
+        """Reconcile the full backups (of a VM) with the XVA files of the folder, recording the ones written before
+        the catalog existed or behind its back and forgetting the vanished ones."""
+        prefix = vm_uuid + "__" if vm_uuid is not None else ""
+        present = {name for name in os.listdir(self.base_folder)
+                   if name.startswith(prefix) and name.endswith(xva_extensions)}
+        query, params = "SELECT path FROM restore_points WHERE type = 'full'", ()
+        if vm_uuid is not None:
+            query, params = query + " AND vm_uuid = ?", (vm_uuid,)
+        known = {path for path, in self._db.execute(query, params)}
+        for path in sorted(present - known - set(self.get_deletions())):
+            try:
+                self.add_full_backup(os.path.join(self.base_folder, path))
+            except ValueError:
+                logger.warning("Unexpected full backup file name %s", path)
+            except FileNotFoundError:
+                pass
+        for path in known - present:
+            self.remove_restore_point(path)
+            self.remove_files([path])
+
+    def sync(self):
+        """Apply the changes made to the folder since the last sync (or since the catalog was created)."""
+        mtime = os.stat(self.base_folder).st_mtime_ns
+        if self._get_mtime("") != mtime:
+            self.sync_full_backups()
+            for name in os.listdir(self.base_folder):
+                if name.startswith("vm_") and os.path.isdir(os.path.join(self.base_folder, name)):
+                    self._db.execute("INSERT OR IGNORE INTO folders VALUES (?, -1)", (name,))
+            self._set_mtime("", mtime)
+
+        for vm_back_dir, in self._db.execute("SELECT name FROM folders WHERE name != ''").fetchall():
+            try:
+                mtime = os.stat(os.path.join(self.base_folder, vm_back_dir)).st_mtime_ns
+            except FileNotFoundError:
+                self._remove_vm_dir(vm_back_dir)
+                continue
+            if self._get_mtime(vm_back_dir) != mtime:
+                self.sync_vm_dir(vm_back_dir)
+                self._set_mtime(vm_back_dir, mtime)
+
+    @contextmanager
+    def _transaction(self):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def _get_path(self, file_name):
+        return os.path.relpath(file_name, self.base_folder)
+
+    def _add_vdi_files(self, vdi_record, replace):
+        base = vdi_record.get("backup_base_file")
+        if base is not None:
+            # Re-exported if missing: the checksum is the one of the new file
+            self._add_file(base, replace and "backup_base_checksum" in vdi_record,
+                           vdi_record.get("backup_base_checksum"))
+        self._add_file(vdi_record["backup_file"], replace, vdi_record.get("checksum"), base,
+                       vdi_record.get("stored_size"))
+
+    def _add_file(self, path, replace, file_checksum=None, base=None, size=None):
+        if size is None:
+            try:
+                size = os.path.getsize(os.path.join(self.base_folder, path))
+            except FileNotFoundError:
+                size = 0
+        self._db.execute("INSERT OR {} INTO files VALUES (?, ?, ?, ?, ?, ?)".format("REPLACE" if replace else "IGNORE"),
+                         (path, get_vm_uuid(path), "delta" if base is not None or "_delta." in path else "full", base,
+                          size, file_checksum and file_checksum["digest"]))
+
+    def _add_restore_point(self, path, vm_uuid, vm_name, timestamp, backup_type, files):
+        self._db.execute("DELETE FROM uses WHERE restore_point = ?", (path,))
+        self._db.executemany("INSERT OR IGNORE INTO uses VALUES (?, ?)", ((path, file) for file in files))
+        size, = self._db.execute("SELECT TOTAL(files.size) FROM uses JOIN files ON files.path = uses.file "
+                                 "WHERE uses.restore_point = ?", (path,)).fetchone()
+        self._db.execute("INSERT OR REPLACE INTO restore_points VALUES (?, ?, ?, ?, ?, ?)",
+                         (path, vm_uuid, vm_name, timestamp, backup_type, int(size)))
+
+    def _sync_definitions(self, vm_back_dir):
+        present = {os.path.join(vm_back_dir, name) for name in os.listdir(os.path.join(self.base_folder, vm_back_dir))
+                   if name.endswith(".json")}
+        known = {path for path, in self._db.execute(
+            "SELECT path FROM restore_points WHERE type = 'delta' AND vm_uuid = ?", (get_vm_uuid(vm_back_dir),))}
+        for path in sorted(present - known):
+            self._read_definition(path)
+        for path in known - present:
+            self.remove_restore_point(path)
+        with self._transaction():
+            for path, in self._db.execute("SELECT path FROM unreadable WHERE vm_uuid = ?",
+                                          (get_vm_uuid(vm_back_dir),)).fetchall():
+                if path not in present:
+                    self._db.execute("DELETE FROM unreadable WHERE path = ?", (path,))
+
+    def _read_definition(self, path):
+        try:
+            with open(os.path.join(self.base_folder, path)) as def_file:
+                self.add_definition(os.path.join(self.base_folder, path), json.load(def_file))
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, OSError) as e:
+            logger.warning("Unreadable VM definition %s, the files of the VM are kept: %s", path, e)
+            with self._transaction():
+                self._db.execute("INSERT OR REPLACE INTO unreadable VALUES (?, ?)", (path, get_vm_uuid(path)))
+
+    def _remove_vm_dir(self, vm_back_dir):
+        vm_uuid = get_vm_uuid(vm_back_dir)
+        with self._transaction():
+            self._db.execute("DELETE FROM uses WHERE restore_point IN "
+                             "(SELECT path FROM restore_points WHERE vm_uuid = ? AND type = 'delta')", (vm_uuid,))
+            self._db.execute("DELETE FROM restore_points WHERE vm_uuid = ? AND type = 'delta'", (vm_uuid,))
+            self._db.execute("DELETE FROM files WHERE vm_uuid = ? AND type != 'xva'", (vm_uuid,))
+            self._db.execute("DELETE FROM unreadable WHERE vm_uuid = ?", (vm_uuid,))
+            self._db.execute("DELETE FROM folders WHERE name = ?", (vm_back_dir,))
+            self._db.execute("DELETE FROM indexed WHERE name = ?", (vm_back_dir,))
+
+    def _get_mtime(self, name):
+        row = self._db.execute("SELECT mtime FROM folders WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_mtime(self, name, mtime):
+        self._db.execute("INSERT OR REPLACE INTO folders VALUES (?, ?)", (name, mtime))
+
+    def _is_indexed(self, name):
+        return self._db.execute("SELECT 1 FROM indexed WHERE name = ?", (name,)).fetchone() is not None
+
+    def _set_indexed(self, name):
+        self._db.execute("INSERT OR IGNORE INTO indexed VALUES (?)", (name,))
+
+
+def get_vm_uuid(path):
+    """UUID of the VM of a file in its vm_<uuid> folder, or of an XVA file."""
+    top = path.split(os.sep, 1)[0]
+    return top[3:] if top.startswith("vm_") else top.split("__", 1)[0]
+
+
+def parse_xva_name(path):
+    """VM UUID, timestamp and VM name of a full backup file."""
+    name = os.path.basename(path)
+    for extension in xva_extensions:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    vm_uuid, timestamp, vm_name = name.split("__", 2)
+    return vm_uuid, timestamp, vm_name
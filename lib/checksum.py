@@ -0,0 +1,166 @@
+"""Checksums of the backup files, computed while they are written.
+
+A file is hashed in blocks of block_size bytes: the checksum is the hash of the concatenated block digests, and the
+block digests themselves are kept if store_blocks is set. Blocks can be verified in parallel, and with the block
+digests a corruption can be located.
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Settings of the checksums, set from the checksum, checksum_algorithm and checksum_blocks settings
+enabled = True
+algorithm = "sha256"
+store_blocks = False
+block_size = 64 * 2 ** 20
+
+sidecar_extension = ".checksum"
+_read_size = 4 * 2 ** 20
+
+
+class HashingWriter(object):
+    """File-like object hashing what is written to file.
+
+    Data written again after a seek backwards (e.g. the BAT rewritten by ZeroBlockFilter) is hashed again by
+    get_checksum, which reads the affected blocks back from file.
+    """
+
+    def __init__(self, file, algorithm_name=None, hash_block_size=None):
+        self.file = file
+        self.algorithm = algorithm_name or algorithm
+        self.block_size = hash_block_size or block_size
+        self.size = 0
+
+        self._position = 0
+        self._digests = []
+        self._hash = hashlib.new(self.algorithm)
+        self._hashed = 0
+        self._dirty = set()
+
+    def write(self, data):
+        written = self.file.write(data)
+        written = len(data) if written is None else written
+        if self._position == self.size:
+            self._update(memoryview(data)[:written])
+            self.size += written
+        elif self._position + written <= self.size:
+            self._dirty.update(range(self._position // self.block_size,
+                                     (self._position + written - 1) // self.block_size + 1))
+        else:
+            raise ValueError("Writes past the end of the hashed data not supported")
+        self._position += written
+        return written
+
+    def seek(self, offset, whence=0):
+        self._position = self.file.seek(offset, whence)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def truncate(self, size=None):
+        size = self.file.truncate(size)
+        if size < self.size:
+            raise ValueError("Truncation of hashed data not supported")
+        return size
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def get_checksum(self):
+        digests = list(self._digests)
+        if self._hashed or not digests:
+            digests.append(self._hash.digest())
+        for block in self._dirty:
+            digests[block] = hash_range(self.file.name, block * self.block_size, self.block_size, self.algorithm)
+        return make_checksum(digests, self.size, self.algorithm, self.block_size)
+
+    def _update(self, data):
+        while data:
+            size = min(len(data), self.block_size - self._hashed)
+            self._hash.update(data[:size])
+            self._hashed += size
+            data = data[size:]
+            if self._hashed == self.block_size:
+                self._digests.append(self._hash.digest())
+                self._hash = hashlib.new(self.algorithm)
+                self._hashed = 0
+
+
+def make_checksum(digests, size, algorithm_name, hash_block_size):
+    checksum = {
+        "algorithm": algorithm_name,
+        "digest": hashlib.new(algorithm_name, b"".join(digests)).hexdigest(),
+        "size": size,
+        "block_size": hash_block_size
+    }
+    if store_blocks:
+        checksum["blocks"] = [digest.hex() for digest in digests]
+    return checksum
+
+
+def hash_range(file_name, start, size, algorithm_name):
+    file_hash = hashlib.new(algorithm_name)
+    buffer = memoryview(bytearray(_read_size))
+    with open(file_name, "rb", 0) as file:
+        file.seek(start)
+        while size > 0:
+            read = file.readinto(buffer[:min(size, _read_size)])
+            if not read:
+                break
+            file_hash.update(buffer[:read])
+            size -= read
+    return file_hash.digest()
+
+
+def submit_verification(executor, file_name, checksum):
+    """Start hashing the blocks of file_name on executor, returns a function listing the problems found."""
+    size = os.path.getsize(file_name)
+    if size != checksum["size"]:
+        return lambda: ["size {} instead of {}".format(size, checksum["size"])]
+
+    hash_block_size = checksum["block_size"]
+    futures = [executor.submit(hash_range, file_name, start, hash_block_size, checksum["algorithm"])
+               for start in range(0, max(size, 1), hash_block_size)]
+
+    def get_problems():
+        digests = [future.result() for future in futures]
+        if hashlib.new(checksum["algorithm"], b"".join(digests)).hexdigest() == checksum["digest"]:
+            return []
+        if "blocks" in checksum:
+            return ["block {} (offset {}) corrupted".format(block, block * hash_block_size)
+                    for block, (digest, expected) in enumerate(zip(digests, checksum["blocks"]))
+                    if digest.hex() != expected]
+        return ["checksum mismatch"]
+
+    return get_problems
+
+
+def verify_file(file_name, checksum, workers=None):
+    """Problems found checking file_name against checksum (empty if valid)."""
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        return submit_verification(executor, file_name, checksum)()
+
+
+def verify_chunk(chunk_file_name):
+    """Whether the content of a chunk store file matches its name."""
+    return hash_range(chunk_file_name, 0, os.path.getsize(chunk_file_name), "sha256").hex() == \
+        os.path.basename(chunk_file_name)
+
+
+def get_sidecar_file(file_name):
+    return file_name + sidecar_extension
+
+
+def write_sidecar(file_name, checksum):
+    with open(get_sidecar_file(file_name), "w") as sidecar_file:
+        json.dump(checksum, sidecar_file)
+
+
+def read_sidecar(file_name):
+    try:
+        with open(get_sidecar_file(file_name)) as sidecar_file:
+            return json.load(sidecar_file)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,252 @@
+"""Deduplicating store of backup data.
+
+Exports are split in content-defined chunks, stored once per content under <base folder>/chunks and indexed by
+SHA-256 in a SQLite database with their reference count. An export is saved as a JSON manifest listing its chunks
+(.vhd.chunks), which is read back as a stream on restore. Deleting a manifest releases its chunks, and the chunks
+not referenced anymore are deleted.
+
+Chunk boundaries follow the end of 4 byte anchors matching a fixed pattern (about one every 64 KiB of random data)
+found with a regular expression, so they move with the content and inserted or shifted data only changes the
+chunks around it. Boundaries are not looked for before min_size and a chunk is cut at max_size if no anchor is
+found (e.g. zero filled areas).
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger("Chunk store")
+
+# Export VDIs to the chunk store, set from the dedup setting
+enabled = False
+store_dir = "chunks"
+manifest_extension = "chunks"
+
+min_size = 16 * 2 ** 10
+max_size = 256 * 2 ** 10
+
+
+def _anchor_pattern(seed=0x5eed):
+    # 4 classes of 16 byte values (not 0x00 nor 0xff, common fillers): 1 in 65536 positions matches random data
+    rand = random.Random(seed)
+    return re.compile(b"".join(
+        b"[" + b"".join(b"\\x%02x" % value for value in sorted(rand.sample(range(1, 255), 16))) + b"]"
+        for _ in range(4)))
+
+
+_anchor = _anchor_pattern()
+
+
+def find_boundary(data, start=0, final=False):
+    """End of the chunk starting at start, None if more data is needed to find it."""
+    end = min(start + max_size, len(data))
+    match = _anchor.search(data, start + min_size - 4, end)
+    if match is not None:
+        return match.end()
+    if end - start >= max_size or (final and end > start):
+        return end
+    return None
+
+
+def is_manifest(file_name):
+    return file_name.endswith("." + manifest_extension)
+
+
+class ChunkStore(object):
+    """Chunk files and their index. One instance per thread (SQLite connections can't be shared)."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, 0o755, True)
+
+        self._db = sqlite3.connect(os.path.join(root, "index.db"), timeout=300, isolation_level=None)
+        # Rollback journal, like the catalog (lib.catalog): the backup folder can be on NFS
+        self._db.execute("PRAGMA journal_mode=DELETE")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks "
+            "(digest BLOB PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL) WITHOUT ROWID")
+
+    @classmethod
+    def from_manifest(cls, manifest_file, manifest):
+        return cls(os.path.normpath(os.path.join(os.path.dirname(manifest_file), manifest["store"])))
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_chunk_file(self, digest):
+        name = digest.hex()
+        return os.path.join(self.root, name[:2], name)
+
+    def add(self, chunks):
+        """Reference the (digest, data) chunks, writing the new ones. Returns the number of bytes written."""
+        written = 0
+        with self._transaction():
+            for digest, data in chunks:
+                if self._db.execute("UPDATE chunks SET refs = refs + 1 WHERE digest = ?", (digest,)).rowcount:
+                    continue
+                self._write_chunk(digest, data)
+                self._db.execute("INSERT INTO chunks VALUES (?, ?, 1)", (digest, len(data)))
+                written += len(data)
+        return written
+
+    def release(self, digests):
+        """Drop a reference to each chunk, deleting the chunks not referenced anymore.
+
+        The chunk files are deleted after the transaction, not to hold up the exports adding chunks: they are moved
+        aside, then put back if the chunk was added again in the meantime (and written before being moved).
+        """
+        with self._transaction():
+            self._db.executemany("UPDATE chunks SET refs = refs - 1 WHERE digest = ?", ((d,) for d in digests))
+            unused = [digest for digest, in self._db.execute("SELECT digest FROM chunks WHERE refs <= 0")]
+            self._db.execute("DELETE FROM chunks WHERE refs <= 0")
+
+        deleted = {}
+        for digest in unused:
+            chunk_file_name = self.get_chunk_file(digest)
+            deleted_file_name = "{}.{}-{}.deleted".format(chunk_file_name, os.getpid(), threading.get_ident())
+            try:
+                os.rename(chunk_file_name, deleted_file_name)
+            except FileNotFoundError:
+                continue
+            deleted[digest] = deleted_file_name
+        if deleted:
+            with self._transaction():
+                for digest, deleted_file_name in deleted.items():
+                    if self._db.execute("SELECT 1 FROM chunks WHERE digest = ?", (digest,)).fetchone() is not None \
+                            and not os.path.exists(self.get_chunk_file(digest)):
+                        os.replace(deleted_file_name, self.get_chunk_file(digest))
+        for deleted_file_name in deleted.values():
+            try:
+                os.remove(deleted_file_name)
+            except FileNotFoundError:
+                pass
+        return len(unused)
+
+    def read(self, digest):
+        with open(self.get_chunk_file(digest), "rb") as chunk_file:
+            return chunk_file.read()
+
+    def get_stats(self):
+        chunks, size, refs = self._db.execute("SELECT COUNT(*), TOTAL(size), TOTAL(refs) FROM chunks").fetchone()
+        return {"chunks": chunks, "size": int(size), "references": int(refs)}
+
+    @contextmanager
+    def _transaction(self):
+        # Chunk files are written while holding the database write lock, so that a chunk is never referenced without
+        # its file (see release for the deletions)
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def _write_chunk(self, digest, data):
+        chunk_file_name = self.get_chunk_file(digest)
+        os.makedirs(os.path.dirname(chunk_file_name), 0o755, True)
+        with open(chunk_file_name + ".tmp", "wb") as chunk_file:
+            chunk_file.write(data)
+        os.replace(chunk_file_name + ".tmp", chunk_file_name)
+
+
+class ChunkWriter(object):
+    """File-like object splitting what is written in chunks added to store. close returns the manifest."""
+
+    def __init__(self, store):
+        self.store = store
+        self.raw_size = 0
+        self.stored_size = 0
+        self.chunks = []
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        self._cut(False)
+        return len(data)
+
+    def close(self):
+        self._cut(True)
+        return {"size": self.raw_size, "chunks": [[digest.hex(), size] for digest, size in self.chunks]}
+
+    def discard(self):
+        """Release the chunks added so far (failed export)."""
+        self.store.release(digest for digest, _ in self.chunks)
+        self.chunks = []
+
+    def _cut(self, final):
+        chunks = []
+        start = 0
+        end = find_boundary(self._buffer, start, final)
+        while end is not None:
+            data = bytes(self._buffer[start:end])
+            chunks.append((hashlib.sha256(data).digest(), data))
+            start = end
+            end = find_boundary(self._buffer, start, final)
+        del self._buffer[:start]
+
+        if chunks:
+            self.stored_size += self.store.add(chunks)
+            self.chunks.extend((digest, len(data)) for digest, data in chunks)
+            self.raw_size += sum(len(data) for _, data in chunks)
+
+
+class ManifestReader(object):
+    """Readable (readinto) stream of the chunks listed by a manifest."""
+
+    def __init__(self, store, manifest):
+        self.store = store
+        self._chunks = iter(manifest["chunks"])
+        self._data = memoryview(b"")
+
+    def readinto(self, buffer):
+        while not self._data:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            digest, size = chunk
+            data = self.store.read(bytes.fromhex(digest))
+            if len(data) != size:
+                raise IOError("Chunk {} corrupted".format(digest))
+            self._data = memoryview(data)
+        size = min(len(buffer), len(self._data))
+        buffer[:size] = self._data[:size]
+        self._data = self._data[size:]
+        return size
+
+
+def write_manifest(manifest_file, store, manifest):
+    """Write the manifest of chunks added to store, releasing the chunks of the manifest it replaces."""
+    replaced = read_manifest(manifest_file) if os.path.exists(manifest_file) else None
+    manifest = dict(manifest, store=os.path.relpath(store.root, os.path.dirname(manifest_file)))
+    with open(manifest_file + ".tmp", "w") as out_file:
+        json.dump(manifest, out_file)
+    os.replace(manifest_file + ".tmp", manifest_file)
+    if replaced is not None:
+        store.release(bytes.fromhex(digest) for digest, _ in replaced["chunks"])
+
+
+def read_manifest(manifest_file):
+    with open(manifest_file) as in_file:
+        return json.load(in_file)
+
+
+def remove_manifest(manifest_file):
+    """Delete a manifest and release its chunks."""
+    manifest = read_manifest(manifest_file)
+    # Removed first: a failure in between leaks chunks instead of releasing them twice
+    os.remove(manifest_file)
+    with ChunkStore.from_manifest(manifest_file, manifest) as store:
+        deleted = store.release(bytes.fromhex(digest) for digest, _ in manifest["chunks"])
+    logger.debug("Manifest %s deleted, %d chunks freed", manifest_file, deleted)
@@ -0,0 +1,402 @@
+"""Block compressed container for backup files.
+
+Layout: magic, codec name, frames of (raw size, compressed size, data) and an end frame followed by the total raw
+size. Frames are compressed and decompressed in parallel by worker threads, and the container can be read and
+written as a stream. zstd and lz4 need the zstandard and lz4 packages, zlib is always available.
+
+XVA exports are not stored in the container but as standard gzip or zstd files (see GzipWriter and ZstdWriter),
+which XenServer and the command line tools can read.
+"""
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+logger = logging.getLogger("Compression")
+
+magic = b"XBCF\x01"
+_frame = struct.Struct(">II")
+_trailer = struct.Struct(">Q")
+_zstd_size_frame = struct.Struct("<II4sQ")
+_zstd_skippable_magic = 0x184D2A5B
+_zstd_size_tag = b"XBSZ"
+
+# Settings of the backup files compression (no codec: not compressed)
+default_codec = None
+default_level = None
+default_workers = 4
+frame_size = 4 * 2 ** 20
+# Compression of the XVA exports: "host" (compressed by the XenServer host), "gzip" or "zstd" (compressed locally in
+# parallel blocks) or "none"
+xva_compression = "host"
+xva_level = None
+
+
+class Codec(ABC):
+    name = None
+    default_level = None
+
+    def __init__(self, level=None):
+        self.level = level if level is not None else self.default_level
+
+    @abstractmethod
+    def compress(self, data):
+        pass
+
+    @abstractmethod
+    def decompress(self, data, raw_size):
+        pass
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+    default_level = 1
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data, raw_size):
+        return zlib.decompress(data, bufsize=raw_size)
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    default_level = 3
+
+    def __init__(self, level=None):
+        super().__init__(level)
+        # Compression contexts can't be shared between threads
+        self._local = threading.local()
+
+    def compress(self, data):
+        if not hasattr(self._local, "compressor"):
+            self._local.compressor = zstandard.ZstdCompressor(level=self.level)
+        return self._local.compressor.compress(data)
+
+    def decompress(self, data, raw_size):
+        if not hasattr(self._local, "decompressor"):
+            self._local.decompressor = zstandard.ZstdDecompressor()
+        return self._local.decompressor.decompress(data, max_output_size=raw_size)
+
+
+class Lz4Codec(Codec):
+    name = "lz4"
+    default_level = 0
+
+    def compress(self, data):
+        return lz4.block.compress(data, compression=self.level, store_size=False)
+
+    def decompress(self, data, raw_size):
+        return lz4.block.decompress(data, uncompressed_size=raw_size)
+
+
+codecs = {"zlib": ZlibCodec}
+if zstandard is not None:
+    codecs["zstd"] = ZstdCodec
+if lz4 is not None:
+    codecs["lz4"] = Lz4Codec
+
+
+def get_codec(name=None, level=None):
+    """Codec by name, falling back to zlib when the module of the codec is not installed."""
+    name = name or default_codec
+    if name not in codecs:
+        logger.warning("Compression codec %s not available, using zlib", name)
+        name = "zlib"
+    return codecs[name](level if level is not None else default_level)
+
+
+def get_xva_writer_class(method=None):
+    """Writer class of the XVA exports compressed locally, None if not compressed locally."""
+    method = method or xva_compression
+    if method == "zstd" and zstandard is None:
+        logger.warning("zstd compression not available, using gzip")
+        method = "gzip"
+    return {"gzip": GzipWriter, "zstd": ZstdWriter}.get(method)
+
+
+def is_compressed(file_name):
+    with open(file_name, "rb") as file:
+        return file.read(len(magic)) == magic
+
+
+class ParallelWriter(ABC):
+    """File-like object compressing what is written to file in blocks, compressed in parallel by worker threads.
+
+    Subclasses define how a block is compressed and what is written before and after the blocks.
+    """
+    # Appended to the name of the output file
+    extension = ""
+
+    def __init__(self, file, workers=None):
+        self.file = file
+        self.raw_size = 0
+        self.compressed_size = 0
+
+        workers = workers or default_workers
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="compress")
+        self._pending = deque()
+        self._max_pending = workers * 2
+        self._buffer = bytearray()
+
+        self._write(self._header())
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= frame_size:
+            self._submit(bytes(self._buffer[:frame_size]))
+            del self._buffer[:frame_size]
+        return len(data)
+
+    def close(self):
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._write_frame()
+            self._write(self._footer())
+        finally:
+            self._executor.shutdown()
+
+    def get_ratio(self):
+        return round(self.compressed_size / self.raw_size, 4) if self.raw_size else 1.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(cancel_futures=True)
+
+    def _header(self):
+        return b""
+
+    def _footer(self):
+        return b""
+
+    def _context(self, data):
+        """Computed in order for every block and passed to _compress (e.g. data depending on the previous block)."""
+        return None
+
+    @abstractmethod
+    def _compress(self, data, context):
+        pass
+
+    def _submit(self, data):
+        if len(self._pending) >= self._max_pending:
+            self._write_frame()
+        self._pending.append((len(data), self._executor.submit(self._compress, data, self._context(data))))
+
+    def _write_frame(self):
+        raw_size, future = self._pending.popleft()
+        self._write_block(raw_size, future.result())
+        self.raw_size += raw_size
+
+    def _write_block(self, raw_size, data):
+        self._write(data)
+
+    def _write(self, data):
+        self.compressed_size += len(data)
+        view = memoryview(data)
+        while view:
+            view = view[self.file.write(view) or len(view):]
+
+
+class CompressedWriter(ParallelWriter):
+    """Writes the compressed container of the backup files."""
+
+    def __init__(self, file, codec=None, workers=None):
+        self.codec = codec if isinstance(codec, Codec) else get_codec(codec)
+        super().__init__(file, workers)
+
+    def _header(self):
+        name = self.codec.name.encode()
+        return magic + bytes([len(name)]) + name
+
+    def _footer(self):
+        return _frame.pack(0, 0) + _trailer.pack(self.raw_size)
+
+    def _compress(self, data, context):
+        return self.codec.compress(data)
+
+    def _write_block(self, raw_size, data):
+        self._write(_frame.pack(raw_size, len(data)))
+        self._write(data)
+
+
+class GzipWriter(ParallelWriter):
+    """Writes a single member gzip file, readable by gunzip, whose blocks are deflated in parallel.
+
+    Like pigz, every block is deflated independently, primed with the last 32 KiB of the previous block, and ends
+    on a byte boundary (sync flush) so that the blocks can be concatenated.
+    """
+    _window = 32 * 2 ** 10
+
+    def __init__(self, file, level=None, workers=None):
+        self.level = level if level is not None else 6
+        self._crc = 0
+        self._previous = b""
+        super().__init__(file, workers)
+
+    def _header(self):
+        return b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) + b"\x00\xff"
+
+    def _footer(self):
+        # Empty final block, CRC and size of the data
+        return b"\x03\x00" + struct.pack("<II", self._crc, self.raw_size & 0xffffffff)
+
+    def _context(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        dictionary = self._previous
+        self._previous = data[-self._window:]
+        return dictionary
+
+    def _compress(self, data, dictionary):
+        if dictionary:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ZstdWriter(ParallelWriter):
+    """Writes a zstd file made of independent frames compressed in parallel.
+
+    The raw size is appended in a skippable frame (ignored by zstd) so that restores can send a Content-Length.
+    """
+    extension = ".zst"
+
+    def __init__(self, file, level=None, workers=None):
+        if zstandard is None:
+            raise ValueError("zstd compression not available")
+        self.codec = ZstdCodec(level)
+        super().__init__(file, workers)
+
+    def _footer(self):
+        return _zstd_size_frame.pack(_zstd_skippable_magic, _zstd_size_frame.size - 8, _zstd_size_tag, self.raw_size)
+
+    def _compress(self, data, context):
+        return self.codec.compress(data)
+
+
+class DecompressingReader(object):
+    """Readable (readinto) view of the content of a compressed container."""
+
+    def __init__(self, file, workers=None):
+        self.file = file
+        header = self._read(len(magic) + 1)
+        if header[:len(magic)] != magic:
+            raise ValueError("Not a compressed backup file")
+        codec_name = self._read(header[-1]).decode()
+        if codec_name not in codecs:
+            raise ValueError("Compression codec {} not available".format(codec_name))
+        self.codec = codecs[codec_name]()
+
+        workers = workers or default_workers
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="decompress")
+        self._pending = deque()
+        self._max_pending = workers * 2
+        self._ended = False
+        self._data = memoryview(b"")
+
+    @staticmethod
+    def get_raw_size(file_name):
+        with open(file_name, "rb") as file:
+            file.seek(-_trailer.size, 2)
+            return _trailer.unpack(file.read(_trailer.size))[0]
+
+    def readinto(self, buffer):
+        while not self._data:
+            self._fill()
+            if not self._pending:
+                return 0
+            self._data = memoryview(self._pending.popleft().result())
+        size = min(len(buffer), len(self._data))
+        buffer[:size] = self._data[:size]
+        self._data = self._data[size:]
+        return size
+
+    def read(self, size=-1):
+        if size < 0:
+            size = frame_size
+        buffer = bytearray(size)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _fill(self):
+        while not self._ended and len(self._pending) < self._max_pending:
+            raw_size, compressed_size = _frame.unpack(self._read(_frame.size))
+            if raw_size == 0:
+                self._ended = True
+                break
+            self._pending.append(
+                self._executor.submit(self.codec.decompress, self._read(compressed_size), raw_size))
+
+    def _read(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.file.read(size - len(data))
+            if not chunk:
+                raise ValueError("Truncated compressed backup file")
+            data += chunk
+        return bytes(data)
+
+
+class ZstdReader(object):
+    """Readable (readinto) view of the content of a zstd file."""
+
+    def __init__(self, file):
+        if zstandard is None:
+            raise ValueError("zstd compression not available")
+        self._reader = zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True, closefd=False)
+
+    @staticmethod
+    def get_raw_size(file_name):
+        """Raw size recorded by ZstdWriter, None if missing."""
+        with open(file_name, "rb") as file:
+            if os.fstat(file.fileno()).st_size < _zstd_size_frame.size:
+                return None
+            file.seek(-_zstd_size_frame.size, 2)
+            frame_magic, _, tag, raw_size = _zstd_size_frame.unpack(file.read(_zstd_size_frame.size))
+        return raw_size if frame_magic == _zstd_skippable_magic and tag == _zstd_size_tag else None
+
+    def readinto(self, buffer):
+        return self._reader.readinto(buffer)
+
+    def read(self, size=-1):
+        return self._reader.read(size)
+
+    def close(self):
+        self._reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,231 @@
+"""Backup files I/O that doesn't flood the page cache.
+
+io_mode "buffered" writes and reads through the page cache as usual. With "dontneed" the writeback of the written
+data is started every writeback_size bytes, the previous range is waited for and dropped from the cache
+(sync_file_range and posix_fadvise DONTNEED), so that dirty memory stays bounded. Read data is dropped behind the
+reader. "direct" writes with O_DIRECT through an aligned buffer, bypassing the cache (reads as with "dontneed").
+"""
+import ctypes
+import ctypes.util
+import errno
+import io
+import logging
+import mmap
+import os
+
+logger = logging.getLogger("File I/O")
+
+# Set from the io_mode and writeback_size settings
+io_mode = "buffered"
+writeback_size = 64 * 2 ** 20
+
+_alignment = 4096
+_direct_buffer_size = 4 * 2 ** 20
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _sync_file_range = _libc.sync_file_range
+    _sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+except (OSError, AttributeError, TypeError):
+    _sync_file_range = None
+
+
+def sync_file_range(fd, offset, size, flags):
+    """sync_file_range(2), fdatasync where not available."""
+    if _sync_file_range is None:
+        os.fdatasync(fd)
+    elif _sync_file_range(fd, offset, size, flags) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def drop_cache(fd, offset=0, size=0):
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, size, os.POSIX_FADV_DONTNEED)
+
+
+def open_output(file_name):
+    """Unbuffered binary file to write file_name, according to io_mode."""
+    if io_mode == "direct" and hasattr(os, "O_DIRECT"):
+        try:
+            return DirectFile(file_name)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise e
+            logger.warning("O_DIRECT not supported for %s", file_name)
+    if io_mode in ("direct", "dontneed"):
+        return WritebackFile(file_name, "wb")
+    return open(file_name, "wb", 0)
+
+
+def open_input(file_name):
+    """Unbuffered binary file to read file_name sequentially, according to io_mode."""
+    if io_mode in ("direct", "dontneed"):
+        return DropBehindFile(file_name, "rb")
+    return open(file_name, "rb", 0)
+
+
+class WritebackFile(io.FileIO):
+    """File whose written data is flushed and dropped from the page cache every writeback_size bytes."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Start of the range being written back and of the range being written
+        self._writeback_start = 0
+        self._dirty_start = 0
+
+    def write(self, data):
+        written = super().write(data)
+        end = self.tell()
+        if end - self._dirty_start >= writeback_size:
+            self._writeback(end)
+        return written
+
+    def close(self):
+        if not self.closed:
+            try:
+                os.fdatasync(self.fileno())
+                drop_cache(self.fileno())
+            finally:
+                super().close()
+
+    def _writeback(self, end):
+        fd = self.fileno()
+        # Start writing the new range, wait for the previous one to be written and drop it
+        sync_file_range(fd, self._dirty_start, end - self._dirty_start, SYNC_FILE_RANGE_WRITE)
+        if self._dirty_start > self._writeback_start:
+            size = self._dirty_start - self._writeback_start
+            sync_file_range(fd, self._writeback_start, size,
+                            SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+            drop_cache(fd, self._writeback_start, size)
+        self._writeback_start = self._dirty_start
+        self._dirty_start = end
+
+
+class DirectFile(io.FileIO):
+    """File written with O_DIRECT through a page aligned buffer.
+
+    Data written again before the end (after a seek backwards) goes through a second, buffered descriptor. The last
+    partial block is padded when written and the file truncated to its size by close.
+    """
+
+    def __init__(self, file_name):
+        super().__init__(file_name, "wb", opener=lambda path, flags: os.open(path, flags | os.O_DIRECT))
+        self._buffer = mmap.mmap(-1, _direct_buffer_size)
+        self._buffered = 0
+        # Size of the data written to the file, data written and position of the writer
+        self._flushed = 0
+        self._size = 0
+        self._position = 0
+        self._truncate_to = None
+        self._rewrite_fd = None
+
+    def write(self, data):
+        if self._position != self._size:
+            return self._rewrite(data)
+        view = memoryview(data).cast("B")
+        written = len(view)
+        while view:
+            size = min(len(view), _direct_buffer_size - self._buffered)
+            self._buffer[self._buffered:self._buffered + size] = view[:size]
+            self._buffered += size
+            view = view[size:]
+            if self._buffered == _direct_buffer_size:
+                self._flush_buffer(_direct_buffer_size)
+        self._size += written
+        self._position = self._size
+        return written
+
+    def seek(self, offset, whence=0):
+        self._position = {0: 0, 1: self._position, 2: self._size}[whence] + offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def truncate(self, size=None):
+        self._truncate_to = self._position if size is None else size
+        return self._truncate_to
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffered:
+                padded = -(-self._buffered // _alignment) * _alignment
+                self._buffer[self._buffered:padded] = bytes(padded - self._buffered)
+                self._flush_buffer(padded)
+            # Drops the padding and what was preallocated past the end
+            super().truncate(self._size if self._truncate_to is None else self._truncate_to)
+            if self._rewrite_fd is not None:
+                os.fdatasync(self._rewrite_fd)
+                drop_cache(self._rewrite_fd)
+            os.fdatasync(self.fileno())
+        finally:
+            if self._rewrite_fd is not None:
+                os.close(self._rewrite_fd)
+            self._buffer.close()
+            super().close()
+
+    def _flush_buffer(self, size):
+        view = memoryview(self._buffer)[:size]
+        try:
+            while view:
+                view = view[super().write(view):]
+        finally:
+            view.release()
+        self._flushed += self._buffered
+        self._buffered = 0
+
+    def _rewrite(self, data):
+        data = bytes(data)
+        if self._position + len(data) > self._size:
+            raise ValueError("Writes past the end of the file after a seek not supported")
+        # Part already in the file
+        on_disk = data[:max(self._flushed - self._position, 0)]
+        if on_disk:
+            if self._rewrite_fd is None:
+                self._rewrite_fd = os.open(self.name, os.O_WRONLY)
+            os.pwrite(self._rewrite_fd, on_disk, self._position)
+        # Part still in the buffer
+        buffered = data[len(on_disk):]
+        if buffered:
+            start = self._position + len(on_disk) - self._flushed
+            self._buffer[start:start + len(buffered)] = buffered
+        self._position += len(data)
+        return len(data)
+
+
+class DropBehindFile(io.FileIO):
+    """File read sequentially, dropping the read data from the page cache every writeback_size bytes."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        self._dropped = 0
+
+    def readinto(self, buffer):
+        read = super().readinto(buffer)
+        self._drop_behind()
+        return read
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self._drop_behind()
+        return data
+
+    def _drop_behind(self):
+        position = self.tell()
+        if position - self._dropped >= writeback_size:
+            drop_cache(self.fileno(), self._dropped, position - self._dropped)
+            self._dropped = position
+
+    def close(self):
+        if not self.closed:
+            drop_cache(self.fileno())
+        super().close()
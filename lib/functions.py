@@ -2,8 +2,10 @@ import json
 import logging
 import os
 import random
+import sqlite3
 from datetime import datetime, timezone
 
+from lib.catalog import Catalog
 from lib.datetime_encoder import DateTimeEncoder
 
 logger = logging.getLogger("Utils")
@@ -14,10 +16,23 @@ def get_saned_string(string):
     return string.replace(" ", "_").replace("/", "_")
 
 
+def get_master_url(master):
+    # Plain host names default to https, a full url (e.g. http://127.0.0.1:8080 for the simulator) is kept
+    return master if "://" in master else "https://" + master
+
+
 def vm_definition_to_file(vm_definition, base_folder, vm_back_dir, timestamp):
     backup_def_fn = os.path.join(base_folder, vm_back_dir, timestamp + ".json")
-    with open(backup_def_fn, "w") as backup_def_file:
+    with open(backup_def_fn + ".tmp", "w") as backup_def_file:
         json.dump(vm_definition, backup_def_file, indent=4, cls=DateTimeEncoder)
+    try:
+        with Catalog(base_folder) as backup_catalog:
+            backup_catalog.add_definition(backup_def_fn, vm_definition, backup_def_fn + ".tmp")
+    except sqlite3.Error:
+        # The backup is complete: the definition is kept, the next retention of the VM catalogues it
+        if os.path.exists(backup_def_fn + ".tmp"):
+            os.replace(backup_def_fn + ".tmp", backup_def_fn)
+        raise
     return backup_def_fn
 
 
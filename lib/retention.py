@@ -0,0 +1,154 @@
+"""Deletion of the backup files dropped by retention, in the background.
+
+Retention only moves the files from the catalog to its deletions table, a durable queue emptied by a Deleter while
+the next VMs are backed up: unlinking a large file can block for tens of seconds on some file systems (e.g. XFS), and
+the exports must not wait for it. Files left in the queue by an interrupted run are deleted by the next one.
+
+Files bigger than truncate_step bytes (when set) are shrunk by truncate_step bytes at a time before being unlinked,
+sleeping truncate_pause seconds in between, to spread the freeing of their extents.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib import checksum, chunkstore
+from lib.catalog import Catalog
+
+logger = logging.getLogger("Retention")
+
+workers = 2
+truncate_step = None
+truncate_pause = 0.0
+# Seconds between checks of the queue when not woken up
+poll_interval = 5
+
+
+class Deleter(object):
+    """Deletes the files queued in the catalog of base_folder with a pool of threads, until stopped.
+
+    stop waits for the queue to be empty (unless aborting). reclaimed is the disk space freed, in bytes (the chunks
+    released by the chunk store manifests are not accounted).
+    """
+
+    def __init__(self, base_folder, num_workers=None):
+        self.base_folder = base_folder
+        self.num_workers = num_workers or workers
+        self.deleted = 0
+        self.reclaimed = 0
+
+        self._wake = threading.Event()
+        self._stopping = False
+        self._abort = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, *exc_info):
+        self.stop(abort=exc_type is not None)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+        return self
+
+    def wake(self):
+        """Check the queue now, e.g. after a retention run."""
+        self._wake.set()
+
+    def stop(self, abort=False):
+        if abort:
+            self._abort.set()
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        return self.reclaimed
+
+    def _run(self):
+        start = time.perf_counter()
+        failed = set()
+        try:
+            with Catalog(self.base_folder) as backup_catalog, \
+                    ThreadPoolExecutor(self.num_workers, thread_name_prefix="delete") as executor:
+                while not self._abort.is_set():
+                    self._wake.clear()
+                    stopping = self._stopping
+                    queued = [path for path in backup_catalog.get_deletions() if path not in failed]
+                    for path, reclaimed in executor.map(self._delete, queued):
+                        if reclaimed is None:
+                            failed.add(path)
+                            continue
+                        backup_catalog.remove_deletion(path)
+                        self.deleted += 1
+                        self.reclaimed += reclaimed
+                    if not queued:
+                        if stopping:
+                            break
+                        self._wake.wait(poll_interval)
+        except sqlite3.Error as e:
+            # The queue is kept, the next run deletes the remaining files
+            logger.error("Deletion of the backup files of %s stopped. Catalog error: %s", self.base_folder, str(e))
+
+        if self.deleted:
+            logger.info("%d backup files deleted in %s in %.1fs, %.1f MiB reclaimed", self.deleted,
+                        self.base_folder, time.perf_counter() - start, self.reclaimed / 2 ** 20)
+
+    def _delete(self, path):
+        if self._abort.is_set():
+            return path, None
+        try:
+            return path, remove_file(os.path.join(self.base_folder, path), self._abort)
+        except OSError as e:
+            logger.error("Error deleting backup file %s %s", path, str(e))
+            return path, None
+
+
+def remove_file(file_name, abort=None, gradual=True):
+    """Delete a backup file and its checksum sidecar, returns the bytes freed (0 if already gone).
+
+    The file is truncated a step at a time unless gradual is False (e.g. in a backup thread, which must not wait for
+    the pauses). Returns None, leaving the file, if the abort event is set while it is being truncated.
+    """
+    reclaimed = 0
+    try:
+        reclaimed += os.stat(file_name).st_blocks * 512
+        if chunkstore.is_manifest(file_name):
+            chunkstore.remove_manifest(file_name)
+        else:
+            if gradual and not truncate(file_name, abort):
+                return None
+            os.remove(file_name)
+    except FileNotFoundError:
+        pass
+    else:
+        logger.debug("Backup file %s deleted", file_name)
+
+    try:
+        sidecar_file = checksum.get_sidecar_file(file_name)
+        reclaimed += os.stat(sidecar_file).st_blocks * 512
+        os.remove(sidecar_file)
+    except FileNotFoundError:
+        pass
+    return reclaimed
+
+
+def truncate(file_name, abort=None):
+    """Shrink a file by truncate_step bytes at a time, returns False if stopped by the abort event."""
+    if not truncate_step:
+        return True
+    with open(file_name, "r+b") as backup_file:
+        size = os.fstat(backup_file.fileno()).st_size
+        while size > truncate_step:
+            if abort is not None and abort.is_set():
+                return False
+            size -= truncate_step
+            os.ftruncate(backup_file.fileno(), size)
+            if truncate_pause:
+                if abort is not None:
+                    abort.wait(truncate_pause)
+                else:
+                    time.sleep(truncate_pause)
+    return True
@@ -0,0 +1,75 @@
+import bisect
+import json
+import threading
+
+# Latency histogram bucket upper bounds (seconds), from 1 ms to ~9 minutes in sqrt(2) steps
+latency_buckets = tuple(0.001 * 2 ** (i / 2) for i in range(39))
+
+
+class MethodStats(object):
+    __slots__ = ("calls", "total_time", "max_time", "retries", "sent_bytes", "received_bytes", "histogram")
+
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.retries = 0
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        self.histogram = [0] * (len(latency_buckets) + 1)
+
+    def percentile(self, q):
+        threshold = q * self.calls
+        count = 0
+        for bucket, bucket_count in enumerate(self.histogram):
+            count += bucket_count
+            if count >= threshold and count > 0:
+                # Beyond the last bucket the slowest call is the only bound known
+                return latency_buckets[bucket] if bucket < len(latency_buckets) else self.max_time
+        return 0.0
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "total_time": round(self.total_time, 6),
+            "p50": round(self.percentile(0.50), 6),
+            "p95": round(self.percentile(0.95), 6),
+            "p99": round(self.percentile(0.99), 6),
+            "session_retries": self.retries,
+            "sent_bytes": self.sent_bytes,
+            "received_bytes": self.received_bytes
+        }
+
+
+class RpcStats(object):
+    """Thread-safe per-method counters of XenAPI calls: count, latency histogram, retries and payload size."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def record(self, method, latency, retries=0, sent_bytes=0, received_bytes=0):
+        bucket = bisect.bisect_left(latency_buckets, latency)
+        with self._lock:
+            stats = self._methods.get(method)
+            if stats is None:
+                stats = self._methods[method] = MethodStats()
+            stats.calls += 1
+            stats.total_time += latency
+            stats.max_time = max(stats.max_time, latency)
+            stats.retries += retries
+            stats.sent_bytes += sent_bytes
+            stats.received_bytes += received_bytes
+            stats.histogram[bucket] += 1
+
+    def to_dict(self):
+        with self._lock:
+            methods = sorted(self._methods.items(), key=lambda item: item[1].total_time, reverse=True)
+            return {method: stats.to_dict() for method, stats in methods}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def total_calls(self):
+        with self._lock:
+            return sum(stats.calls for stats in self._methods.values())
@@ -0,0 +1,108 @@
+import threading
+
+
+class Scheduler(object):
+    """Runs jobs on up to `workers` threads, limiting the jobs using the same resource at the same time.
+
+    A job is a (resources, function) pair, resources being (type, id) tuples, e.g. ("SR", sr_ref). limits maps a
+    resource type to the number of jobs that can use one resource of that type at once (missing: unlimited).
+    Workers pick the first waiting job whose resources are all available, so a busy resource doesn't hold back
+    the jobs behind it. After the first job error no new job is started and the error is raised by run.
+
+    Functions are called with an abort event, set when run is interrupted (SystemExit in the calling thread, where
+    signals are delivered): the waiting jobs are dropped, the running ones are expected to stop at the next check of
+    the event, and run returns after them. With a single worker the jobs run in the calling thread, one after the
+    other, and are interrupted directly.
+    """
+
+    def __init__(self, workers=1, limits=None):
+        self.workers = max(workers, 1)
+        self.limits = {resource_type: limit for resource_type, limit in (limits or {}).items() if limit}
+
+        self._condition = threading.Condition()
+        self._jobs = []
+        self._in_use = {}
+        self._aborts = set()
+        self._error = None
+
+    def run(self, jobs):
+        if self.workers == 1:
+            for resources, function in jobs:
+                function(threading.Event())
+            return
+
+        with self._condition:
+            self._jobs = [(frozenset(resources), function) for resources, function in jobs]
+            self._error = None
+
+        threads = [threading.Thread(target=self._worker, name="scheduler-{}".format(w), daemon=True)
+                   for w in range(min(self.workers, len(self._jobs)))]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        except SystemExit as e:
+            self._abort(e)
+            self._wait_running()
+            raise e
+
+        if self._error is not None:
+            raise self._error
+
+    def _abort(self, error):
+        with self._condition:
+            self._error = self._error or error
+            self._jobs = []
+            for abort in self._aborts:
+                abort.set()
+            self._condition.notify_all()
+
+    def _wait_running(self):
+        """Wait for the running jobs to stop, even if interrupted again (idle workers don't start new jobs)."""
+        while True:
+            try:
+                with self._condition:
+                    while self._aborts:
+                        self._condition.wait()
+                return
+            except SystemExit:
+                pass
+
+    def _available(self, resources):
+        return all(self._in_use.get(resource, 0) < self.limits[resource[0]]
+                   for resource in resources if resource[0] in self.limits)
+
+    def _next_job(self):
+        with self._condition:
+            while True:
+                if self._error is not None or not self._jobs:
+                    return None
+                for j, (resources, function) in enumerate(self._jobs):
+                    if self._available(resources):
+                        del self._jobs[j]
+                        for resource in resources:
+                            self._in_use[resource] = self._in_use.get(resource, 0) + 1
+                        abort = threading.Event()
+                        self._aborts.add(abort)
+                        return resources, function, abort
+                self._condition.wait()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            resources, function, abort = job
+            try:
+                function(abort)
+            except BaseException as e:
+                with self._condition:
+                    if self._error is None:
+                        self._error = e
+            finally:
+                with self._condition:
+                    self._aborts.discard(abort)
+                    for resource in resources:
+                        self._in_use[resource] -= 1
+                    self._condition.notify_all()
@@ -0,0 +1,926 @@
+"""Local stand-in for a XenServer/XCP-ng pool master.
+
+Serves the subset of the XenAPI used by the handlers over XML-RPC plus the /export, /import, /export_raw_vdi and
+/import_raw_vdi data paths, with synthetic VHD/XVA streams, so that backups, restores and cleanups can run end to
+end (and be benchmarked) on a single box:
+
+    sim = XapiSimulator().start()
+    vm_ref = sim.add_vm("test vm", disks=[4 * 2 ** 20])
+    session = XenAPI.Session(sim.url)
+
+Latency, throughput limits and failures can be injected through the constructor options, fail() and
+fail_transfer(). Run as a module to serve a sample pool: python -m lib.simulator --port 8080 --vms 10
+"""
+import argparse
+import copy
+import hashlib
+import math
+import random
+import socket
+import struct
+import tarfile
+import threading
+import time
+import uuid as uuid_lib
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from xmlrpc.client import DateTime, Fault, dumps, loads
+
+NULL_REF = "OpaqueRef:NULL"
+SECTOR_SIZE = 512
+BLOCK_SIZE = 2 * 2 ** 20
+
+_vhd_footer = struct.Struct(">8sIIQI4sIIQQIII16sB427x")
+_vhd_header = struct.Struct(">8sQQIIII16sII512s192s256x")
+
+_defaults = {
+    "VM": {
+        "name_label": "", "name_description": "", "power_state": "Halted", "is_a_template": False,
+        "is_a_snapshot": False, "is_control_domain": False, "snapshot_of": NULL_REF, "snapshots": [],
+        "snapshot_time": DateTime("19700101T00:00:00Z"), "VBDs": [], "VIFs": [], "resident_on": NULL_REF,
+        "affinity": NULL_REF, "allowed_operations": ["export", "snapshot", "destroy"], "other_config": {},
+        "memory_static_max": "1073741824", "VCPUs_max": "1"
+    },
+    "VDI": {
+        "name_label": "", "name_description": "", "type": "user", "SR": NULL_REF, "VBDs": [], "virtual_size": "0",
+        "is_a_snapshot": False, "snapshot_of": NULL_REF, "snapshots": [], "snapshot_time": DateTime(
+            "19700101T00:00:00Z"), "allowed_operations": ["destroy", "snapshot"], "sharable": False,
+        "read_only": False, "other_config": {}, "sm_config": {}, "xenstore_data": {}
+    },
+    "VBD": {
+        "VM": NULL_REF, "VDI": NULL_REF, "device": "", "userdevice": "0", "bootable": False, "mode": "RW",
+        "type": "Disk", "empty": False, "other_config": {}, "qos_algorithm_type": "", "qos_algorithm_params": {}
+    },
+    "VIF": {
+        "VM": NULL_REF, "network": NULL_REF, "device": "0", "MAC": "", "MTU": "1500", "other_config": {},
+        "qos_algorithm_type": "", "qos_algorithm_params": {}
+    },
+    "SR": {"name_label": "", "name_description": "", "VDIs": [], "PBDs": [], "shared": False, "type": "ext"},
+    "PBD": {"host": NULL_REF, "SR": NULL_REF, "currently_attached": True},
+    "network": {"name_label": "", "name_description": "", "VIFs": [], "bridge": ""},
+    "host": {"name_label": "", "address": "127.0.0.1", "enabled": True, "API_version_major": "2", "API_version_minor": "7",
+             "PBDs": [], "resident_VMs": []},
+    "pool": {"name_label": "", "master": NULL_REF, "default_SR": NULL_REF},
+    "task": {"name_label": "", "name_description": "", "status": "pending", "progress": 0.0},
+}
+
+# Fields pointing to another object and the field of the other object listing the back references
+_links = {
+    "VBD": {"VM": ("VM", "VBDs"), "VDI": ("VDI", "VBDs")},
+    "VIF": {"VM": ("VM", "VIFs"), "network": ("network", "VIFs")},
+    "VDI": {"SR": ("SR", "VDIs"), "snapshot_of": ("VDI", "snapshots")},
+    "VM": {"snapshot_of": ("VM", "snapshots")},
+    "PBD": {"host": ("host", "PBDs"), "SR": ("SR", "PBDs")},
+}
+_back_references = {field for links in _links.values() for _, field in links.values()}
+
+# Fields set by the server only, ignored by create
+_snapshot_fields = ("is_a_snapshot", "snapshot_of", "snapshot_time")
+
+
+class SimulatorFailure(Exception):
+    def __init__(self, *description):
+        self.description = list(description)
+
+
+class XapiSimulator(object):
+    """In-memory pool answering XenAPI calls and data transfers.
+
+    Options:
+        rpc_latency: seconds added to every XML-RPC call
+        throughput: bytes/s limit of every data stream (None for unlimited)
+        xva_size: size of the synthetic disk data of XVA exports (default: allocated size of the VM disks)
+        zero_fraction: fraction of the allocated blocks of new disks that are all zeros
+        seed: seed of the synthetic data
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, rpc_latency=0.0, throughput=None, xva_size=None,
+                 zero_fraction=0.0, seed=0):
+        self.rpc_latency = rpc_latency
+        self.throughput = throughput
+        self.xva_size = xva_size
+        self.zero_fraction = zero_fraction
+
+        self.rpc_calls = Counter()
+        self.transfers = Counter()
+        # Transfers by the host name they were sent to
+        self.transfer_hosts = Counter()
+
+        self._lock = threading.RLock()
+        self._random = random.Random(seed)
+        self._objects = {cls: {} for cls in _defaults}
+        self._sessions = set()
+        self._events = []
+        self._event_id = 0
+        self._clock = time.mktime((2020, 1, 1, 0, 0, 0, 0, 0, 0))
+        self._failures = {}
+        self._transfer_failures = {}
+
+        # VDI data: ref -> {block index: digest}, digest -> block data
+        self._vdi_blocks = {}
+        self._block_data = {}
+        self._patterns = []
+        for pattern in range(8):
+            data = self._random.randbytes(BLOCK_SIZE // 2) + bytes(BLOCK_SIZE // 2)
+            self._patterns.append(self._store_block(data))
+        self._zero_block = self._store_block(bytes(BLOCK_SIZE))
+
+        self._server = ThreadingHTTPServer((host, port), _RequestHandler)
+        self._server.daemon_threads = True
+        self._server.simulator = self
+        self._thread = None
+
+        self.host_ref = self._create("host", {"name_label": "sim-host", "address": host})
+        self.default_sr = self._create("SR", {"name_label": "Local storage", "shared": True})
+        self._create("PBD", {"host": self.host_ref, "SR": self.default_sr})
+        self.default_network = self._create("network", {"name_label": "Pool-wide network", "bridge": "xenbr0"})
+        self.pool_ref = self._create("pool", {"name_label": "Simulated pool", "master": self.host_ref,
+                                              "default_SR": self.default_sr})
+        self._create("VM", {"name_label": "Control domain on host: sim-host", "is_control_domain": True,
+                            "power_state": "Running", "resident_on": self.host_ref})
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="xapi-simulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    """
+        Fixtures
+    """
+
+    def add_vm(self, name, disks=(BLOCK_SIZE,), power_state="Running", sr=None, network=None, fill=1.0):
+        """Create a VM with one VDI per disk size, fill is the fraction of allocated blocks."""
+        with self._lock:
+            vm_ref = self._create("VM", {"name_label": name, "power_state": power_state,
+                                         "resident_on": self.host_ref if power_state == "Running" else NULL_REF})
+            for device, disk_size in enumerate(disks):
+                vdi_ref = self.add_vdi("{} disk {}".format(name, device), disk_size, sr, fill)
+                self._create("VBD", {"VM": vm_ref, "VDI": vdi_ref, "device": "xvd" + chr(ord("a") + device),
+                                     "userdevice": str(device), "bootable": device == 0})
+            self._create("VBD", {"VM": vm_ref, "type": "CD", "empty": True, "device": "xvdd", "userdevice": "3"})
+            self._create("VIF", {"VM": vm_ref, "network": network or self.default_network, "device": "0",
+                                 "MAC": "02:00:00:00:00:01"})
+            return vm_ref
+
+    def add_vdi(self, name, size, sr=None, fill=1.0):
+        with self._lock:
+            vdi_ref = self._create("VDI", {"name_label": name, "virtual_size": str(size),
+                                           "SR": sr or self.default_sr})
+            n_blocks = int(math.ceil(size / BLOCK_SIZE))
+            blocks = {}
+            for block in range(n_blocks):
+                if self._random.random() < fill:
+                    blocks[block] = self._zero_block if self._random.random() < self.zero_fraction else \
+                        self._random.choice(self._patterns)
+            self._vdi_blocks[vdi_ref] = blocks
+            return vdi_ref
+
+    def add_sr(self, name, shared=False, host=None):
+        with self._lock:
+            sr_ref = self._create("SR", {"name_label": name, "shared": shared})
+            self._create("PBD", {"host": host or self.host_ref, "SR": sr_ref})
+            return sr_ref
+
+    def add_host(self, name, address):
+        return self._create("host", {"name_label": name, "address": address})
+
+    def write_vdi(self, vdi_ref, blocks):
+        """Overwrite the given blocks of a VDI with new synthetic data."""
+        with self._lock:
+            for block in blocks:
+                data = self._random.randbytes(BLOCK_SIZE // 4) + bytes(BLOCK_SIZE - BLOCK_SIZE // 4)
+                self._vdi_blocks[vdi_ref][block] = self._store_block(data)
+
+    def get_vdi_blocks(self, vdi_ref, zero_blocks=True):
+        """Block index -> digest of the data of a VDI, without the allocated all zero blocks if not zero_blocks."""
+        with self._lock:
+            return {block: digest for block, digest in self._vdi_blocks.get(vdi_ref, {}).items()
+                    if zero_blocks or digest != self._zero_block}
+
+    def get_records(self, cls):
+        with self._lock:
+            return copy.deepcopy(self._objects[cls])
+
+    def expire_sessions(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def fail(self, method, count=1, error=("INTERNAL_ERROR", "simulated failure")):
+        """Make the next count calls of method fail."""
+        with self._lock:
+            self._failures[method] = [count, list(error)]
+
+    def fail_transfer(self, path, count=1, status=500, after=None):
+        """Make the next count transfers of path (e.g. /export_raw_vdi) fail: with an HTTP status, or by dropping
+        the connection after the given amount of bytes."""
+        with self._lock:
+            self._transfer_failures[path] = [count, status, after]
+
+    """
+        Object store
+    """
+
+    def _new_ref(self):
+        return "OpaqueRef:" + str(uuid_lib.UUID(int=self._random.getrandbits(128)))
+
+    def _create(self, cls, fields, ref=None):
+        with self._lock:
+            ref = ref or self._new_ref()
+            record = copy.deepcopy(_defaults[cls])
+            record.update(copy.deepcopy({key: value for key, value in fields.items() if key in record}))
+            record["uuid"] = str(uuid_lib.UUID(int=self._random.getrandbits(128)))
+            for field in _back_references.intersection(record):
+                record[field] = []
+            self._objects[cls][ref] = record
+            for field, (link_cls, link_field) in _links.get(cls, {}).items():
+                if record[field] in self._objects[link_cls]:
+                    self._objects[link_cls][record[field]][link_field].append(ref)
+                    self._log_event(link_cls, "mod", record[field])
+            self._log_event(cls, "add", ref)
+            return ref
+
+    def _destroy(self, cls, ref):
+        with self._lock:
+            record = self._record(cls, ref)
+            for field, (link_cls, link_field) in _links.get(cls, {}).items():
+                link = self._objects[link_cls].get(record[field])
+                if link is not None and ref in link[link_field]:
+                    link[link_field].remove(ref)
+                    self._log_event(link_cls, "mod", record[field])
+            del self._objects[cls][ref]
+            self._vdi_blocks.pop(ref, None)
+            self._log_event(cls, "del", ref)
+
+    def _record(self, cls, ref):
+        if ref not in self._objects[cls]:
+            raise SimulatorFailure("HANDLE_INVALID", cls, ref)
+        return self._objects[cls][ref]
+
+    def _log_event(self, cls, operation, ref):
+        self._event_id += 1
+        snapshot = copy.deepcopy(self._objects[cls][ref]) if operation != "del" else {}
+        self._events.append({"id": str(self._event_id), "timestamp": str(self._event_id), "class": cls.lower(),
+                             "operation": operation, "ref": ref, "snapshot": snapshot})
+
+    def _store_block(self, data):
+        digest = hashlib.sha1(data).digest()
+        self._block_data.setdefault(digest, bytes(data))
+        return digest
+
+    def _tick(self):
+        self._clock += 3600
+        return DateTime(time.strftime("%Y%m%dT%H:%M:%SZ", time.gmtime(self._clock)))
+
+    """
+        XML-RPC
+    """
+
+    def dispatch(self, method, params):
+        self.rpc_calls[method] += 1
+        if self.rpc_latency:
+            time.sleep(self.rpc_latency)
+
+        with self._lock:
+            try:
+                if method in self._failures:
+                    failure = self._failures[method]
+                    failure[0] -= 1
+                    if failure[0] <= 0:
+                        del self._failures[method]
+                    raise SimulatorFailure(*failure[1])
+
+                if method.startswith("session.login") or method.startswith("session.slave_local_login"):
+                    session_ref = "OpaqueRef:" + str(uuid_lib.uuid4())
+                    self._sessions.add(session_ref)
+                    return {"Status": "Success", "Value": session_ref}
+                if not params or params[0] not in self._sessions:
+                    raise SimulatorFailure("SESSION_INVALID", params[0] if params else "")
+                if method in ("session.logout", "session.local_logout"):
+                    self._sessions.discard(params[0])
+                    return {"Status": "Success", "Value": ""}
+
+                cls, _, name = method.partition(".")
+                handler = getattr(self, "_rpc_{}_{}".format(cls, name), None)
+                if handler is None:
+                    handler = getattr(self, "_rpc_" + name, None)
+                    if handler is None and (name.startswith("get_") or name.startswith("set_")):
+                        handler = self._rpc_get_field if name.startswith("get_") else self._rpc_set_field
+                        params = (params[0], name[4:]) + tuple(params[1:])
+                    if handler is None or cls not in self._objects:
+                        raise SimulatorFailure("MESSAGE_METHOD_UNKNOWN", method)
+                    params = (params[0], cls) + tuple(params[1:])
+                value = handler(*params[1:])
+                return {"Status": "Success", "Value": value if value is not None else ""}
+            except SimulatorFailure as e:
+                return {"Status": "Failure", "ErrorDescription": e.description}
+
+    def _rpc_get_all(self, cls):
+        return list(self._objects[cls].keys())
+
+    def _rpc_get_all_records(self, cls):
+        return copy.deepcopy(self._objects[cls])
+
+    def _rpc_get_record(self, cls, ref):
+        return copy.deepcopy(self._record(cls, ref))
+
+    def _rpc_get_by_uuid(self, cls, uuid):
+        for ref, record in self._objects[cls].items():
+            if record["uuid"] == uuid:
+                return ref
+        raise SimulatorFailure("UUID_INVALID", cls, uuid)
+
+    def _rpc_get_by_name_label(self, cls, label):
+        return [ref for ref, record in self._objects[cls].items() if record.get("name_label") == label]
+
+    def _rpc_get_field(self, cls, field, ref):
+        record = self._record(cls, ref)
+        if field not in record:
+            raise SimulatorFailure("MESSAGE_METHOD_UNKNOWN", "{}.get_{}".format(cls, field))
+        return copy.deepcopy(record[field])
+
+    def _rpc_set_field(self, cls, field, ref, value):
+        record = self._record(cls, ref)
+        if field not in record:
+            raise SimulatorFailure("MESSAGE_METHOD_UNKNOWN", "{}.set_{}".format(cls, field))
+        record[field] = value
+        self._log_event(cls, "mod", ref)
+
+    def _rpc_create(self, cls, *params):
+        if cls == "task":
+            return self._create(cls, {"name_label": params[0], "name_description": params[1]})
+        fields = {field: value for field, value in params[0].items() if field not in _snapshot_fields}
+        for field, (link_cls, _) in _links.get(cls, {}).items():
+            if field in fields and fields[field] != NULL_REF:
+                self._record(link_cls, fields[field])
+        ref = self._create(cls, fields)
+        if cls == "VDI":
+            self._vdi_blocks[ref] = {}
+        return ref
+
+    def _rpc_destroy(self, cls, ref):
+        if cls == "VM":
+            record = self._record(cls, ref)
+            for vbd_ref in list(record["VBDs"]):
+                self._destroy("VBD", vbd_ref)
+            for vif_ref in list(record["VIFs"]):
+                self._destroy("VIF", vif_ref)
+        elif cls == "VDI":
+            for vbd_ref in list(self._record(cls, ref)["VBDs"]):
+                self._objects["VBD"][vbd_ref]["VDI"] = NULL_REF
+                self._log_event("VBD", "mod", vbd_ref)
+        self._destroy(cls, ref)
+
+    def _rpc_task_cancel(self, ref):
+        self._record("task", ref)["status"] = "cancelling"
+        self._log_event("task", "mod", ref)
+
+    def _rpc_pool_get_default_SR(self, ref):
+        return self._record("pool", ref)["default_SR"]
+
+    def _rpc_VM_snapshot(self, ref, name=None):
+        record = self._record("VM", ref)
+        snapshot_time = self._tick()
+        snap_ref = self._create("VM", dict(record, name_label=name or record["name_label"], is_a_snapshot=True,
+                                           snapshot_of=ref, snapshot_time=snapshot_time, power_state="Halted",
+                                           resident_on=NULL_REF))
+        for vbd_ref in record["VBDs"]:
+            vbd = self._objects["VBD"][vbd_ref]
+            vdi_ref = vbd["VDI"]
+            if vdi_ref != NULL_REF:
+                vdi = self._objects["VDI"][vdi_ref]
+                vdi_ref = self._create("VDI", dict(vdi, is_a_snapshot=True, snapshot_of=vdi_ref,
+                                                   snapshot_time=snapshot_time))
+                self._vdi_blocks[vdi_ref] = dict(self._vdi_blocks[vbd["VDI"]])
+            self._create("VBD", dict(vbd, VM=snap_ref, VDI=vdi_ref))
+        for vif_ref in record["VIFs"]:
+            self._create("VIF", dict(self._objects["VIF"][vif_ref], VM=snap_ref))
+        return snap_ref
+
+    def _set_power_state(self, ref, from_states, to_state):
+        record = self._record("VM", ref)
+        if record["power_state"] not in from_states:
+            raise SimulatorFailure("VM_BAD_POWER_STATE", ref, "/".join(from_states), record["power_state"])
+        record["power_state"] = to_state
+        record["resident_on"] = self.host_ref if to_state != "Halted" else NULL_REF
+        self._log_event("VM", "mod", ref)
+
+    def _rpc_VM_start(self, ref, paused=False, force=False):
+        self._set_power_state(ref, ("Halted",), "Paused" if paused else "Running")
+
+    def _rpc_VM_shutdown(self, ref):
+        self._set_power_state(ref, ("Running", "Paused", "Suspended"), "Halted")
+
+    def _rpc_VM_pause(self, ref):
+        self._set_power_state(ref, ("Running",), "Paused")
+
+    def _rpc_VM_unpause(self, ref):
+        self._set_power_state(ref, ("Paused",), "Running")
+
+    def _rpc_VM_suspend(self, ref):
+        self._set_power_state(ref, ("Running",), "Suspended")
+
+    def _rpc_VM_resume(self, ref, paused=False, force=False):
+        self._set_power_state(ref, ("Suspended",), "Running")
+
+    def _rpc_event_from(self, classes, token, timeout):
+        classes = set(cls.lower() for cls in classes)
+        if token == "":
+            events = [{"id": str(self._event_id), "timestamp": str(self._event_id), "class": cls.lower(),
+                       "operation": "add", "ref": ref, "snapshot": copy.deepcopy(record)}
+                      for cls, objects in self._objects.items() if cls.lower() in classes
+                      for ref, record in objects.items()]
+        else:
+            try:
+                token_id = int(token)
+            except ValueError:
+                raise SimulatorFailure("EVENT_FROM_TOKEN_INVALID", token)
+            events = [event for event in self._events[token_id:] if event["class"] in classes]
+        return {"events": events, "valid_ref_counts": {}, "token": str(self._event_id)}
+
+    """
+        Data paths
+    """
+
+    def check_transfer(self, path, query, host=None):
+        with self._lock:
+            self.transfers[path] += 1
+            self.transfer_hosts[host] += 1
+            if query.get("session_id") not in self._sessions:
+                return 401, None
+            failure = self._transfer_failures.get(path)
+            if failure is not None:
+                failure[0] -= 1
+                if failure[0] <= 0:
+                    del self._transfer_failures[path]
+                if failure[2] is None:
+                    return failure[1], None
+                return None, failure[2]
+        return None, None
+
+    def task_done(self, task_ref, status="success"):
+        with self._lock:
+            if task_ref in self._objects["task"]:
+                self._objects["task"][task_ref]["status"] = status
+                self._objects["task"][task_ref]["progress"] = 1.0
+                self._log_event("task", "mod", task_ref)
+
+    def is_cancelled(self, task_ref):
+        with self._lock:
+            task = self._objects["task"].get(task_ref)
+            return task is not None and task["status"] == "cancelling"
+
+    def vdi_stream(self, vdi_ref, vdi_format="raw", base_ref=None):
+        with self._lock:
+            virtual_size = int(self._record("VDI", vdi_ref)["virtual_size"])
+            blocks = dict(self._vdi_blocks[vdi_ref])
+            if base_ref is not None:
+                self._record("VDI", base_ref)
+                base_blocks = self._vdi_blocks[base_ref]
+                blocks = {block: digest for block, digest in blocks.items() if base_blocks.get(block) != digest}
+        if vdi_format == "vhd":
+            return _vhd_stream(virtual_size, blocks, self._block_data)
+        return _raw_stream(virtual_size, blocks, self._block_data)
+
+    def vdi_import(self, vdi_ref, reader, vdi_format="raw"):
+        with self._lock:
+            self._record("VDI", vdi_ref)
+            blocks = self._vdi_blocks[vdi_ref]
+        for block, bitmap, data in (_vhd_blocks(reader) if vdi_format == "vhd" else _raw_blocks(reader)):
+            if bitmap is not None and bitmap != b"\xff" * len(bitmap):
+                current = bytearray(self._block_data[blocks[block]] if block in blocks else bytes(BLOCK_SIZE))
+                for sector in range(BLOCK_SIZE // SECTOR_SIZE):
+                    if bitmap[sector // 8] & (0x80 >> (sector % 8)):
+                        start = sector * SECTOR_SIZE
+                        current[start:start + SECTOR_SIZE] = data[start:start + SECTOR_SIZE]
+                data = bytes(current)
+            with self._lock:
+                blocks[block] = self._store_block(data)
+
+    def xva_stream(self, vm_ref, compress):
+        with self._lock:
+            record = copy.deepcopy(self._record("VM", vm_ref))
+            disks = []
+            for vbd_ref in record["VBDs"]:
+                vdi_ref = self._objects["VBD"][vbd_ref]["VDI"]
+                if vdi_ref != NULL_REF:
+                    disks.append((copy.deepcopy(self._objects["VDI"][vdi_ref]), dict(self._vdi_blocks[vdi_ref])))
+            record["VDIs"] = [vdi for vdi, _ in disks]
+        chunks = [self._block_data[digest] for _, blocks in disks for digest in blocks.values()]
+        xva_size = len(chunks) * BLOCK_SIZE if self.xva_size is None else self.xva_size
+        stream = _xva_stream(record, chunks or [self._block_data[digest] for digest in self._patterns], xva_size)
+        return _gzip_stream(stream) if compress else stream
+
+    def xva_import(self, reader, sr_ref=None, restore=False):
+        record = None
+        disk_data = 0
+        for name, data in _tar_members(_decompressed(reader)):
+            if name == "ova.xml":
+                record = loads(data)[0][0]
+            else:
+                disk_data += data
+        if record is None:
+            raise SimulatorFailure("IMPORT_ERROR", "ova.xml missing")
+
+        with self._lock:
+            vm_ref = self._create("VM", dict(record, is_a_snapshot=False, snapshot_of=NULL_REF, power_state="Halted",
+                                             resident_on=NULL_REF))
+            if restore:
+                self._objects["VM"][vm_ref]["uuid"] = record["uuid"]
+            for device, vdi in enumerate(record.get("VDIs", [])):
+                vdi_ref = self._create("VDI", dict(vdi, SR=sr_ref or self.default_sr, is_a_snapshot=False,
+                                                   snapshot_of=NULL_REF))
+                self._vdi_blocks[vdi_ref] = {}
+                self._create("VBD", {"VM": vm_ref, "VDI": vdi_ref, "userdevice": str(device)})
+            self._create("VIF", {"VM": vm_ref, "network": self.default_network, "device": "0"})
+            return vm_ref
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    chunk_size = 2 ** 20
+
+    @property
+    def simulator(self):
+        return self.server.simulator
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = _BodyReader(self).read()
+        try:
+            params, method = loads(body, use_builtin_types=False)
+            response = dumps((self.simulator.dispatch(method, params),), methodresponse=True, allow_none=True)
+        except Fault as fault:
+            response = dumps(fault, allow_none=True)
+        response = response.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == "/export_raw_vdi":
+            self._send_stream(url.path, query, lambda: self.simulator.vdi_stream(
+                query["vdi"], query.get("format", "raw"), query.get("base")))
+        elif url.path == "/export":
+            self._send_stream(url.path, query, lambda: self.simulator.xva_stream(
+                query["ref"], query.get("use_compression") == "true"))
+        else:
+            self._send_error(404)
+
+    def do_PUT(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        status, _ = self.simulator.check_transfer(url.path, query, self._get_host())
+        reader = _BodyReader(self, self.simulator.throughput)
+        try:
+            if status is not None:
+                raise SimulatorFailure("HTTP", status)
+            if url.path == "/import_raw_vdi":
+                self.simulator.vdi_import(query["vdi"], reader, query.get("format", "raw"))
+            elif url.path == "/import":
+                self.simulator.xva_import(reader, query.get("sr_id"), query.get("restore") == "true")
+            else:
+                status = 404
+                raise SimulatorFailure("HTTP", status)
+        except (SimulatorFailure, KeyError, ValueError, struct.error, tarfile.TarError, zlib.error):
+            reader.drain()
+            self.simulator.task_done(query.get("task_id"), "failure")
+            self._send_error(status or 500)
+        else:
+            reader.drain()
+            self.simulator.task_done(query.get("task_id"))
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def _get_host(self):
+        return urlsplit("//" + self.headers.get("Host", "")).hostname
+
+    def _send_error(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send_stream(self, path, query, make_stream):
+        status, fail_after = self.simulator.check_transfer(path, query, self._get_host())
+        if status is not None:
+            return self._send_error(status)
+        try:
+            stream = make_stream()
+        except (SimulatorFailure, KeyError):
+            return self._send_error(500)
+
+        # Like xapi, data is sent without Content-Length and the connection closed at the end
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        sent = 0
+        start = time.time()
+        task_ref = query.get("task_id")
+        for chunk in stream:
+            if fail_after is not None and sent + len(chunk) > fail_after:
+                self.wfile.write(chunk[:max(fail_after - sent, 0)])
+                self.simulator.task_done(task_ref, "failure")
+                # Reset the connection so that the client sees an error instead of a short stream
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                self.connection.close()
+                return
+            if self.simulator.is_cancelled(task_ref):
+                return
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            _throttle(self.simulator.throughput, sent, start)
+        self.simulator.task_done(task_ref)
+
+
+class _BodyReader(object):
+    """Request body reader handling both Content-Length and chunked transfer encoding."""
+
+    def __init__(self, handler, throughput=None):
+        self._rfile = handler.rfile
+        self._chunked = handler.headers.get("Transfer-Encoding", "").lower() == "chunked"
+        self._remaining = int(handler.headers.get("Content-Length", 0) or 0)
+        self._throughput = throughput
+        self._start = time.time()
+        self.received = 0
+
+    def read(self, size=-1):
+        if self._chunked:
+            data = bytearray()
+            while size < 0 or len(data) < size:
+                if self._remaining == 0:
+                    line = self._rfile.readline()
+                    self._remaining = int(line.split(b";")[0].strip() or b"0", 16)
+                    if self._remaining == 0:
+                        # Trailer
+                        while self._rfile.readline() not in (b"\r\n", b"\n", b""):
+                            pass
+                        self._remaining = -1
+                if self._remaining < 0:
+                    break
+                chunk = self._rfile.read(self._remaining if size < 0 else min(self._remaining, size - len(data)))
+                if not chunk:
+                    break
+                data += chunk
+                self._remaining -= len(chunk)
+                if self._remaining == 0:
+                    self._rfile.readline()
+            data = bytes(data)
+        else:
+            size = self._remaining if size < 0 else min(size, self._remaining)
+            data = self._rfile.read(size) if size > 0 else b""
+            self._remaining -= len(data)
+        self.received += len(data)
+        _throttle(self._throughput, self.received, self._start)
+        return data
+
+    def read_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise ValueError("Unexpected end of stream")
+            data += chunk
+        return bytes(data)
+
+    def drain(self):
+        while self.read(2 ** 20):
+            pass
+
+
+def _throttle(throughput, transferred, start):
+    if throughput:
+        delay = transferred / throughput - (time.time() - start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _checksum(data):
+    return ~sum(data) & 0xffffffff
+
+
+def _geometry(size):
+    sectors = min(size // SECTOR_SIZE, 65535 * 16 * 255)
+    if sectors >= 65535 * 16 * 63:
+        spt, heads = 255, 16
+        cylinder_heads = sectors // spt
+    else:
+        spt = 17
+        cylinder_heads = sectors // spt
+        heads = max((cylinder_heads + 1023) // 1024, 4)
+        if cylinder_heads >= heads * 1024 or heads > 16:
+            spt, heads = 31, 16
+            cylinder_heads = sectors // spt
+        if cylinder_heads >= heads * 1024:
+            spt, heads = 63, 16
+            cylinder_heads = sectors // spt
+    return ((cylinder_heads // heads) << 16) | (heads << 8) | spt
+
+
+def _vhd_footer_bytes(virtual_size):
+    fields = [b"conectix", 2, 0x00010000, SECTOR_SIZE, 0, b"tap\0", 0x00010003, 0, virtual_size, virtual_size,
+              _geometry(virtual_size), 3, 0, uuid_lib.uuid4().bytes, 0]
+    fields[12] = _checksum(_vhd_footer.pack(*fields))
+    return _vhd_footer.pack(*fields)
+
+
+def _vhd_stream(virtual_size, blocks, block_data):
+    n_entries = int(math.ceil(virtual_size / BLOCK_SIZE))
+    bat_size = int(math.ceil(n_entries * 4 / SECTOR_SIZE)) * SECTOR_SIZE
+    footer = _vhd_footer_bytes(virtual_size)
+
+    fields = [b"cxsparse", 0xffffffffffffffff, 3 * SECTOR_SIZE, 0x00010000, n_entries, BLOCK_SIZE, 0, bytes(16), 0,
+              0, bytes(512), bytes(192)]
+    fields[6] = _checksum(_vhd_header.pack(*fields))
+    yield footer + _vhd_header.pack(*fields)
+
+    bat = [0xffffffff] * n_entries
+    sector = (3 * SECTOR_SIZE + bat_size) // SECTOR_SIZE
+    for block in sorted(blocks):
+        bat[block] = sector
+        sector += 1 + BLOCK_SIZE // SECTOR_SIZE
+    yield struct.pack(">%dI" % n_entries, *bat) + b"\xff" * (bat_size - n_entries * 4)
+
+    bitmap = b"\xff" * SECTOR_SIZE
+    for block in sorted(blocks):
+        yield bitmap
+        yield block_data[blocks[block]]
+    yield footer
+
+
+def _vhd_blocks(reader):
+    position = 0
+
+    def skip_to(offset):
+        nonlocal position
+        if offset < position:
+            raise ValueError("VHD stream not in order")
+        while position < offset:
+            position += len(reader.read_exactly(min(offset - position, 2 ** 20)))
+
+    footer = _vhd_footer.unpack(reader.read_exactly(SECTOR_SIZE))
+    position = SECTOR_SIZE
+    if footer[0] != b"conectix":
+        raise ValueError("Not a VHD stream")
+    skip_to(footer[3])
+    header = _vhd_header.unpack(reader.read_exactly(1024))
+    position += 1024
+    table_offset, n_entries, block_size = header[2], header[4], header[5]
+    if block_size != BLOCK_SIZE:
+        raise ValueError("Unsupported VHD block size")
+    skip_to(table_offset)
+    bat = struct.unpack(">%dI" % n_entries, reader.read_exactly(n_entries * 4))
+    position += n_entries * 4
+
+    bitmap_size = int(math.ceil(block_size // SECTOR_SIZE / 8 / SECTOR_SIZE)) * SECTOR_SIZE
+    for offset, block in sorted((offset, block) for block, offset in enumerate(bat) if offset != 0xffffffff):
+        skip_to(offset * SECTOR_SIZE)
+        bitmap = reader.read_exactly(bitmap_size)
+        data = reader.read_exactly(block_size)
+        position += bitmap_size + block_size
+        yield block, bitmap, data
+
+
+def _raw_stream(virtual_size, blocks, block_data):
+    for block in range(int(math.ceil(virtual_size / BLOCK_SIZE))):
+        data = block_data[blocks[block]] if block in blocks else bytes(BLOCK_SIZE)
+        yield data[:virtual_size - block * BLOCK_SIZE]
+
+
+def _raw_blocks(reader):
+    block = 0
+    while True:
+        data = reader.read(BLOCK_SIZE)
+        if not data:
+            break
+        data = data + reader.read_exactly(BLOCK_SIZE - len(data)) if len(data) < BLOCK_SIZE else data
+        if data.count(0) != len(data):
+            yield block, None, data
+        block += 1
+
+
+def _tar_header(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = 0
+    return info.tobuf(tarfile.USTAR_FORMAT)
+
+
+def _xva_stream(record, chunks, xva_size):
+    ova = dumps((record,), allow_none=True).encode()
+    yield _tar_header("ova.xml", len(ova)) + ova + bytes(-len(ova) % tarfile.BLOCKSIZE)
+
+    chunk = 0
+    while xva_size > 0:
+        data = chunks[chunk % len(chunks)]
+        data = data[:min(len(data), xva_size)]
+        yield _tar_header("Ref:1/%08d" % chunk, len(data)) + data + bytes(-len(data) % tarfile.BLOCKSIZE)
+        xva_size -= len(data)
+        chunk += 1
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+
+def _gzip_stream(stream):
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 31)
+    for chunk in stream:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _decompressed(reader):
+    head = reader.read(2)
+    if head == b"\x1f\x8b":
+        decompressor = zlib.decompressobj(47)
+        data = head
+        while data:
+            while data:
+                chunk = decompressor.decompress(data)
+                if chunk:
+                    yield chunk
+                data = decompressor.unused_data
+                if data:
+                    # Next gzip member
+                    decompressor = zlib.decompressobj(47)
+            data = reader.read(2 ** 20)
+    elif head == b"\x28\xb5":
+        raise SimulatorFailure("IMPORT_ERROR", "zstd compressed XVA not supported by the simulator")
+    else:
+        yield head
+        data = reader.read(2 ** 20)
+        while data:
+            yield data
+            data = reader.read(2 ** 20)
+
+
+def _tar_members(stream):
+    """Yield (name, data) for the ova.xml member and (name, size) for the others."""
+    buffer = bytearray()
+    stream = iter(stream)
+
+    def take(size):
+        while len(buffer) < size:
+            chunk = next(stream, None)
+            if chunk is None:
+                raise ValueError("Unexpected end of XVA")
+            buffer.extend(chunk)
+        data = bytes(buffer[:size])
+        del buffer[:size]
+        return data
+
+    while True:
+        header = take(tarfile.BLOCKSIZE)
+        if header.count(0) == len(header):
+            break
+        info = tarfile.TarInfo.frombuf(header, "utf-8", "surrogateescape")
+        data = take(info.size)
+        take(-info.size % tarfile.BLOCKSIZE)
+        yield (info.name, data) if info.name == "ova.xml" else (info.name, len(data))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a simulated Xen pool")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--vms", type=int, default=3, help="Number of VMs")
+    parser.add_argument("--disks", type=int, default=1, help="Disks per VM")
+    parser.add_argument("--disk-size", type=int, default=64, help="Disk size (MiB)")
+    parser.add_argument("--fill", type=float, default=0.5, help="Fraction of allocated disk blocks")
+    parser.add_argument("--rpc-latency", type=float, default=0.0, help="Seconds added to every XenAPI call")
+    parser.add_argument("--throughput", type=float, help="Data stream limit (MiB/s)")
+    args = parser.parse_args()
+
+    simulator = XapiSimulator(args.host, args.port, args.rpc_latency,
+                              args.throughput * 2 ** 20 if args.throughput else None)
+    for vm in range(args.vms):
+        simulator.add_vm("vm {}".format(vm), [args.disk_size * 2 ** 20] * args.disks, fill=args.fill)
+    print("Simulated pool listening on", simulator.url)
+    try:
+        simulator.start()._thread.join()
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import errno
+import os
+import threading
+import time
+
+from six.moves import queue
+
+# Size of the transfer buffers, set from the block_size setting
+default_block_size = 4 * 2 ** 20
+# Buffers read ahead by a separate thread (0: read and write in lock-step), set from the pipeline_depth setting
+default_depth = 4
+
+
+class TransferStats(object):
+    """Counters of a pipelined transfer.
+
+    read_wait is the time the reading thread waited for a free buffer (the writing side is the bottleneck),
+    write_wait the time the writing side waited for data (the reading side is the bottleneck).
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.blocks = 0
+        self.read_wait = 0.0
+        self.write_wait = 0.0
+        self.queued_blocks = 0
+        self.max_queued_blocks = 0
+
+    def get_average_queue(self):
+        return self.queued_blocks / self.blocks if self.blocks else 0.0
+
+    def to_dict(self):
+        return {
+            "bytes": self.bytes,
+            "read_wait": round(self.read_wait, 6),
+            "write_wait": round(self.write_wait, 6),
+            "average_queue": round(self.get_average_queue(), 2),
+            "max_queue": self.max_queued_blocks
+        }
+
+    def __str__(self):
+        return "{} bytes, read wait {:.2f}s, write wait {:.2f}s, average queue {:.1f}".format(
+            self.bytes, self.read_wait, self.write_wait, self.get_average_queue())
+
+
+class Pipeline(object):
+    """Iterates over the content of src, read by a separate thread into depth rotating buffers.
+
+    Every yielded view is valid until the next one is requested. Errors of the reading thread are raised by the
+    iteration, SystemExit is raised as soon as the abort event is set.
+    """
+    _poll_interval = 0.5
+
+    def __init__(self, src, block_size=None, depth=None, abort=None, stats=None):
+        self.src = src
+        self.abort = abort
+        self.stats = stats if stats is not None else TransferStats()
+
+        self._free = queue.Queue()
+        self._full = queue.Queue()
+        for _ in range(max(depth or default_depth, 1)):
+            self._free.put(memoryview(bytearray(block_size or default_block_size)))
+        self._stop = False
+        self._thread = threading.Thread(target=self._read, name="stream-reader", daemon=True)
+
+    def __iter__(self):
+        self._thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                buffer, read = self._next_block()
+                self.stats.write_wait += time.perf_counter() - start
+                if buffer is None:
+                    raise read
+                if not read:
+                    break
+
+                queued = self._full.qsize()
+                self.stats.blocks += 1
+                self.stats.bytes += read
+                self.stats.queued_blocks += queued
+                self.stats.max_queued_blocks = max(self.stats.max_queued_blocks, queued)
+
+                yield buffer[:read]
+                self._free.put(buffer)
+        finally:
+            self._stop = True
+            self._free.put(None)
+
+        self._thread.join()
+
+    def _next_block(self):
+        while True:
+            if self.abort is not None and self.abort.is_set():
+                raise SystemExit("Copy aborted")
+            try:
+                return self._full.get(timeout=self._poll_interval)
+            except queue.Empty:
+                pass
+
+    def _read(self):
+        try:
+            while True:
+                start = time.perf_counter()
+                buffer = self._free.get()
+                self.stats.read_wait += time.perf_counter() - start
+                if buffer is None or self._stop:
+                    return
+                read = self.src.readinto(buffer)
+                self._full.put((buffer, read))
+                if not read:
+                    return
+        except BaseException as e:
+            self._full.put((None, e))
+
+
+def copy_stream(src, dst, size=None, abort=None, block_size=None, depth=None, stats=None):
+    """Copy src to dst through preallocated buffers and return the number of bytes copied.
+
+    src must support readinto (HTTP responses and binary files do), dst should be unbuffered (buffering=0) to
+    avoid a further copy. Unless depth is 0, src is read by a separate thread (see Pipeline) so that network and
+    disk I/O overlap. With a known size the output file is allocated upfront. Raises SystemExit as soon as the
+    abort event is set.
+    """
+    if size:
+        preallocate(dst, size)
+
+    copied = 0
+    for block in iter_file(src, block_size, depth, abort, stats):
+        write_all(dst, block)
+        copied += len(block)
+
+    if size and copied != size:
+        dst.truncate(copied)
+    return copied
+
+
+def iter_file(file, block_size=None, depth=None, abort=None, stats=None):
+    """Yield the content of a binary file as views of reused buffers, each one valid until the next is read.
+
+    Suitable as request body: http.client sends every block before asking for the next one.
+    """
+    if (depth if depth is not None else default_depth) > 0:
+        yield from Pipeline(file, block_size, depth, abort, stats)
+        return
+
+    buffer = memoryview(bytearray(block_size or default_block_size))
+    while True:
+        if abort is not None and abort.is_set():
+            raise SystemExit("Copy aborted")
+        read = file.readinto(buffer)
+        if not read:
+            break
+        if stats is not None:
+            stats.blocks += 1
+            stats.bytes += read
+        yield buffer[:read]
+
+
+def write_all(file, data):
+    # Raw files may write less than asked
+    written = file.write(data)
+    while written is not None and written < len(data):
+        data = data[written:]
+        written = file.write(data)
+
+
+def preallocate(file, size):
+    if not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except OSError as e:
+        # Not supported by the file system
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            raise e
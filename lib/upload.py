@@ -0,0 +1,139 @@
+"""HTTP PUT uploads of the restored data (/import and /import_raw_vdi).
+
+The body is written straight to the socket in large blocks: slices of a memory map of the backup file, or the
+buffers of the stream pipeline for generated streams (decompressed, merged or deduplicated data), which are sent with
+chunked transfer encoding when their size is unknown. Progress is logged every progress_interval seconds.
+"""
+import http.client
+import logging
+import mmap
+import os
+import ssl
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+
+from lib import fileio, stream
+from lib.stream import TransferStats, iter_file
+
+logger = logging.getLogger("Upload")
+
+progress_interval = 30
+
+_ctx = ssl.create_default_context()
+_ctx.check_hostname = False
+_ctx.verify_mode = ssl.CERT_NONE
+
+
+class Upload(object):
+    """PUT request whose body is sent by write. finish completes it, raising HTTPError on an error status.
+
+    Like urllib, a connection failure raises URLError: nothing was sent yet and the upload can be retried elsewhere.
+    """
+
+    def __init__(self, url, size=None, content_type="application/octet-stream"):
+        self.url = url
+        self.size = size
+        self.sent = 0
+
+        url_parts = urlsplit(url)
+        if url_parts.scheme == "https":
+            self._connection = http.client.HTTPSConnection(url_parts.hostname, url_parts.port, context=_ctx)
+        else:
+            self._connection = http.client.HTTPConnection(url_parts.hostname, url_parts.port)
+        self._connection.putrequest("PUT", url_parts.path + ("?" + url_parts.query if url_parts.query else ""),
+                                    skip_accept_encoding=True)
+        self._connection.putheader("Content-Type", content_type)
+        if size is None:
+            self._connection.putheader("Transfer-Encoding", "chunked")
+        else:
+            self._connection.putheader("Content-Length", str(size))
+        try:
+            self._connection.endheaders()
+        except OSError as e:
+            self._connection.close()
+            raise URLError(e)
+
+        self._start = self._reported = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        if not data:
+            return
+        if self.size is None:
+            # Chunk framing sent apart to avoid copying the data
+            self._connection.send(b"%X\r\n" % len(data))
+            self._connection.send(data)
+            self._connection.send(b"\r\n")
+        elif self.sent + len(data) > self.size:
+            raise ValueError("Upload larger than its declared size ({} bytes)".format(self.size))
+        else:
+            self._connection.send(data)
+        self.sent += len(data)
+
+        now = time.perf_counter()
+        if now - self._reported >= progress_interval:
+            self._reported = now
+            logger.debug("%s: %s uploaded, %.1f MiB/s", urlsplit(self.url).path, self._get_progress(),
+                         self.get_throughput())
+
+    def finish(self):
+        if self.size is None:
+            self._connection.send(b"0\r\n\r\n")
+        elif self.sent != self.size:
+            raise IOError("Upload ended after {} of {} bytes".format(self.sent, self.size))
+
+        response = self._connection.getresponse()
+        response.read()
+        if response.status >= 300:
+            raise HTTPError(self.url, response.status, response.reason, response.headers, None)
+        logger.debug("%s: %d bytes uploaded in %.1fs, %.1f MiB/s", urlsplit(self.url).path, self.sent,
+                     time.perf_counter() - self._start, self.get_throughput())
+        return response.status
+
+    def close(self):
+        self._connection.close()
+
+    def get_throughput(self):
+        """Average throughput in MiB/s."""
+        return self.sent / max(time.perf_counter() - self._start, 1e-6) / 2 ** 20
+
+    def _get_progress(self):
+        if self.size:
+            return "{:.1f}%".format(self.sent * 100 / self.size)
+        return "{} bytes".format(self.sent)
+
+
+def put_stream(url, data_file, size=None, stats=None, abort=None):
+    """PUT what is read from data_file (anything supporting readinto), read ahead by the stream pipeline."""
+    with Upload(url, size) as upload:
+        for block in iter_file(data_file, abort=abort, stats=stats):
+            upload.write(block)
+        return upload.finish()
+
+
+def put_file(url, file_name, stats=None, abort=None):
+    """PUT a file, sent from a memory map of it (read by fileio.open_input outside of the buffered io_mode)."""
+    size = os.path.getsize(file_name)
+    if fileio.io_mode != "buffered" or size == 0:
+        with fileio.open_input(file_name) as data_file:
+            return put_stream(url, data_file, size, stats, abort)
+
+    stats = stats if stats is not None else TransferStats()
+    with open(file_name, "rb") as data_file, mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+            Upload(url, size) as upload:
+        if hasattr(data, "madvise"):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        for start in range(0, size, stream.default_block_size):
+            if abort is not None and abort.is_set():
+                raise SystemExit("Upload aborted")
+            with memoryview(data)[start:start + stream.default_block_size] as block:
+                upload.write(block)
+                stats.blocks += 1
+                stats.bytes += len(block)
+        return upload.finish()
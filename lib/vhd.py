@@ -0,0 +1,416 @@
+"""Reading and streaming rewriting of the dynamic and differencing VHD files exported by XenServer."""
+import logging
+import mmap
+import struct
+import uuid
+
+logger = logging.getLogger("VHD")
+
+SECTOR_SIZE = 512
+UNUSED_ENTRY = 0xffffffff
+FIXED_DISK = 2
+DYNAMIC_DISK = 3
+DIFFERENCING_DISK = 4
+
+_footer = struct.Struct(">8sIIQI4sIIQQIII16sB427x")
+_header = struct.Struct(">8sQQIIII16sII512s192s256x")
+_locator = struct.Struct(">4sIIIQ")
+_bat_entry = struct.Struct(">I")
+
+# Drop the all zero blocks of full VHD exports, set from the drop_zero_blocks setting
+drop_zero_blocks = True
+# Restore delta backups merged with their base in a single upload, set from the merge_restores setting
+merge_restores = True
+
+
+class ZeroBlockFilter(object):
+    """File-like object writing a dynamic VHD stream to file without its all zero data blocks.
+
+    The BAT of the stream is written as is, the blocks following it are checked one at a time and written only if
+    they contain any non zero byte, and the BAT is rewritten by close with the new block offsets. Blocks must be
+    stored in the order of their offsets, after the BAT (as XenServer exports them). file must be seekable.
+
+    Anything else (fixed or differencing disks, unexpected layouts) is written unchanged. Zero blocks of a delta
+    overwrite data of the base disk: only full exports can be filtered.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.zero_blocks = 0
+        self.bytes_saved = 0
+
+        self._buffer = bytearray()
+        # Bytes of the input stream received and written (or dropped)
+        self._position = 0
+        self._written = 0
+        self._state = self._read_footer
+        self._needed = SECTOR_SIZE
+
+        self._copy_end = None
+        self._next_state = None
+        self._bat = None
+        self._bat_offset = None
+        self._blocks = None
+        self._block_size = None
+        self._bitmap_size = None
+        self._zero = None
+
+    def write(self, data):
+        self._buffer += data
+        while self._state is not None and len(self._buffer) >= self._needed:
+            self._state()
+        if self._state is None and self._buffer:
+            self._write(self._take(len(self._buffer)))
+        return len(data)
+
+    def close(self):
+        if self._buffer:
+            self._write(self._take(len(self._buffer)))
+        if self._bat_offset is not None and self.zero_blocks:
+            end = self.file.tell()
+            self.file.seek(self._bat_offset)
+            self._write_all(struct.pack(">%dI" % len(self._bat), *self._bat))
+            self.file.seek(end)
+        self.file.truncate(self.file.tell())
+
+    def _take(self, size):
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._position += size
+        return data
+
+    def _write(self, data):
+        self._write_all(data)
+        self._written += len(data)
+
+    def _write_all(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[self.file.write(view) or len(view):]
+
+    def _pass_through(self):
+        self._state = None
+        self._needed = 0
+
+    def _copy_to(self, offset, next_state, needed):
+        """Write the stream as is up to offset, then wait for needed bytes and call next_state."""
+        if offset < self._position:
+            logger.warning("Unexpected VHD layout, zero blocks kept")
+            self._bat_offset = None
+            self._pass_through()
+            return
+        self._copy_end = offset
+        self._next_state = next_state, needed
+        self._state = self._copy
+        self._needed = 0
+
+    def _copy(self):
+        size = min(self._copy_end - self._position, len(self._buffer))
+        if size:
+            self._write(self._take(size))
+        if self._position == self._copy_end:
+            self._state, self._needed = self._next_state
+        else:
+            self._needed = 1
+
+    def _read_footer(self):
+        footer = _footer.unpack(bytes(self._buffer[:SECTOR_SIZE]))
+        if footer[0] != b"conectix" or footer[11] != DYNAMIC_DISK:
+            self._pass_through()
+            return
+        self._copy_to(footer[3], self._read_header, _header.size)
+
+    def _read_header(self):
+        header = _header.unpack(bytes(self._buffer[:_header.size]))
+        table_offset, n_entries, self._block_size = header[2], header[4], header[5]
+        self._bitmap_size = -(-self._block_size // SECTOR_SIZE // 8 // SECTOR_SIZE) * SECTOR_SIZE
+        bat_size = -(-n_entries * 4 // SECTOR_SIZE) * SECTOR_SIZE
+        self._copy_to(table_offset, lambda: self._read_bat(n_entries, bat_size), bat_size)
+
+    def _read_bat(self, n_entries, bat_size):
+        self._bat = list(struct.unpack(">%dI" % n_entries, bytes(self._buffer[:n_entries * 4])))
+        self._bat_offset = self._written
+        self._write(self._take(bat_size))
+
+        self._blocks = sorted((offset, block) for block, offset in enumerate(self._bat) if offset != UNUSED_ENTRY)
+        offsets = [offset * SECTOR_SIZE for offset, _ in self._blocks]
+        block_total = self._bitmap_size + self._block_size
+        if any(b - a < block_total for a, b in zip([self._position - block_total] + offsets, offsets)):
+            logger.warning("Unexpected VHD block layout, zero blocks kept")
+            self._bat_offset = None
+            self._pass_through()
+            return
+        self._zero = bytes(self._block_size)
+        self._blocks.reverse()
+        self._next_block()
+
+    def _next_block(self):
+        if not self._blocks:
+            self._pass_through()
+            return
+        offset, block = self._blocks[-1]
+        self._copy_to(offset * SECTOR_SIZE, self._read_block, self._bitmap_size + self._block_size)
+
+    def _read_block(self):
+        _, block = self._blocks.pop()
+        size = self._bitmap_size + self._block_size
+        if self._buffer[self._bitmap_size:size] == self._zero:
+            del self._buffer[:size]
+            self._position += size
+            self._bat[block] = UNUSED_ENTRY
+            self.zero_blocks += 1
+            self.bytes_saved += size
+        else:
+            self._bat[block] = self._written // SECTOR_SIZE
+            self._write(self._take(size))
+        self._next_block()
+
+
+def _checksum(data):
+    return ~sum(data) & 0xffffffff
+
+
+class VhdFile(object):
+    """Memory mapped dynamic or differencing VHD file.
+
+    Footer, header and BAT are read in place, and blocks and bitmaps are returned as memoryviews of the mapping
+    (valid until close), so that large files can be inspected without reading them.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        try:
+            self._parse()
+        except (ValueError, struct.error) as e:
+            self.close()
+            raise ValueError("{}: {}".format(file_name, e))
+
+    def _parse(self):
+        if len(self._view) < 3 * SECTOR_SIZE:
+            raise ValueError("Too short for a VHD file")
+        footer = _footer.unpack_from(self._view, len(self._view) - SECTOR_SIZE)
+        if footer[0] != b"conectix":
+            raise ValueError("Not a VHD file")
+        self.footer_checksum_ok = _checksum(
+            bytes(self._view[-SECTOR_SIZE:-SECTOR_SIZE + 64]) + bytes(4) + bytes(self._view[-SECTOR_SIZE + 68:])) \
+            == footer[12]
+        self.disk_type = footer[11]
+        self.virtual_size = footer[9]
+        self.uuid = uuid.UUID(bytes=footer[13])
+        if self.disk_type not in (DYNAMIC_DISK, DIFFERENCING_DISK):
+            raise ValueError("Unsupported VHD disk type {}".format(self.disk_type))
+
+        header_offset = footer[3]
+        header = _header.unpack_from(self._view, header_offset)
+        if header[0] != b"cxsparse":
+            raise ValueError("VHD header missing")
+        header_bytes = bytes(self._view[header_offset:header_offset + _header.size])
+        self.header_checksum_ok = _checksum(header_bytes[:36] + bytes(4) + header_bytes[40:]) == header[6]
+        self.table_offset = header[2]
+        self.max_table_entries = header[4]
+        self.block_size = header[5]
+        self.parent_uuid = uuid.UUID(bytes=header[7]) if self.disk_type == DIFFERENCING_DISK else None
+        self.parent_name = header[10].decode("utf-16-be").rstrip("\0") or None
+        self.parent_locators = [
+            (code, offset, length)
+            for code, _, length, _, offset in _locator.iter_unpack(header[11]) if code != bytes(4)]
+
+        self.bitmap_size = -(-self.block_size // SECTOR_SIZE // 8 // SECTOR_SIZE) * SECTOR_SIZE
+        self.bat = self._view[self.table_offset:self.table_offset + self.max_table_entries * _bat_entry.size]
+        if len(self.bat) != self.max_table_entries * _bat_entry.size:
+            raise ValueError("BAT truncated")
+
+    def close(self):
+        self.bat = None
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Block views still referenced, unmapped when released
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_block_offset(self, block):
+        """Byte offset of the bitmap of the block, None if not allocated."""
+        sector, = _bat_entry.unpack_from(self.bat, block * _bat_entry.size)
+        return None if sector == UNUSED_ENTRY else sector * SECTOR_SIZE
+
+    def iter_allocated_blocks(self):
+        """Index and offset of the allocated blocks, in block order."""
+        for block, (sector,) in enumerate(_bat_entry.iter_unpack(self.bat)):
+            if sector != UNUSED_ENTRY:
+                yield block, sector * SECTOR_SIZE
+
+    def get_allocated_blocks(self):
+        return sum(1 for _ in self.iter_allocated_blocks())
+
+    def read_bitmap(self, block):
+        offset = self.get_block_offset(block)
+        return None if offset is None else self._view[offset:offset + self.bitmap_size]
+
+    def read_block(self, block):
+        """Data of the block as a memoryview of the file, None if not allocated."""
+        offset = self.get_block_offset(block)
+        if offset is None:
+            return None
+        offset += self.bitmap_size
+        return self._view[offset:offset + self.block_size]
+
+    def is_sector_present(self, block, sector):
+        bitmap = self.read_bitmap(block)
+        return bitmap is not None and bool(bitmap[sector // 8] & (0x80 >> (sector % 8)))
+
+    def get_parent_paths(self):
+        """Parent paths of a differencing disk, as recorded by its parent locators."""
+        paths = []
+        for code, offset, length in self.parent_locators:
+            data = bytes(self._view[offset:offset + length])
+            if code in (b"W2ku", b"W2ru"):
+                paths.append(data.decode("utf-16-le").rstrip("\0"))
+            elif code == b"MacX":
+                paths.append(data.decode("utf-8").rstrip("\0"))
+        return paths
+
+    def check(self):
+        """List of the problems found in the structure of the file (empty if valid)."""
+        problems = []
+        if not self.footer_checksum_ok:
+            problems.append("footer checksum mismatch")
+        if not self.header_checksum_ok:
+            problems.append("header checksum mismatch")
+        if bytes(self._view[:SECTOR_SIZE]) != bytes(self._view[-SECTOR_SIZE:]):
+            problems.append("footer copy differs from footer")
+        if self.max_table_entries * self.block_size < self.virtual_size:
+            problems.append("BAT smaller than the virtual size")
+
+        data_start = self.table_offset + len(self.bat)
+        data_end = len(self._view) - SECTOR_SIZE
+        previous_end = data_start
+        for offset, block in sorted((offset, block) for block, offset in self.iter_allocated_blocks()):
+            if offset < previous_end:
+                problems.append("block {} overlaps the metadata or another block".format(block))
+            if offset + self.bitmap_size + self.block_size > data_end:
+                problems.append("block {} beyond the end of the file".format(block))
+            previous_end = max(previous_end, offset + self.bitmap_size + self.block_size)
+        return problems
+
+
+def can_merge(base_file_name, delta_file_name):
+    """Whether the two files are VHDs that MergedVhd can merge (not compressed nor chunked)."""
+    try:
+        with VhdFile(base_file_name) as base, VhdFile(delta_file_name) as delta:
+            return base.block_size == delta.block_size and base.bitmap_size == delta.bitmap_size
+    except (OSError, ValueError):
+        return False
+
+
+class MergedVhd(object):
+    """Readable (readinto) dynamic VHD stream with the blocks of delta and, where delta has none, of base.
+
+    Blocks partially present in delta (sector bitmap not full) are completed with the sectors of base. Full blocks
+    are read from the mapped files without copies. size is the length of the stream.
+    """
+
+    def __init__(self, base, delta):
+        self.base = base
+        self.delta = delta
+        self.blocks = 0
+        self.delta_blocks = 0
+
+        n_entries = max(base.max_table_entries, delta.max_table_entries)
+        self._block_total = delta.bitmap_size + delta.block_size
+        self._full_bitmap = b"\xff" * delta.bitmap_size
+        self._pieces = self._iter_pieces(n_entries)
+
+        bat_size = -(-n_entries * _bat_entry.size // SECTOR_SIZE) * SECTOR_SIZE
+        allocated = {block for block, _ in base.iter_allocated_blocks() if block < n_entries}
+        allocated.update(block for block, _ in delta.iter_allocated_blocks())
+        self._allocated = sorted(allocated)
+        self.size = 3 * SECTOR_SIZE + bat_size + len(self._allocated) * self._block_total + SECTOR_SIZE
+        self._bat_size = bat_size
+        self._data = memoryview(b"")
+
+    def readinto(self, buffer):
+        while not self._data:
+            piece = next(self._pieces, None)
+            if piece is None:
+                return 0
+            self._data = memoryview(piece)
+        size = min(len(buffer), len(self._data))
+        buffer[:size] = self._data[:size]
+        self._data = self._data[size:]
+        return size
+
+    def close(self):
+        self._pieces = iter(())
+        self._data = memoryview(b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _iter_pieces(self, n_entries):
+        footer = bytearray(self.delta._view[-SECTOR_SIZE:])
+        if _footer.unpack_from(footer)[3] != SECTOR_SIZE or _footer.unpack_from(footer)[11] != DYNAMIC_DISK:
+            # Header right after the footer copy, dynamic disk without parent
+            struct.pack_into(">Q", footer, 16, SECTOR_SIZE)
+            struct.pack_into(">I", footer, 60, DYNAMIC_DISK)
+            struct.pack_into(">I", footer, 64, 0)
+            struct.pack_into(">I", footer, 64, _checksum(footer))
+        yield footer
+
+        header_offset = _footer.unpack_from(self.delta._view, len(self.delta._view) - SECTOR_SIZE)[3]
+        header = bytearray(self.delta._view[header_offset:header_offset + _header.size])
+        struct.pack_into(">Q", header, 16, 3 * SECTOR_SIZE)
+        struct.pack_into(">I", header, 28, n_entries)
+        # No parent
+        header[40:64] = bytes(24)
+        header[64:1024] = bytes(960)
+        struct.pack_into(">I", header, 36, 0)
+        struct.pack_into(">I", header, 36, _checksum(header))
+        yield header
+
+        bat = [UNUSED_ENTRY] * n_entries
+        sector = (3 * SECTOR_SIZE + self._bat_size) // SECTOR_SIZE
+        for block in self._allocated:
+            bat[block] = sector
+            sector += self._block_total // SECTOR_SIZE
+        yield struct.pack(">%dI" % n_entries, *bat) + b"\xff" * (self._bat_size - n_entries * _bat_entry.size)
+
+        for block in self._allocated:
+            bitmap, data = self._merge_block(block)
+            yield bitmap
+            yield data
+            self.blocks += 1
+
+        yield footer
+
+    def _merge_block(self, block):
+        delta_bitmap = self.delta.read_bitmap(block) if block < self.delta.max_table_entries else None
+        base_bitmap = self.base.read_bitmap(block) if block < self.base.max_table_entries else None
+        if delta_bitmap is None:
+            return base_bitmap, self.base.read_block(block)
+        self.delta_blocks += 1
+        if base_bitmap is None or delta_bitmap == self._full_bitmap:
+            return delta_bitmap, self.delta.read_block(block)
+
+        # Sectors of delta over the ones of base
+        bitmap = bytes(b | d for b, d in zip(base_bitmap, delta_bitmap))
+        data = bytearray(self.base.read_block(block))
+        delta_data = self.delta.read_block(block)
+        for byte, bits in enumerate(delta_bitmap):
+            for bit in range(8) if bits else ():
+                if bits & (0x80 >> bit):
+                    start = (byte * 8 + bit) * SECTOR_SIZE
+                    data[start:start + SECTOR_SIZE] = delta_data[start:start + SECTOR_SIZE]
+        return bitmap, data
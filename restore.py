@@ -1,8 +1,12 @@
 import logging
 from http.client import CannotSendRequest
 
+import yaml
+
 from handlers import vm
-from lib import XenAPI
+from handlers.inventory import Inventory, get_cache_file
+from lib import XenAPI, fileio, stream, vhd
+from lib.functions import get_master_url
 
 # def restore(name, master, username, password, vm_file, auto_start=False, restore=False,
 #             sr=None, sr_map=None, network_map=None, delta=False, base_folder="."):
@@ -78,7 +82,23 @@ def restore(args):
     if storage_map is not None:
         storage_map = dict(mapping.split("=") for mapping in storage_map)
 
-    master_url = "https://" + args.master
+    # The transfer settings of the config file apply to restores too, which can be run without it
+    try:
+        with open(args.config, "r") as config_file:
+            config = yaml.load(config_file) or {}
+    except FileNotFoundError:
+        config = {}
+    if "block_size" in config:
+        stream.default_block_size = config["block_size"]
+    if "pipeline_depth" in config:
+        stream.default_depth = config["pipeline_depth"]
+
+    if args.no_merge:
+        vhd.merge_restores = False
+    if args.io_mode is not None:
+        fileio.io_mode = args.io_mode
+
+    master_url = get_master_url(args.master)
 
     session = XenAPI.Session(master_url, ignore_ssl=True)
     try:
@@ -87,16 +107,21 @@ def restore(args):
         logger.error("Error logging in Xen host")
         raise e
     else:
+        xapi = Inventory(session.xenapi, cache_file=get_cache_file(args.cache_dir, args.master))
         try:
             if args.type == "delta":
                 vm.restore_delta(
-                    session.xenapi, master_url, session.handle,
+                    xapi, master_url, session.handle,
                     backup_file, backup_dir, sr_map=storage_map, network_map=network_map, restore=args.restore)
             else:
                 vm.restore(
-                    session.xenapi, master_url, session.handle,
+                    xapi, master_url, session.handle,
                     backup_file, sr_map=storage_map, restore=args.restore)
         finally:
+            try:
+                xapi.save()
+            except (OSError, XenAPI.Failure) as e:
+                logger.error("Error saving inventory cache: %s", str(e))
             try:
                 session.xenapi.session.logout()
             except (CannotSendRequest, XenAPI.Failure) as e:
@@ -36,6 +36,15 @@ if __name__ == "__main__":
             body = body + "Backup errors:" + os.linesep + "\t" + (os.linesep + "\t").join(
                 pool_errors["errors"]) + os.linesep
             body = body + "VMs export errors:" + os.linesep + "\t" + (os.linesep + "\t").join(pool_errors["vms"])
+            if pool_errors.get("reclaimed"):
+                body = body + os.linesep + "Space reclaimed by retention: {:.1f} GiB".format(
+                    pool_errors["reclaimed"] / 2 ** 30) + os.linesep
+            if pool_errors.get("rpc_stats"):
+                body = body + os.linesep + "Slowest XenAPI calls (calls, total s, p95 s):" + os.linesep
+                for method, stats in list(pool_errors["rpc_stats"].items())[:10]:
+                    body = body + "\t{} {} {:.3f} {:.3f}".format(
+                        method, stats["calls"], stats["total_time"], stats["p95"]) + os.linesep
+            body = body + os.linesep
 
     # Create a text/plain message
     msg = EmailMessage()
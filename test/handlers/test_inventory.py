@@ -0,0 +1,158 @@
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from xmlrpc.client import DateTime
+
+from handlers.inventory import Inventory
+from handlers.vm import VM, get_all_vm_refs
+
+
+class FakeClass(object):
+    def __init__(self, xapi, records):
+        self.xapi = xapi
+        self.records = records
+
+    def __getattr__(self, method):
+        def call(*params):
+            self.xapi.calls.append(method)
+            if method == "get_all_records":
+                return {ref: dict(record) for ref, record in self.records.items()}
+            if method == "get_record":
+                return dict(self.records[params[0]])
+            if method.startswith("get_"):
+                return self.records[params[0]][method[4:]]
+            if method.startswith("set_"):
+                self.records[params[0]][method[4:]] = params[1]
+            if method == "snapshot":
+                ref = "OpaqueRef:snap"
+                self.records[ref] = dict(self.records[params[0]], uuid="snap", name_label=params[1],
+                                         is_a_snapshot=True, snapshot_of=params[0])
+                self.records[params[0]]["snapshots"] = [ref]
+                return ref
+
+        return call
+
+
+class FakeEvent(object):
+    def __init__(self, xapi):
+        self.xapi = xapi
+        self.pending = []
+
+    def __getattr__(self, method):
+        def event_from(classes, token, timeout):
+            self.xapi.calls.append("event.from")
+            if token == "":
+                events = [{"class": "vm", "operation": "add", "ref": ref, "snapshot": dict(record)}
+                          for ref, record in self.xapi.VM.records.items()]
+            else:
+                events, self.pending = self.pending, []
+            return {"events": events, "token": str(int(token or 0) + 1), "valid_ref_counts": {}}
+
+        assert method == "from"
+        return event_from
+
+
+class FakeXapi(object):
+    def __init__(self, vms):
+        self.calls = []
+        self.VM = FakeClass(self, vms)
+        self.event = FakeEvent(self)
+
+
+def vm_record(uuid, label, snapshot=False, template=False, control_domain=False):
+    return {"uuid": uuid, "name_label": label, "is_a_snapshot": snapshot, "is_a_template": template,
+            "is_control_domain": control_domain, "snapshots": [], "snapshot_of": "OpaqueRef:NULL"}
+
+
+class TestInventory(TestCase):
+    def setUp(self):
+        self.xapi = FakeXapi({
+            "OpaqueRef:vm%d" % i: vm_record("uuid-%d" % i, "vm %d" % i) for i in range(10)
+        })
+        self.xapi.VM.records["OpaqueRef:dom0"] = vm_record("dom0", "Control domain", control_domain=True)
+        self.inventory = Inventory(self.xapi)
+
+    def test_getters_use_single_load(self):
+        vm_refs = get_all_vm_refs(self.inventory)
+        self.assertEqual(len(vm_refs), 10)
+        for vm_ref in vm_refs:
+            vm = VM(self.inventory, None, None, vm_ref)
+            vm.get_label()
+            vm.get_uuid()
+            vm.is_snapshot()
+        self.assertEqual(self.inventory.VM.get_by_uuid("uuid-3"), "OpaqueRef:vm3")
+        self.assertEqual(self.inventory.VM.get_by_name_label("vm 4"), ["OpaqueRef:vm4"])
+        self.assertEqual(self.xapi.calls, ["get_all_records"])
+        self.assertEqual(self.inventory.stats, {"hits": 30, "misses": 0})
+
+    def test_setter_write_through(self):
+        self.inventory.load(["VM"])
+        vm = VM(self.inventory, None, None, "OpaqueRef:vm1")
+        vm.set_name("renamed")
+        self.assertEqual(vm.get_label(), "renamed")
+        self.assertEqual(self.inventory.VM.get_by_name_label("renamed"), ["OpaqueRef:vm1"])
+        self.assertEqual(self.inventory.VM.get_by_name_label("vm 1"), [])
+        self.assertEqual(self.xapi.calls, ["get_all_records", "set_name_label"])
+
+    def test_power_actions_invalidate(self):
+        self.xapi.VM.records["OpaqueRef:vm1"]["power_state"] = "Running"
+        vm = VM(self.inventory, None, None, "OpaqueRef:vm1")
+        self.assertTrue(vm.is_running())
+        vm.shutdown()
+        self.xapi.VM.records["OpaqueRef:vm1"]["power_state"] = "Halted"
+        self.assertEqual(vm.get_power_state(), "Halted")
+        self.assertEqual(self.xapi.calls, ["get_all_records", "shutdown", "get_record"])
+
+    def test_mutation_invalidates(self):
+        vm = VM(self.inventory, None, None, "OpaqueRef:vm1")
+        snap = vm.snapshot("snap")
+        self.assertEqual([s.ref for s in vm.get_snapshots()], [snap.ref])
+        self.assertEqual(snap.get_snapshot_of().ref, vm.ref)
+        self.assertIn(snap.ref, self.inventory.VM.get_all())
+
+    def test_calls_outside_lock(self):
+        self.inventory.load(["VM"])
+        self.inventory.invalidate("OpaqueRef:vm1", False)
+        fetching, release = threading.Event(), threading.Event()
+        released = []
+        get_record = self.xapi.VM.get_record
+
+        def slow_get_record(ref):
+            fetching.set()
+            released.append(release.wait(5))
+            return get_record(ref)
+
+        self.xapi.VM.get_record = slow_get_record
+        fetch = threading.Thread(target=self.inventory.VM.get_name_label, args=("OpaqueRef:vm1",))
+        fetch.start()
+        self.assertTrue(fetching.wait(5))
+        # Served while the other thread waits for the master
+        self.assertEqual(self.inventory.VM.get_name_label("OpaqueRef:vm2"), "vm 2")
+        release.set()
+        fetch.join()
+        self.assertEqual(released, [True])
+
+    def test_unlabelled_records(self):
+        self.xapi.VBD = FakeClass(self.xapi, {"OpaqueRef:vbd": {"uuid": "vbd", "VM": "OpaqueRef:vm1"}})
+        self.assertEqual(self.inventory.VBD.get_by_uuid("vbd"), "OpaqueRef:vbd")
+        self.assertEqual(self.inventory.VBD.get_VM("OpaqueRef:vbd"), "OpaqueRef:vm1")
+
+    def test_persistent_cache(self):
+        self.xapi.VM.records["OpaqueRef:vm1"]["snapshot_time"] = DateTime("20200101T00:00:00Z")
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_file = os.path.join(cache_dir, "inventory.json")
+            inventory = Inventory(self.xapi, ["VM"], cache_file)
+            self.assertEqual(len(get_all_vm_refs(inventory)), 10)
+            inventory.save()
+            self.assertEqual(self.xapi.calls, ["event.from", "event.from"])
+
+            self.xapi.calls = []
+            record = dict(self.xapi.VM.records["OpaqueRef:vm2"], name_label="changed")
+            self.xapi.event.pending = [{"class": "vm", "operation": "mod", "ref": "OpaqueRef:vm2", "snapshot": record},
+                                       {"class": "vm", "operation": "del", "ref": "OpaqueRef:vm3", "snapshot": {}}]
+            inventory = Inventory(self.xapi, ["VM"], cache_file)
+            self.assertEqual(VM(inventory, None, None, "OpaqueRef:vm2").get_label(), "changed")
+            self.assertNotIn("OpaqueRef:vm3", inventory.VM.get_all())
+            self.assertEqual(inventory.VM.get_snapshot_time("OpaqueRef:vm1").value, "20200101T00:00:00Z")
+            self.assertEqual(self.xapi.calls, ["event.from"])
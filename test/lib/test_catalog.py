@@ -0,0 +1,140 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from lib.catalog import Catalog
+
+
+class TestCatalog(TestCase):
+    def setUp(self):
+        self.base_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_folder)
+        os.makedirs(os.path.join(self.base_folder, "vm_1234", "vdi_a"))
+
+    def write_file(self, path, size=100):
+        with open(os.path.join(self.base_folder, path), "wb") as out_file:
+            out_file.write(bytes(size))
+
+    def add_backup(self, backup_catalog, timestamp, base=None):
+        """Delta backup of a VM with one VDI, a base backup without base."""
+        vdi_record = {"backup_file": "vm_1234/vdi_a/{}_{}.vhd".format(timestamp, "delta" if base else "full"),
+                      "checksum": {"digest": "ab" + timestamp}}
+        if base is not None:
+            vdi_record["backup_base_file"] = "vm_1234/vdi_a/{}_full.vhd".format(base)
+        self.write_file(vdi_record["backup_file"], 1000 if base is None else 10)
+        backup_catalog.add_vdi_backup(vdi_record)
+        vm_def_file = os.path.join(self.base_folder, "vm_1234", timestamp + ".json")
+        vm_definition = {"vm": {"name_label": "test vm - backup " + timestamp}, "vdis": {"OpaqueRef:a": vdi_record}}
+        with open(vm_def_file + ".tmp", "w") as def_file:
+            json.dump(vm_definition, def_file)
+        backup_catalog.add_definition(vm_def_file, vm_definition, vm_def_file + ".tmp")
+
+    def test_restore_points(self):
+        with Catalog(self.base_folder) as backup_catalog:
+            self.add_backup(backup_catalog, "20200101T000000")
+            self.add_backup(backup_catalog, "20200102T000000", "20200101T000000")
+            self.add_backup(backup_catalog, "20200103T000000", "20200101T000000")
+            xva_file = os.path.join(self.base_folder, "1234__20200104T000000__test_vm.xva")
+            self.write_file(xva_file, 500)
+            backup_catalog.add_full_backup(xva_file)
+
+            restore_points = backup_catalog.get_restore_points("1234")
+            self.assertEqual([(point["timestamp"], point["type"], point["size"]) for point in restore_points],
+                             [("20200101T000000", "delta", 1000), ("20200102T000000", "delta", 1010),
+                              ("20200103T000000", "delta", 1010), ("20200104T000000", "full", 500)])
+            self.assertEqual(restore_points[1]["vm_name"], "test vm")
+            self.assertTrue(os.path.exists(os.path.join(self.base_folder, restore_points[1]["path"])))
+            self.assertEqual([point["timestamp"] for point in backup_catalog.get_restore_points(
+                "1234", "delta", "20200103T000000")], ["20200101T000000", "20200102T000000"])
+            self.assertEqual([f["digest"] for f in backup_catalog.get_files(restore_points[2]["path"])],
+                             ["ab20200101T000000", "ab20200103T000000"])
+
+            # The base stays while used by a delta
+            for point in restore_points[:2]:
+                backup_catalog.remove_restore_point(point["path"])
+            self.assertEqual(backup_catalog.get_unused_files("1234"), ["vm_1234/vdi_a/20200102T000000_delta.vhd"])
+
+    def test_index_vm_dir(self):
+        with Catalog(self.base_folder) as backup_catalog:
+            self.add_backup(backup_catalog, "20200101T000000")
+            self.add_backup(backup_catalog, "20200102T000000", "20200101T000000")
+        self.write_file("vm_1234/vdi_a/20200103T000000_delta.vhd")
+        os.remove(os.path.join(self.base_folder, "catalog.db"))
+
+        with Catalog(self.base_folder) as backup_catalog:
+            backup_catalog.index_vm_dir("vm_1234")
+            self.assertEqual([point["timestamp"] for point in backup_catalog.get_restore_points("1234")],
+                             ["20200101T000000", "20200102T000000"])
+            self.assertEqual(backup_catalog.get_unused_files("1234"), ["vm_1234/vdi_a/20200103T000000_delta.vhd"])
+
+    def test_sync(self):
+        with Catalog(self.base_folder) as backup_catalog:
+            self.add_backup(backup_catalog, "20200101T000000")
+            self.add_backup(backup_catalog, "20200102T000000", "20200101T000000")
+            backup_catalog.sync()
+
+            os.remove(os.path.join(self.base_folder, "vm_1234", "20200102T000000.json"))
+            os.makedirs(os.path.join(self.base_folder, "vm_5678"))
+            with open(os.path.join(self.base_folder, "vm_5678", "20200103T000000.json"), "w") as def_file:
+                json.dump({"vm": {"name_label": "other vm - backup 20200103T000000"}, "vdis": {}}, def_file)
+            self.write_file("5678__20200104T000000__other_vm.xva", 500)
+            backup_catalog.sync()
+
+            self.assertEqual([point["timestamp"] for point in backup_catalog.get_restore_points("1234")],
+                             ["20200101T000000"])
+            self.assertEqual([(point["timestamp"], point["type"]) for point in backup_catalog.get_restore_points(
+                "5678")], [("20200103T000000", "delta"), ("20200104T000000", "full")])
+            self.assertEqual(backup_catalog.get_latest_restore_point("5678", "20200104T000000")["timestamp"],
+                             "20200103T000000")
+
+            shutil.rmtree(os.path.join(self.base_folder, "vm_1234"))
+            backup_catalog.sync()
+            self.assertEqual(backup_catalog.get_restore_points("1234"), [])
+            self.assertEqual(backup_catalog.get_total_size(), 500)
+
+    def test_index_skips_unreadable_definitions(self):
+        with Catalog(self.base_folder) as backup_catalog:
+            self.add_backup(backup_catalog, "20200101T000000")
+        os.remove(os.path.join(self.base_folder, "catalog.db"))
+        with open(os.path.join(self.base_folder, "vm_1234", "20200102T000000.json"), "w") as def_file:
+            json.dump({"vdis": {}}, def_file)
+        with open(os.path.join(self.base_folder, "vm_1234", "20200103T000000.json"), "w") as def_file:
+            def_file.write("{")
+
+        with Catalog(self.base_folder) as backup_catalog:
+            backup_catalog.index_vm_dir("vm_1234")
+            self.assertEqual([point["timestamp"] for point in backup_catalog.get_restore_points("1234")],
+                             ["20200101T000000"])
+
+    def test_unreadable_definition_keeps_files(self):
+        with Catalog(self.base_folder) as backup_catalog:
+            self.add_backup(backup_catalog, "20200101T000000")
+        self.write_file("vm_1234/vdi_a/20200102T000000_delta.vhd")
+        with open(os.path.join(self.base_folder, "vm_1234", "20200102T000000.json"), "w") as def_file:
+            def_file.write('{"vdis": {"OpaqueRef:a": {"backup_file": "vm_1234/vdi_a/2020')
+        os.remove(os.path.join(self.base_folder, "catalog.db"))
+
+        with Catalog(self.base_folder) as backup_catalog:
+            backup_catalog.sync_vm_dir("vm_1234")
+            self.assertEqual(backup_catalog.get_unused_files("1234"), [])
+            backup_catalog.sync_vm_dir("vm_1234")
+            self.assertEqual(backup_catalog.get_unused_files("1234"), [])
+
+            os.remove(os.path.join(self.base_folder, "vm_1234", "20200102T000000.json"))
+            backup_catalog.sync_vm_dir("vm_1234")
+            self.assertEqual(backup_catalog.get_unused_files("1234"), ["vm_1234/vdi_a/20200102T000000_delta.vhd"])
+
+    def test_sync_full_backups(self):
+        with Catalog(self.base_folder) as backup_catalog:
+            self.write_file("1234__20200101T000000__test_vm.xva", 500)
+            backup_catalog.sync_full_backups("1234")
+            self.write_file("1234__20200102T000000__test_vm.xva", 500)
+            self.write_file("5678__20200102T000000__other_vm.xva", 500)
+            os.remove(os.path.join(self.base_folder, "1234__20200101T000000__test_vm.xva"))
+            backup_catalog.sync_full_backups("1234")
+
+            self.assertEqual([point["path"] for point in backup_catalog.get_restore_points(backup_type="full")],
+                             ["1234__20200102T000000__test_vm.xva"])
+            self.assertEqual(backup_catalog.get_total_size(), 500)
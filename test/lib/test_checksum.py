@@ -0,0 +1,53 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from lib import checksum
+from lib.checksum import HashingWriter
+
+
+class TestChecksum(TestCase):
+    def setUp(self):
+        fd, self.file_name = tempfile.mkstemp()
+        os.close(fd)
+        self.data = os.urandom(10 * 2 ** 20 + 1234)
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def write(self, data, rewrite=None):
+        with open(self.file_name, "wb", 0) as out_file:
+            writer = HashingWriter(out_file, hash_block_size=2 ** 20)
+            for offset in range(0, len(data), 100000):
+                writer.write(data[offset:offset + 100000])
+            if rewrite is not None:
+                writer.seek(rewrite[0])
+                writer.write(rewrite[1])
+                writer.seek(0, 2)
+        return writer.get_checksum()
+
+    def test_verify(self):
+        file_checksum = self.write(self.data)
+        self.assertEqual(file_checksum["size"], len(self.data))
+        self.assertEqual(checksum.verify_file(self.file_name, file_checksum, 3), [])
+
+        with open(self.file_name, "r+b") as in_file:
+            in_file.seek(3 * 2 ** 20 + 5)
+            in_file.write(b"x")
+        self.assertEqual(checksum.verify_file(self.file_name, file_checksum), ["checksum mismatch"])
+
+    def test_block_digests(self):
+        checksum.store_blocks = True
+        self.addCleanup(setattr, checksum, "store_blocks", False)
+        file_checksum = self.write(self.data)
+        self.assertEqual(len(file_checksum["blocks"]), 11)
+
+        with open(self.file_name, "r+b") as in_file:
+            in_file.seek(3 * 2 ** 20 + 5)
+            in_file.write(b"x")
+        self.assertEqual(checksum.verify_file(self.file_name, file_checksum),
+                         ["block 3 (offset {}) corrupted".format(3 * 2 ** 20)])
+
+    def test_rewrite(self):
+        file_checksum = self.write(self.data, (2 ** 20 - 10, b"y" * 20))
+        self.assertEqual(checksum.verify_file(self.file_name, file_checksum), [])
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from lib import chunkstore
+from lib.chunkstore import ChunkStore, ChunkWriter, ManifestReader
+
+
+class TestChunkStore(TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.store = ChunkStore(os.path.join(self.base_dir, "chunks"))
+        self.addCleanup(self.store.close)
+        self.data = os.urandom(2 * 2 ** 20) + bytes(2 ** 20) + os.urandom(2 ** 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def write(self, data, name):
+        writer = ChunkWriter(self.store)
+        for offset in range(0, len(data), 300000):
+            writer.write(data[offset:offset + 300000])
+        manifest_file = os.path.join(self.base_dir, name + ".vhd.chunks")
+        chunkstore.write_manifest(manifest_file, self.store, writer.close())
+        return manifest_file, writer
+
+    def read(self, manifest_file):
+        manifest = chunkstore.read_manifest(manifest_file)
+        reader = ManifestReader(self.store, manifest)
+        data = bytearray()
+        buffer = bytearray(100000)
+        read = reader.readinto(buffer)
+        while read:
+            data += buffer[:read]
+            read = reader.readinto(buffer)
+        return bytes(data)
+
+    def test_chunk_sizes(self):
+        manifest_file, writer = self.write(self.data, "a")
+        sizes = [size for _, size in chunkstore.read_manifest(manifest_file)["chunks"]]
+        self.assertEqual(sum(sizes), len(self.data))
+        self.assertTrue(all(chunkstore.min_size <= size <= chunkstore.max_size for size in sizes[:-1]))
+        # The zero filled MiB is stored once
+        self.assertLessEqual(writer.stored_size, len(self.data) - 2 ** 20 + chunkstore.max_size * 2)
+
+    def test_shifted_data_deduplicated(self):
+        manifest_a, writer_a = self.write(self.data, "a")
+        manifest_b, writer_b = self.write(os.urandom(1000) + self.data[:3000000] + self.data[3000100:], "b")
+        self.assertLess(writer_b.stored_size, 4 * chunkstore.max_size)
+        self.assertEqual(self.read(manifest_a), self.data)
+        self.assertEqual(self.read(manifest_b)[1000:3001000], self.data[:3000000])
+
+    def test_release(self):
+        manifest_a, _ = self.write(self.data, "a")
+        manifest_b, _ = self.write(self.data[:2 ** 20], "b")
+        chunks = self.store.get_stats()["chunks"]
+
+        chunkstore.remove_manifest(manifest_a)
+        self.assertFalse(os.path.exists(manifest_a))
+        self.assertLess(self.store.get_stats()["chunks"], chunks)
+        self.assertEqual(self.read(manifest_b), self.data[:2 ** 20])
+
+        chunkstore.remove_manifest(manifest_b)
+        self.assertEqual(self.store.get_stats(), {"chunks": 0, "size": 0, "references": 0})
+        self.assertEqual([files for path, _, files in os.walk(self.store.root) if path != self.store.root and files], [])
+
+    def test_release_while_added(self):
+        manifest_file, _ = self.write(self.data[:2 ** 20], "a")
+        chunks = [(bytes.fromhex(digest), size) for digest, size in chunkstore.read_manifest(manifest_file)["chunks"]]
+        rename = os.rename
+
+        def add_then_rename(src, dst):
+            # An export adds the first chunk again, between the release and the deletion of its file
+            if src == self.store.get_chunk_file(chunks[0][0]):
+                with ChunkStore(self.store.root) as other_store:
+                    other_store.add([(chunks[0][0], self.data[:chunks[0][1]])])
+            rename(src, dst)
+
+        with mock.patch("os.rename", side_effect=add_then_rename):
+            chunkstore.remove_manifest(manifest_file)
+        self.assertEqual(self.store.get_stats()["chunks"], 1)
+        self.assertEqual(self.store.read(chunks[0][0]), self.data[:chunks[0][1]])
+        self.assertEqual(sorted(name for _, _, files in os.walk(self.store.root) for name in files), sorted(
+            ["index.db", os.path.basename(self.store.get_chunk_file(chunks[0][0]))]))
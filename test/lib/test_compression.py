@@ -0,0 +1,65 @@
+import gzip
+import io
+import os
+import tempfile
+import zlib
+from unittest import TestCase, skipIf
+
+from lib import compression
+from lib.compression import CompressedWriter, DecompressingReader, GzipWriter, ZstdReader, ZstdWriter
+
+
+class TestCompression(TestCase):
+    def setUp(self):
+        self.data = (os.urandom(1000) + bytes(3000)) * 3000
+        fd, self.file_name = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def test_round_trip(self):
+        for codec_name in compression.codecs:
+            with open(self.file_name, "wb") as out_file, CompressedWriter(out_file, codec_name, 3) as writer:
+                for offset in range(0, len(self.data), 100000):
+                    writer.write(memoryview(self.data)[offset:offset + 100000])
+            self.assertEqual(writer.raw_size, len(self.data))
+            self.assertLess(writer.get_ratio(), 0.5)
+            self.assertTrue(compression.is_compressed(self.file_name))
+            self.assertEqual(DecompressingReader.get_raw_size(self.file_name), len(self.data))
+
+            with open(self.file_name, "rb") as in_file, DecompressingReader(in_file, 3) as reader:
+                data = bytearray()
+                buffer = bytearray(300000)
+                read = reader.readinto(buffer)
+                while read:
+                    data += buffer[:read]
+                    read = reader.readinto(buffer)
+            self.assertEqual(data, self.data)
+
+    def test_unavailable_codec(self):
+        self.assertEqual(compression.get_codec("unknown").name, "zlib")
+        with self.assertRaises(ValueError):
+            DecompressingReader(io.BytesIO(compression.magic + b"\x07unknown"))
+
+    def test_gzip_writer(self):
+        with open(self.file_name, "wb") as out_file, GzipWriter(out_file, workers=3) as writer:
+            for offset in range(0, len(self.data), 1000000):
+                writer.write(self.data[offset:offset + 1000000])
+        self.assertLess(writer.get_ratio(), 0.5)
+        with open(self.file_name, "rb") as in_file:
+            decompressor = zlib.decompressobj(31)
+            self.assertEqual(decompressor.decompress(in_file.read()), self.data)
+            # A single gzip member
+            self.assertTrue(decompressor.eof)
+            self.assertEqual(decompressor.unused_data, b"")
+        with gzip.open(self.file_name) as in_file:
+            self.assertEqual(in_file.read(), self.data)
+
+    @skipIf(compression.zstandard is None, "zstandard not installed")
+    def test_zstd_writer(self):
+        with open(self.file_name, "wb") as out_file, ZstdWriter(out_file, workers=3) as writer:
+            writer.write(self.data)
+        self.assertEqual(ZstdReader.get_raw_size(self.file_name), len(self.data))
+        with open(self.file_name, "rb") as in_file, ZstdReader(in_file) as reader:
+            self.assertEqual(reader.read(), self.data)
@@ -0,0 +1,58 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from lib import fileio
+
+
+class TestFileIO(TestCase):
+    def setUp(self):
+        fd, self.file_name = tempfile.mkstemp()
+        os.close(fd)
+        self.data = os.urandom(3 * 2 ** 20 + 1234)
+        for setting in ("io_mode", "writeback_size", "_direct_buffer_size"):
+            self.addCleanup(setattr, fileio, setting, getattr(fileio, setting))
+        fileio.writeback_size = 2 ** 20
+        fileio._direct_buffer_size = 256 * 2 ** 10
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def write(self, io_mode, rewrite=None, truncate=None):
+        fileio.io_mode = io_mode
+        with fileio.open_output(self.file_name) as out_file:
+            for offset in range(0, len(self.data), 100003):
+                out_file.write(self.data[offset:offset + 100003])
+            if rewrite is not None:
+                out_file.seek(rewrite[0])
+                out_file.write(rewrite[1])
+                out_file.seek(0, 2)
+            if truncate is not None:
+                out_file.truncate(truncate)
+
+    def read(self):
+        with fileio.open_input(self.file_name) as in_file:
+            return in_file.read()
+
+    def test_write_read(self):
+        for io_mode in ("buffered", "dontneed", "direct"):
+            with self.subTest(io_mode=io_mode):
+                self.write(io_mode)
+                self.assertEqual(self.read(), self.data)
+
+    def test_rewrite(self):
+        # Data written by DirectFile, still buffered and across the two
+        flushed = len(self.data) - len(self.data) % fileio._direct_buffer_size
+        for offset in (1000, len(self.data) - 100, flushed - 50):
+            expected = bytearray(self.data)
+            expected[offset:offset + 100] = b"x" * 100
+            for io_mode in ("dontneed", "direct"):
+                with self.subTest(io_mode=io_mode, offset=offset):
+                    self.write(io_mode, rewrite=(offset, b"x" * 100))
+                    self.assertEqual(self.read(), expected)
+
+    def test_truncate(self):
+        for io_mode in ("dontneed", "direct"):
+            with self.subTest(io_mode=io_mode):
+                self.write(io_mode, truncate=len(self.data) - 5000)
+                self.assertEqual(self.read(), self.data[:-5000])
@@ -1,6 +1,9 @@
 import os
 import re
-from unittest import TestCase
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase, mock
 
 import yaml
 
@@ -16,6 +19,21 @@ class TestRandomXenMac(TestCase):
         assert re.match("^([a-z0-9]{2}:){5}[a-z0-9]{2}$", random_mac)
 
 
+class TestVmDefinitionCatalogError(TestCase):
+    def test_definition_kept(self):
+        base_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_folder)
+        os.makedirs(os.path.join(base_folder, "vm_1234"))
+        vm_definition = {"vm": {"name_label": "test vm - backup 20200101T000000"}, "vdis": {}}
+
+        with mock.patch("lib.catalog.Catalog.add_definition", side_effect=sqlite3.OperationalError("locked")):
+            with self.assertRaises(sqlite3.OperationalError):
+                vm_definition_to_file(vm_definition, base_folder, "vm_1234", "20200101T000000")
+        self.assertEqual(os.listdir(os.path.join(base_folder, "vm_1234")), ["20200101T000000.json"])
+        self.assertEqual(vm_definition_from_file(os.path.join(base_folder, "vm_1234", "20200101T000000.json")),
+                         vm_definition)
+
+
 class TestVmDefinitionHandling(TestCase):
     def setUp(self):
         test_folder = os.path.normpath(os.path.join(os.path.realpath(__file__), "../.."))
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+from lib import retention
+from lib.catalog import Catalog
+
+
+class TestDeleter(TestCase):
+    def setUp(self):
+        self.base_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_folder)
+        self.paths = []
+        for name in ("a.vhd", "b.vhd", "c.xva"):
+            with open(os.path.join(self.base_folder, name), "wb") as backup_file:
+                backup_file.write(os.urandom(3 * 4096))
+            self.paths.append(name)
+        with open(os.path.join(self.base_folder, "c.xva.checksum"), "w") as sidecar_file:
+            sidecar_file.write("{}")
+
+    def get_files(self):
+        return sorted(name for name in os.listdir(self.base_folder) if not name.startswith("catalog.db"))
+
+    def test_delete_queued(self):
+        with Catalog(self.base_folder) as backup_catalog:
+            backup_catalog.queue_deletion(self.paths[:2])
+            with retention.Deleter(self.base_folder) as deleter:
+                backup_catalog.queue_deletion(self.paths[2:])
+                deleter.wake()
+            self.assertEqual(self.get_files(), [])
+            self.assertEqual(backup_catalog.get_deletions(), [])
+            self.assertEqual(deleter.deleted, 3)
+            self.assertGreaterEqual(deleter.reclaimed, 9 * 4096)
+
+    def test_failed_deletion_stays_queued(self):
+        with Catalog(self.base_folder) as backup_catalog:
+            backup_catalog.queue_deletion(self.paths)
+            with mock.patch("os.remove", side_effect=PermissionError("denied")):
+                retention.Deleter(self.base_folder).start().stop()
+            self.assertEqual(backup_catalog.get_deletions(), self.paths)
+
+            # Deleted by the next run
+            retention.Deleter(self.base_folder).start().stop()
+            self.assertEqual(self.get_files(), [])
+
+    def test_truncate(self):
+        file_name = os.path.join(self.base_folder, self.paths[0])
+        sizes = []
+        with mock.patch.object(retention, "truncate_step", 4096), \
+                mock.patch("os.ftruncate", side_effect=lambda fd, size: sizes.append(size)):
+            retention.truncate(file_name)
+        self.assertEqual(sizes, [2 * 4096, 4096])
+
+    def test_truncate_aborted(self):
+        file_name = os.path.join(self.base_folder, self.paths[0])
+        abort = threading.Event()
+        sizes = []
+
+        def ftruncate(fd, size):
+            sizes.append(size)
+            abort.set()
+
+        with mock.patch.object(retention, "truncate_step", 4096), mock.patch("os.ftruncate", side_effect=ftruncate):
+            self.assertIsNone(retention.remove_file(file_name, abort))
+        self.assertEqual(sizes, [2 * 4096])
+        self.assertTrue(os.path.exists(file_name))
+
+    def test_remove_file_at_once(self):
+        file_name = os.path.join(self.base_folder, self.paths[0])
+        with mock.patch.object(retention, "truncate_step", 4096), mock.patch("os.ftruncate") as ftruncate:
+            self.assertGreater(retention.remove_file(file_name, gradual=False), 0)
+        ftruncate.assert_not_called()
+        self.assertFalse(os.path.exists(file_name))
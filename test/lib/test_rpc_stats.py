@@ -0,0 +1,29 @@
+import json
+from unittest import TestCase
+
+from lib.rpc_stats import RpcStats
+
+
+class TestRpcStats(TestCase):
+    def test_record(self):
+        stats = RpcStats()
+        for i in range(100):
+            stats.record("VM.get_record", 0.010 if i < 90 else 1.0, sent_bytes=10, received_bytes=100)
+        stats.record("VM.snapshot", 5.0, retries=1)
+
+        result = json.loads(stats.to_json())
+        self.assertEqual(list(result.keys()), ["VM.get_record", "VM.snapshot"])
+        get_record = result["VM.get_record"]
+        self.assertEqual(get_record["calls"], 100)
+        self.assertAlmostEqual(get_record["total_time"], 90 * 0.010 + 10 * 1.0)
+        self.assertTrue(0.010 <= get_record["p50"] < 0.015)
+        self.assertTrue(1.0 <= get_record["p95"] < 1.5)
+        self.assertEqual((get_record["sent_bytes"], get_record["received_bytes"]), (1000, 10000))
+        self.assertEqual(result["VM.snapshot"]["session_retries"], 1)
+        self.assertEqual(stats.total_calls(), 101)
+
+    def test_overflow_percentile(self):
+        stats = RpcStats()
+        for latency in (1000.0, 1200.0, 0.5):
+            stats.record("VM.clean_shutdown", latency)
+        self.assertEqual(stats.to_dict()["VM.clean_shutdown"]["p99"], 1200.0)
@@ -0,0 +1,72 @@
+import os
+import signal
+import threading
+import time
+from unittest import TestCase
+
+from lib.scheduler import Scheduler
+
+
+class TestScheduler(TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.max_running = {}
+        self.order = []
+
+    def job(self, name, resources, duration=0.02):
+        def run(abort):
+            with self.lock:
+                self.order.append(name)
+                for resource in resources:
+                    self.running[resource] = self.running.get(resource, 0) + 1
+                    self.max_running[resource] = max(self.max_running.get(resource, 0), self.running[resource])
+            time.sleep(duration)
+            with self.lock:
+                for resource in resources:
+                    self.running[resource] -= 1
+
+        return resources, run
+
+    def test_limits(self):
+        jobs = [self.job(j, {("SR", j % 2), ("host", j % 3), ("pool", 0)}) for j in range(12)]
+        Scheduler(4, {"SR": 2, "host": 1}).run(jobs)
+        self.assertEqual(len(self.order), 12)
+        self.assertEqual(self.max_running[("pool", 0)], 3)
+        self.assertEqual(max(self.max_running[("SR", sr)] for sr in range(2)), 2)
+        self.assertEqual(max(self.max_running[("host", host)] for host in range(3)), 1)
+
+    def test_busy_resource_skipped(self):
+        jobs = [self.job("a", {("SR", 1)}, 0.1), self.job("b", {("SR", 1)}), self.job("c", {("SR", 2)})]
+        Scheduler(2, {"SR": 1}).run(jobs)
+        self.assertEqual(self.order, ["a", "c", "b"])
+
+    def test_error(self):
+        def fail(abort):
+            raise IOError("failed")
+
+        jobs = [({("SR", 1)}, fail)] + [self.job(j, {("SR", 1)}) for j in range(3)]
+        with self.assertRaises(IOError):
+            Scheduler(1).run(jobs)
+        self.assertEqual(self.order, [])
+
+    def test_interrupt(self):
+        def interrupt(*args):
+            raise SystemExit("interrupted")
+
+        self.addCleanup(signal.signal, signal.SIGUSR1, signal.signal(signal.SIGUSR1, interrupt))
+        aborted = []
+
+        def job(abort):
+            aborted.append(abort.wait(5))
+
+        def interrupting_job(abort):
+            os.kill(os.getpid(), signal.SIGUSR1)
+            job(abort)
+
+        jobs = [({("SR", 1)}, interrupting_job), ({("SR", 2)}, job), self.job("waiting", {("SR", 3)})]
+        with self.assertRaises(SystemExit):
+            Scheduler(2).run(jobs)
+        # The running jobs were aborted and waited for, the waiting one dropped
+        self.assertTrue(aborted and all(aborted))
+        self.assertEqual(self.order, [])
@@ -0,0 +1,66 @@
+import io
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from lib.stream import TransferStats, copy_stream, iter_file
+
+
+class TestStream(TestCase):
+    def setUp(self):
+        self.data = os.urandom(3 * 1024 + 5)
+        fd, self.file_name = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def test_copy(self):
+        with open(self.file_name, "wb", 0) as out_file:
+            self.assertEqual(copy_stream(io.BytesIO(self.data), out_file, block_size=1024), len(self.data))
+        with open(self.file_name, "rb") as in_file:
+            self.assertEqual(in_file.read(), self.data)
+
+    def test_copy_shorter_than_size(self):
+        with open(self.file_name, "wb", 0) as out_file:
+            copy_stream(io.BytesIO(self.data), out_file, len(self.data) * 2, block_size=1024)
+        self.assertEqual(os.path.getsize(self.file_name), len(self.data))
+
+    def test_abort(self):
+        abort = threading.Event()
+        abort.set()
+        with open(self.file_name, "wb", 0) as out_file, self.assertRaises(SystemExit):
+            copy_stream(io.BytesIO(self.data), out_file, abort=abort)
+
+    def test_lock_step_copy(self):
+        stats = TransferStats()
+        with open(self.file_name, "wb", 0) as out_file:
+            copy_stream(io.BytesIO(self.data), out_file, block_size=1024, depth=0, stats=stats)
+        with open(self.file_name, "rb") as in_file:
+            self.assertEqual(in_file.read(), self.data)
+        self.assertEqual(stats.blocks, 4)
+
+    def test_pipeline_stats(self):
+        stats = TransferStats()
+        with open(self.file_name, "wb", 0) as out_file:
+            copy_stream(io.BytesIO(self.data), out_file, block_size=1024, depth=2, stats=stats)
+        self.assertEqual(stats.bytes, len(self.data))
+        self.assertEqual(stats.blocks, 4)
+        self.assertLessEqual(stats.max_queued_blocks, 2)
+
+    def test_read_error(self):
+        class FailingReader(io.BytesIO):
+            def readinto(self, buffer):
+                if self.tell() > 0:
+                    raise ConnectionResetError("reset")
+                return super().readinto(buffer)
+
+        with open(self.file_name, "wb", 0) as out_file, self.assertRaises(ConnectionResetError):
+            copy_stream(FailingReader(self.data), out_file, block_size=1024)
+
+    def test_iter_file(self):
+        with open(self.file_name, "wb") as out_file:
+            out_file.write(self.data)
+        with open(self.file_name, "rb", 0) as in_file:
+            self.assertEqual(b"".join(bytes(block) for block in iter_file(in_file, 1024)), self.data)
@@ -0,0 +1,64 @@
+import io
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+from urllib.error import HTTPError
+
+from lib import upload
+
+
+class _PutHandler(BaseHTTPRequestHandler):
+    def do_PUT(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    break
+        else:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.uploads.append((self.path, self.headers.get("Transfer-Encoding"), body))
+        self.send_response(500 if self.path == "/fail" else 200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestUpload(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _PutHandler)
+        self.server.uploads = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.data = os.urandom(5 * 2 ** 20 + 123)
+
+    def test_put_stream(self):
+        upload.put_stream(self.url + "/import?task_id=1", io.BytesIO(self.data), len(self.data))
+        upload.put_stream(self.url + "/chunked", io.BytesIO(self.data))
+        self.assertEqual(self.server.uploads, [("/import?task_id=1", None, self.data),
+                                               ("/chunked", "chunked", self.data)])
+
+    def test_put_file(self):
+        fd, file_name = tempfile.mkstemp()
+        self.addCleanup(os.remove, file_name)
+        with os.fdopen(fd, "wb") as out_file:
+            out_file.write(self.data)
+        upload.put_file(self.url + "/file", file_name)
+        self.assertEqual(self.server.uploads, [("/file", None, self.data)])
+
+    def test_error_status(self):
+        with self.assertRaises(HTTPError) as error:
+            upload.put_stream(self.url + "/fail", io.BytesIO(b"data"), 4)
+        self.assertEqual(error.exception.code, 500)
+
+    def test_size_mismatch(self):
+        with self.assertRaises(IOError):
+            upload.put_stream(self.url + "/short", io.BytesIO(b"data"), 5)
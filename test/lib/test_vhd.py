@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from lib.simulator import XapiSimulator, BLOCK_SIZE
+from lib.vhd import VhdFile, MergedVhd, ZeroBlockFilter, DYNAMIC_DISK
+
+
+class TestVhd(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.simulator = XapiSimulator(zero_fraction=0.3, seed=3).start()
+        self.vdi_ref = self.simulator.add_vdi("disk", 20 * BLOCK_SIZE, fill=0.7)
+        self.blocks = self.simulator.get_vdi_blocks(self.vdi_ref)
+        self.raw = b"".join(self.simulator.vdi_stream(self.vdi_ref, "raw"))
+
+    def tearDown(self):
+        self.simulator.stop()
+        shutil.rmtree(self.work_dir)
+
+    def export(self, file_name, zero_filter=False, vdi_ref=None, base_ref=None):
+        file_name = os.path.join(self.work_dir, file_name)
+        with open(file_name, "wb") as out_file:
+            writer = ZeroBlockFilter(out_file) if zero_filter else out_file
+            for data in self.simulator.vdi_stream(vdi_ref or self.vdi_ref, "vhd", base_ref):
+                # Odd sizes to cross the structure boundaries
+                for offset in range(0, len(data), 100003):
+                    writer.write(data[offset:offset + 100003])
+            if zero_filter:
+                writer.close()
+        return file_name
+
+    def test_read(self):
+        with VhdFile(self.export("disk.vhd")) as vhd:
+            self.assertEqual(vhd.check(), [])
+            self.assertEqual(vhd.disk_type, DYNAMIC_DISK)
+            self.assertEqual(vhd.virtual_size, 20 * BLOCK_SIZE)
+            self.assertEqual(vhd.block_size, BLOCK_SIZE)
+            self.assertIsNone(vhd.parent_uuid)
+            self.assertEqual([block for block, _ in vhd.iter_allocated_blocks()], sorted(self.blocks))
+            block = min(self.blocks)
+            data = vhd.read_block(block)
+            self.assertIsInstance(data, memoryview)
+            self.assertEqual(data, self.raw[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE])
+            self.assertTrue(vhd.is_sector_present(block, 10))
+            self.assertIsNone(vhd.read_block(max(set(range(20)) - set(self.blocks))))
+            del data
+
+    def test_zero_block_filter(self):
+        zero_blocks = set(self.blocks) - set(self.simulator.get_vdi_blocks(self.vdi_ref, False))
+        self.assertTrue(zero_blocks)
+        with VhdFile(self.export("filtered.vhd", True)) as vhd:
+            self.assertEqual(vhd.check(), [])
+            self.assertEqual([block for block, _ in vhd.iter_allocated_blocks()], sorted(set(self.blocks) - zero_blocks))
+            for block, _ in vhd.iter_allocated_blocks():
+                self.assertEqual(vhd.read_block(block), self.raw[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE])
+
+    def test_check(self):
+        file_name = self.export("disk.vhd")
+        with open(file_name, "r+b") as vhd_file:
+            vhd_file.seek(-600, 2)
+            vhd_file.truncate()
+        with self.assertRaises(ValueError):
+            VhdFile(file_name).close()
+
+    def test_merge(self):
+        new_ref = self.simulator.add_vdi("new disk", 20 * BLOCK_SIZE, fill=1.0)
+        self.simulator.write_vdi(new_ref, [19])
+        base_file = self.export("base.vhd")
+        delta_file = self.export("delta.vhd", vdi_ref=new_ref, base_ref=self.vdi_ref)
+        new_raw = b"".join(self.simulator.vdi_stream(new_ref, "raw"))
+
+        # First half of the sectors of a block only in the delta
+        with VhdFile(delta_file) as delta:
+            partial_block, offset = next((block, offset) for block, offset in delta.iter_allocated_blocks()
+                                         if block in self.blocks)
+        with open(delta_file, "r+b") as vhd_file:
+            vhd_file.seek(offset + 256)
+            vhd_file.write(bytes(256))
+
+        merged_file = os.path.join(self.work_dir, "merged.vhd")
+        with VhdFile(base_file) as base, VhdFile(delta_file) as delta, MergedVhd(base, delta) as merged:
+            with open(merged_file, "wb") as out_file:
+                buffer = bytearray(1000000)
+                read = merged.readinto(buffer)
+                while read:
+                    out_file.write(buffer[:read])
+                    read = merged.readinto(buffer)
+            self.assertEqual(merged.size, os.path.getsize(merged_file))
+
+        with VhdFile(merged_file) as vhd:
+            self.assertEqual(vhd.check(), [])
+            self.assertEqual([block for block, _ in vhd.iter_allocated_blocks()], list(range(20)))
+            for block in range(20):
+                expected = new_raw[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE]
+                if block == partial_block:
+                    half = BLOCK_SIZE // 2
+                    expected = expected[:half] + self.raw[block * BLOCK_SIZE + half:(block + 1) * BLOCK_SIZE]
+                self.assertEqual(vhd.read_block(block), expected, block)
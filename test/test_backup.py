@@ -0,0 +1,341 @@
+import glob
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest import TestCase
+
+from backup import do_backup
+from clean import clean_all
+from handlers import host, vm
+from lib import XenAPI, chunkstore, compression, fileio, retention, vhd
+from lib.catalog import Catalog, get_vm_uuid
+from lib.chunkstore import ChunkStore
+from lib.functions import vm_definition_from_file
+from lib.simulator import XapiSimulator, BLOCK_SIZE
+from verify import verify_backups
+
+
+class TestSimulatedBackup(TestCase):
+    def setUp(self):
+        self.simulator = XapiSimulator().start()
+        self.vm_ref = self.simulator.add_vm("test vm", disks=[4 * BLOCK_SIZE, 2 * BLOCK_SIZE])
+        self.backup_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.simulator.stop()
+        shutil.rmtree(self.backup_dir)
+
+    def do_backup(self, delta, **kwargs):
+        return do_backup("Simulated pool", self.simulator.url, "root", "", delta, base_folder=self.backup_dir,
+                         backups_to_retain=2, **kwargs)
+
+    def login(self):
+        session = XenAPI.Session(self.simulator.url)
+        session.xenapi.login_with_password("root", "")
+        self.addCleanup(session.xenapi.session.logout)
+        return session
+
+    def get_vdi_blocks(self, vm_ref, zero_blocks=True):
+        vms = self.simulator.get_records("VM")
+        vbds = self.simulator.get_records("VBD")
+        vdis = self.simulator.get_records("VDI")
+        vdi_refs = sorted((vbds[vbd_ref]["VDI"] for vbd_ref in vms[vm_ref]["VBDs"]
+                           if vbds[vbd_ref]["VDI"] != "OpaqueRef:NULL"), key=lambda ref: vdis[ref]["virtual_size"])
+        return [self.simulator.get_vdi_blocks(vdi_ref, zero_blocks) for vdi_ref in vdi_refs]
+
+    def test_full_backup_restore(self):
+        status = self.do_backup(False)
+        self.assertEqual(status["failed_vms"], {})
+        xva_files = glob.glob(os.path.join(self.backup_dir, "*.xva"))
+        self.assertEqual(len(xva_files), 1)
+
+        session = self.login()
+        vm.restore(session.xenapi, self.simulator.url, session.handle, xva_files[0])
+        self.assertEqual(len(self.simulator.get_records("VM")), 3)
+        self.assertEqual(self.simulator.transfers["/import"], 1)
+
+    def test_locally_compressed_full_backup_restore(self):
+        compression.xva_compression = "gzip"
+        self.addCleanup(setattr, compression, "xva_compression", "host")
+
+        self.assertEqual(self.do_backup(False)["failed_vms"], {})
+        xva_files = glob.glob(os.path.join(self.backup_dir, "*.xva"))
+        self.assertEqual(len(xva_files), 1)
+        with tarfile.open(xva_files[0], "r:gz") as xva:
+            self.assertIn("ova.xml", xva.getnames())
+
+        session = self.login()
+        vm.restore(session.xenapi, self.simulator.url, session.handle, xva_files[0])
+        self.assertEqual(len(self.simulator.get_records("VM")), 3)
+
+    def test_delta_backup_restore(self):
+        self.assertEqual(self.do_backup(True)["failed_vms"], {})
+        disk_ref = self.simulator.get_records("VBD")[self.simulator.get_records("VM")[self.vm_ref]["VBDs"][0]]["VDI"]
+        self.simulator.write_vdi(disk_ref, [1])
+        self.assertEqual(self.do_backup(True)["failed_vms"], {})
+
+        vm_back_dir = os.path.join(self.backup_dir, "vm_" + self.simulator.get_records("VM")[self.vm_ref]["uuid"])
+        vm_def_files = sorted(glob.glob(os.path.join(vm_back_dir, "*.json")))
+        self.assertEqual(len(vm_def_files), 2)
+        self.assertEqual(len(glob.glob(os.path.join(vm_back_dir, "*", "*_delta.vhd"))), 2)
+
+        session = self.login()
+        restored_ref = vm.restore_delta(
+            session.xenapi, self.simulator.url, session.handle, vm_def_files[-1], self.backup_dir)
+        self.assertEqual(self.get_vdi_blocks(restored_ref), self.get_vdi_blocks(self.vm_ref))
+        # Base and delta merged in a single upload per VDI
+        self.assertEqual(self.simulator.transfers["/import_raw_vdi"], 2)
+
+        vhd.merge_restores = False
+        self.addCleanup(setattr, vhd, "merge_restores", True)
+        restored_ref = vm.restore_delta(
+            session.xenapi, self.simulator.url, session.handle, vm_def_files[-1], self.backup_dir)
+        self.assertEqual(self.get_vdi_blocks(restored_ref), self.get_vdi_blocks(self.vm_ref))
+        self.assertEqual(self.simulator.transfers["/import_raw_vdi"], 6)
+
+    def test_zero_blocks_dropped(self):
+        self.simulator.zero_fraction = 0.5
+        vm_ref = self.simulator.add_vm("sparse vm", disks=[16 * BLOCK_SIZE])
+        vdi_blocks = self.get_vdi_blocks(vm_ref)[0]
+        zero_blocks = len(vdi_blocks) - len(self.get_vdi_blocks(vm_ref, False)[0])
+        self.assertGreater(zero_blocks, 0)
+
+        self.assertEqual(self.do_backup(True, vm_uuid_list=[self.simulator.get_records("VM")[vm_ref]["uuid"]])[
+                             "failed_vms"], {})
+        vm_back_dir = os.path.join(self.backup_dir, "vm_" + self.simulator.get_records("VM")[vm_ref]["uuid"])
+        vhd_files = glob.glob(os.path.join(vm_back_dir, "*", "*_full.vhd"))
+        self.assertEqual(len(vhd_files), 1)
+        self.assertLess(os.path.getsize(vhd_files[0]), (len(vdi_blocks) - zero_blocks + 1) * (BLOCK_SIZE + 512))
+
+        session = self.login()
+        vm_def_file = glob.glob(os.path.join(vm_back_dir, "*.json"))[0]
+        restored_ref = vm.restore_delta(session.xenapi, self.simulator.url, session.handle, vm_def_file, self.backup_dir)
+        self.assertEqual(self.get_vdi_blocks(restored_ref), self.get_vdi_blocks(vm_ref, False))
+
+    def test_compressed_delta_backup_restore(self):
+        compression.default_codec = "zlib"
+        self.addCleanup(setattr, compression, "default_codec", None)
+
+        self.assertEqual(self.do_backup(True)["failed_vms"], {})
+        disk_ref = self.simulator.get_records("VBD")[self.simulator.get_records("VM")[self.vm_ref]["VBDs"][0]]["VDI"]
+        self.simulator.write_vdi(disk_ref, [0, 3])
+        self.assertEqual(self.do_backup(True)["failed_vms"], {})
+
+        vm_back_dir = os.path.join(self.backup_dir, "vm_" + self.simulator.get_records("VM")[self.vm_ref]["uuid"])
+        self.assertEqual(len(glob.glob(os.path.join(vm_back_dir, "*", "*_delta.vhd.zlib"))), 2)
+        vm_def_file = sorted(glob.glob(os.path.join(vm_back_dir, "*.json")))[-1]
+        for vdi_record in vm_definition_from_file(vm_def_file)["vdis"].values():
+            self.assertEqual(vdi_record["compression"], "zlib")
+            self.assertLess(vdi_record["compression_ratio"], 1)
+
+        session = self.login()
+        restored_ref = vm.restore_delta(session.xenapi, self.simulator.url, session.handle, vm_def_file, self.backup_dir)
+        self.assertEqual(self.get_vdi_blocks(restored_ref), self.get_vdi_blocks(self.vm_ref))
+
+    def test_restore_unreadable_compressed_backup(self):
+        compression.default_codec = "zlib"
+        self.addCleanup(setattr, compression, "default_codec", None)
+        self.assertEqual(self.do_backup(True)["failed_vms"], {})
+
+        vm_back_dir = os.path.join(self.backup_dir, "vm_" + self.simulator.get_records("VM")[self.vm_ref]["uuid"])
+        # Written with a codec not available here
+        for vdi_file in glob.glob(os.path.join(vm_back_dir, "*", "*.vhd.zlib")):
+            with open(vdi_file, "r+b") as data_file:
+                data_file.seek(len(compression.magic) + 1)
+                data_file.write(b"lzma")
+        vms, vdis = len(self.simulator.get_records("VM")), len(self.simulator.get_records("VDI"))
+
+        session = self.login()
+        with self.assertRaises(ValueError):
+            vm.restore_delta(session.xenapi, self.simulator.url, session.handle,
+                             glob.glob(os.path.join(vm_back_dir, "*.json"))[0], self.backup_dir)
+        # The VM and the VDI being imported are destroyed
+        self.assertEqual((len(self.simulator.get_records("VM")), len(self.simulator.get_records("VDI"))), (vms, vdis))
+
+    def test_deduplicated_delta_backup_restore(self):
+        chunkstore.enabled = True
+        self.addCleanup(setattr, chunkstore, "enabled", False)
+        self.simulator.add_vm("clone vm", disks=[4 * BLOCK_SIZE, 2 * BLOCK_SIZE])
+
+        self.assertEqual(self.do_backup(True)["failed_vms"], {})
+        disk_ref = self.simulator.get_records("VBD")[self.simulator.get_records("VM")[self.vm_ref]["VBDs"][0]]["VDI"]
+        self.simulator.write_vdi(disk_ref, [1])
+        self.assertEqual(self.do_backup(True)["failed_vms"], {})
+
+        vm_back_dir = os.path.join(self.backup_dir, "vm_" + self.simulator.get_records("VM")[self.vm_ref]["uuid"])
+        self.assertEqual(len(glob.glob(os.path.join(vm_back_dir, "*", "*_full.vhd.chunks"))), 2)
+        vm_def_file = sorted(glob.glob(os.path.join(vm_back_dir, "*.json")))[-1]
+        vdi_records = vm_definition_from_file(vm_def_file)["vdis"].values()
+        self.assertLess(sum(record["stored_size"] for record in vdi_records),
+                        sum(record["raw_size"] for record in vdi_records))
+
+        session = self.login()
+        restored_ref = vm.restore_delta(session.xenapi, self.simulator.url, session.handle, vm_def_file, self.backup_dir)
+        self.assertEqual(self.get_vdi_blocks(restored_ref), self.get_vdi_blocks(self.vm_ref))
+
+        # Chunks go with the last backups using them
+        for vm_def_file in glob.glob(os.path.join(self.backup_dir, "vm_*", "*.json")):
+            os.remove(vm_def_file)
+        with Catalog(self.backup_dir) as backup_catalog:
+            backup_catalog.sync()
+            for vm_dir in glob.glob(os.path.join(self.backup_dir, "vm_*")):
+                backup_catalog.queue_deletion(backup_catalog.get_unused_files(get_vm_uuid(os.path.basename(vm_dir))))
+        retention.Deleter(self.backup_dir).start().stop()
+        with ChunkStore(os.path.join(self.backup_dir, chunkstore.store_dir)) as store:
+            self.assertEqual(store.get_stats()["chunks"], 0)
+
+    def test_verify(self):
+        self.assertEqual(self.do_backup(False)["failed_vms"], {})
+        self.assertEqual(self.do_backup(True)["failed_vms"], {})
+        disk_ref = self.simulator.get_records("VBD")[self.simulator.get_records("VM")[self.vm_ref]["VBDs"][0]]["VDI"]
+        self.simulator.write_vdi(disk_ref, [2])
+        self.assertEqual(self.do_backup(True)["failed_vms"], {})
+
+        verified, corrupted, missing, unverified = verify_backups(self.backup_dir, 2)
+        # 1 XVA, 2 full and 2 delta VHDs
+        self.assertEqual((len(verified), corrupted, missing, unverified), (5, {}, [], []))
+
+        vhd_files = sorted(glob.glob(os.path.join(self.backup_dir, "vm_*", "*", "*.vhd")))
+        with open(vhd_files[0], "r+b") as vhd_file:
+            vhd_file.seek(10000)
+            vhd_file.write(b"corrupted")
+        os.remove(vhd_files[1])
+        verified, corrupted, missing, unverified = verify_backups(self.backup_dir)
+        self.assertEqual((list(corrupted), missing), ([vhd_files[0]], [vhd_files[1]]))
+
+    def test_verify_after_retention(self):
+        disk_ref = self.simulator.get_records("VBD")[self.simulator.get_records("VM")[self.vm_ref]["VBDs"][0]]["VDI"]
+        for block in range(3):
+            self.simulator.write_vdi(disk_ref, [block])
+            self.assertEqual(self.do_backup(True)["failed_vms"], {})
+
+        # The full VHDs are checked against their sidecar once the definition exporting them is gone
+        verified, corrupted, missing, unverified = verify_backups(self.backup_dir)
+        self.assertEqual((corrupted, missing, unverified), ({}, [], []))
+        self.assertEqual(len([file_name for file_name in verified if file_name.endswith("_full.vhd")]), 2)
+
+    def test_direct_io_backup_restore(self):
+        fileio.io_mode = "direct"
+        self.addCleanup(setattr, fileio, "io_mode", "buffered")
+        self.assertEqual(self.do_backup(False)["failed_vms"], {})
+        self.assertEqual(self.do_backup(True)["failed_vms"], {})
+        verified, corrupted, missing, unverified = verify_backups(self.backup_dir)
+        self.assertEqual((len(verified), corrupted, missing, unverified), (3, {}, [], []))
+
+        session = self.login()
+        vm_back_dir = os.path.join(self.backup_dir, "vm_" + self.simulator.get_records("VM")[self.vm_ref]["uuid"])
+        vm_def_file = sorted(glob.glob(os.path.join(vm_back_dir, "*.json")))[-1]
+        restored_ref = vm.restore_delta(session.xenapi, self.simulator.url, session.handle, vm_def_file, self.backup_dir)
+        self.assertEqual(self.get_vdi_blocks(restored_ref), self.get_vdi_blocks(self.vm_ref, False))
+
+    def test_transfers_to_sr_host(self):
+        host_ref = self.simulator.add_host("local host", "localhost")
+        sr_ref = self.simulator.add_sr("local SR", host=host_ref)
+        vm_ref = self.simulator.add_vm("local vm", disks=[2 * BLOCK_SIZE], sr=sr_ref)
+        vm_uuid = self.simulator.get_records("VM")[vm_ref]["uuid"]
+        self.assertEqual(self.do_backup(True, vm_uuid_list=[vm_uuid])["failed_vms"], {})
+        self.assertEqual(self.do_backup(False, vm_uuid_list=[vm_uuid])["failed_vms"], {})
+        # The VDI export and the XVA export
+        self.assertEqual(self.simulator.transfer_hosts["localhost"], 2)
+
+        session = self.login()
+        vm_back_dir = os.path.join(self.backup_dir, "vm_" + vm_uuid)
+        vm_def_file = glob.glob(os.path.join(vm_back_dir, "*.json"))[0]
+        vm.restore_delta(session.xenapi, self.simulator.url, session.handle, vm_def_file, self.backup_dir)
+        self.assertEqual(self.simulator.transfer_hosts["localhost"], 3)
+
+    def test_full_restore_to_mapped_sr(self):
+        sr_ref = self.simulator.add_sr("local SR", host=self.simulator.add_host("local host", "localhost"))
+        self.assertEqual(self.do_backup(False)["failed_vms"], {})
+        xva_file = glob.glob(os.path.join(self.backup_dir, "*.xva"))[0]
+
+        session = self.login()
+        vm_uuid = self.simulator.get_records("VM")[self.vm_ref]["uuid"]
+        vm.restore(session.xenapi, self.simulator.url, session.handle, xva_file,
+                   sr_map={vm_uuid: self.simulator.get_records("SR")[sr_ref]["uuid"]})
+        # Imported straight to the host of the SR
+        self.assertEqual(self.simulator.transfer_hosts["localhost"], 1)
+        vdis = self.simulator.get_records("VDI").values()
+        self.assertEqual(len([vdi for vdi in vdis if vdi["SR"] == sr_ref]), 2)
+
+    def test_unreachable_sr_host(self):
+        # Nothing listens on 127.0.0.2, the export is retried through the master
+        host_ref = self.simulator.add_host("unreachable host", "127.0.0.2")
+        vm_ref = self.simulator.add_vm("local vm", sr=self.simulator.add_sr("local SR", host=host_ref))
+        self.assertEqual(self.do_backup(True, vm_uuid_list=[self.simulator.get_records("VM")[vm_ref]["uuid"]])[
+                             "failed_vms"], {})
+        self.assertEqual(self.simulator.transfers["/export_raw_vdi"], 1)
+
+    def test_restore_to_unreachable_sr_host(self):
+        host_ref = self.simulator.add_host("unreachable host", "127.0.0.2")
+        vm_ref = self.simulator.add_vm("local vm", sr=self.simulator.add_sr("local SR", host=host_ref))
+        vm_uuid = self.simulator.get_records("VM")[vm_ref]["uuid"]
+        self.assertEqual(self.do_backup(True, vm_uuid_list=[vm_uuid])["failed_vms"], {})
+        # Each transfer starts from a new process, where the host isn't known to be unreachable
+        host._sr_urls.clear()
+        self.assertEqual(self.do_backup(False, vm_uuid_list=[vm_uuid])["failed_vms"], {})
+        self.assertEqual(self.simulator.transfers["/export"], 1)
+
+        host._sr_urls.clear()
+        session = self.login()
+        vm_def_file = glob.glob(os.path.join(self.backup_dir, "vm_" + vm_uuid, "*.json"))[0]
+        vm.restore_delta(session.xenapi, self.simulator.url, session.handle, vm_def_file, self.backup_dir)
+        self.assertEqual(self.simulator.transfers["/import_raw_vdi"], 1)
+
+    def test_retention(self):
+        disk_ref = self.simulator.get_records("VBD")[self.simulator.get_records("VM")[self.vm_ref]["VBDs"][0]]["VDI"]
+        for backup in range(4):
+            self.simulator.write_vdi(disk_ref, [backup])
+            return_status = self.do_backup(True)
+            self.assertEqual(return_status["failed_vms"], {})
+            if backup == 1:
+                # Backups made before the catalog existed are indexed
+                os.remove(os.path.join(self.backup_dir, "catalog.db"))
+
+        self.assertGreater(return_status["reclaimed"], 0)
+
+        vm_back_dir = os.path.join(self.backup_dir, "vm_" + self.simulator.get_records("VM")[self.vm_ref]["uuid"])
+        self.assertEqual(len(glob.glob(os.path.join(vm_back_dir, "*.json"))), 2)
+        # The bases of the retained deltas are kept
+        self.assertEqual(len(glob.glob(os.path.join(vm_back_dir, "*", "*_full.vhd"))), 2)
+        self.assertEqual(len(glob.glob(os.path.join(vm_back_dir, "*", "*_delta.vhd"))), 4)
+
+        session = self.login()
+        vm_def_file = sorted(glob.glob(os.path.join(vm_back_dir, "*.json")))[0]
+        restored_ref = vm.restore_delta(session.xenapi, self.simulator.url, session.handle, vm_def_file, self.backup_dir)
+        self.assertEqual(len(self.get_vdi_blocks(restored_ref)), 2)
+
+    def test_parallel_delta_backup(self):
+        vm_ref = self.simulator.add_vm("parallel vm", disks=[BLOCK_SIZE] * 4)
+        self.assertEqual(self.do_backup(True, vdi_workers=4)["failed_vms"], {})
+        self.assertEqual(self.do_backup(True, vdi_workers=4)["failed_vms"], {})
+
+        vm_back_dir = os.path.join(self.backup_dir, "vm_" + self.simulator.get_records("VM")[vm_ref]["uuid"])
+        self.assertEqual(len(glob.glob(os.path.join(vm_back_dir, "*", "*_full.vhd"))), 4)
+        self.assertEqual(len(glob.glob(os.path.join(vm_back_dir, "*", "*_delta.vhd"))), 4)
+
+    def test_parallel_delta_backup_failure(self):
+        self.simulator.fail_transfer("/export_raw_vdi", count=6)
+        status = self.do_backup(True, vdi_workers=2)
+        self.assertEqual(list(status["failed_vms"].keys()), [self.vm_ref])
+        self.assertEqual(glob.glob(os.path.join(self.backup_dir, "*", "*", "*.vhd")), [])
+
+    def test_concurrent_vm_backups(self):
+        sr_ref = self.simulator.add_sr("Other storage")
+        for v in range(3):
+            self.simulator.add_vm("vm {}".format(v), sr=sr_ref if v % 2 else None)
+        status = self.do_backup(True, vm_workers=3, sr_streams=1)
+        self.assertEqual(status["failed_vms"], {})
+        self.assertEqual(len(glob.glob(os.path.join(self.backup_dir, "vm_*", "*.json"))), 4)
+
+    def test_export_retry(self):
+        self.simulator.fail_transfer("/export_raw_vdi", after=BLOCK_SIZE)
+        self.assertEqual(self.do_backup(True)["failed_vms"], {})
+        self.assertEqual(self.simulator.transfers["/export_raw_vdi"], 3)
+
+    def test_clean(self):
+        self.do_backup(True)
+        clean_all("Simulated pool", self.simulator.url, "root", "")
+        snapshots = [record for record in self.simulator.get_records("VM").values() if record["is_a_snapshot"]]
+        self.assertEqual(snapshots, [])
@@ -0,0 +1,42 @@
+import argparse
+import io
+import os
+import shutil
+import tempfile
+from contextlib import redirect_stdout
+from unittest import TestCase
+
+from find import find, list_backups
+
+
+class TestFind(TestCase):
+    def setUp(self):
+        self.backup_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.backup_dir)
+        for timestamp in ("20200101T000000", "20200102T000000"):
+            with open(os.path.join(self.backup_dir, "1234__{}__test_vm.xva".format(timestamp)), "wb") as xva_file:
+                xva_file.write(bytes(2048))
+
+    def run_action(self, action, **kwargs):
+        args = dict(config=None, type="full", base_dir=self.backup_dir, uuid=None, vm_name=None, before=None,
+                    totals=False)
+        args.update(kwargs)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            action(argparse.Namespace(**args))
+        return output.getvalue().splitlines()
+
+    def test_find(self):
+        self.assertEqual(self.run_action(find, vm_name="test vm"),
+                         [os.path.join(self.backup_dir, "1234__20200102T000000__test_vm.xva")])
+        self.assertEqual(self.run_action(find, uuid=["1234"], before="2020-01-02"),
+                         [os.path.join(self.backup_dir, "1234__20200101T000000__test_vm.xva")])
+        with self.assertRaises(ValueError):
+            self.run_action(find, uuid=["1234"], before="20200101T000000")
+
+    def test_list(self):
+        summary = self.run_action(list_backups)
+        self.assertEqual(len(summary), 3)
+        self.assertIn("test_vm", summary[1])
+        self.assertEqual(summary[2], "Total: 4.0 KiB")
+        self.assertEqual(len(self.run_action(list_backups, uuid=["1234"], totals=True)), 4)
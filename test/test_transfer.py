@@ -0,0 +1,43 @@
+import argparse
+import shutil
+import tempfile
+from unittest import TestCase
+
+from lib.simulator import XapiSimulator, BLOCK_SIZE
+from transfer import transfer
+
+
+class TestSimulatedTransfer(TestCase):
+    def setUp(self):
+        self.src = XapiSimulator().start()
+        self.addCleanup(self.src.stop)
+        self.dst = XapiSimulator().start()
+        self.addCleanup(self.dst.stop)
+        self.vm_ref = self.src.add_vm("test vm", disks=[4 * BLOCK_SIZE])
+        self.backup_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.backup_dir)
+
+    def transfer(self, stream):
+        transfer(argparse.Namespace(
+            username="root", password="", base_dir=self.backup_dir,
+            uuid=[self.src.get_records("VM")[self.vm_ref]["uuid"]], vm_name=None, src_master=self.src.url,
+            dst_master=self.dst.url, shutdown=False, restore=False, stream=stream))
+
+    def get_vm_names(self, simulator):
+        return sorted(vm["name_label"] for vm in simulator.get_records("VM").values() if not vm["is_a_template"])
+
+    def test_transfer(self):
+        self.transfer(False)
+        self.assertEqual(self.get_vm_names(self.dst), self.get_vm_names(self.src))
+        self.assertEqual(self.dst.transfers["/import"], 1)
+
+    def test_stream_transfer(self):
+        self.transfer(True)
+        self.assertEqual(self.get_vm_names(self.dst), self.get_vm_names(self.src))
+        self.assertEqual(self.dst.transfers["/import"], 1)
+
+    def test_stream_transfer_failure(self):
+        vm_names = self.get_vm_names(self.dst)
+        self.src.fail_transfer("/export", after=BLOCK_SIZE)
+        self.transfer(True)
+        self.assertEqual(self.get_vm_names(self.dst), vm_names)
@@ -5,10 +5,12 @@ from http.client import CannotSendRequest
 from urllib.error import HTTPError
 
 from handlers.common import get_by_uuid, get_by_label
-from handlers.vm import VM, restore as restore_vm
-from lib import XenAPI
+from handlers.vm import VM, import_vm, restore as restore_vm
+from lib import XenAPI, compression
 from lib.XenAPI import Failure
-from lib.functions import get_timestamp
+from lib.functions import get_master_url, get_timestamp
+from lib.stream import TransferStats
+from lib.upload import put_stream
 
 logger = logging.getLogger("Xen transfer")
 
@@ -21,8 +23,8 @@ def transfer(args):
     if args.uuid is None and args.vm_name is None:
         raise ValueError("VM UUID or name required!")
 
-    src_master_url = "https://" + args.src_master
-    dst_master_url = "https://" + args.dst_master
+    src_master_url = get_master_url(args.src_master)
+    dst_master_url = get_master_url(args.dst_master)
 
     src_session = XenAPI.Session(src_master_url, ignore_ssl=True)
     dst_session = XenAPI.Session(dst_master_url, ignore_ssl=True)
@@ -77,21 +79,27 @@ def transfer(args):
                     else:
                         src_vm.set_name(export_name)
 
+                    exported_file_name = None
                     try:
-                        exported_file_name = src_vm.export(backup_dir, export_name, vm_name)
+                        if args.stream:
+                            stream_vm(src_vm, dst_xapi, dst_master_url, dst_s_id, export_name, args.restore)
+                        else:
+                            exported_file_name = src_vm.export(backup_dir, export_name, vm_name)
                     finally:
                         if take_snapshot:
                             src_vm.destroy()
                         else:
                             src_vm.set_name(vm_name)
 
-                    restore_vm(dst_xapi, dst_master_url, dst_s_id, exported_file_name, restore=args.restore)
+                    if exported_file_name is not None:
+                        restore_vm(dst_xapi, dst_master_url, dst_s_id, exported_file_name, restore=args.restore)
 
                     dst_vm = VM(dst_xapi, dst_master_url, dst_s_id, get_by_label(dst_xapi.VM, export_name)[0])
                     dst_vm.set_name(vm_name)
                     dst_vm.set_power_state(power_state)
 
-                    os.remove(exported_file_name)
+                    if exported_file_name is not None:
+                        os.remove(exported_file_name)
             except SystemExit:
                 logger.info("VM transfer aborted on user request")
                 if src_vm is not None and (dst_vm is None or dst_vm.get_power_state() != power_state):
@@ -110,3 +118,16 @@ def transfer(args):
             dst_session.xenapi.session.logout()
         except (CannotSendRequest, XenAPI.Failure) as e:
             logger.error("Xen logout failed: %s", e)
+
+
+def stream_vm(src_vm, dst_xapi, dst_master_url, dst_session_id, export_name, restore=False):
+    """Import the export of src_vm in the destination pool as it is downloaded, without a local copy.
+
+    The response is read ahead by the stream pipeline (stream.default_depth buffers) and uploaded chunked.
+    """
+    stats = TransferStats()
+    desc = "Streaming VM {} to {}".format(export_name, dst_master_url)
+    with src_vm.open_export(export_name, desc, compression.xva_compression == "host") as response:
+        import_vm(dst_xapi, dst_master_url, dst_session_id, export_name,
+                  lambda url: put_stream(url, response, response.length, stats), restore=restore)
+    logger.debug("VM %s streamed (%s)", export_name, stats)
@@ -0,0 +1,116 @@
+import glob
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from lib import checksum, chunkstore
+from lib.chunkstore import ChunkStore
+from lib.compression import ZstdWriter
+
+logger = logging.getLogger("Xen verify")
+
+
+def verify_backups(base_folder, workers=None):
+    """Check the backup files of base_folder against their checksums.
+
+    Returns the verified files, the corrupted ones (file -> problems), the missing ones and the files without
+    checksum. Files are hashed in blocks by workers threads (hashlib releases the GIL, so they use all cores).
+    """
+    checksums = {}
+    unverified = []
+    missing = []
+    chunk_files = set()
+
+    for file_name in sorted(os.listdir(base_folder)):
+        if file_name.endswith((".xva", ".xva" + ZstdWriter.extension)):
+            file_name = os.path.join(base_folder, file_name)
+            file_checksum = checksum.read_sidecar(file_name)
+            if file_checksum is None:
+                unverified.append(file_name)
+            else:
+                checksums[file_name] = file_checksum
+
+    # The latest definition using a file has its current checksum
+    for vm_def_file in sorted(glob.glob(os.path.join(base_folder, "vm_*", "*.json"))):
+        with open(vm_def_file) as def_file:
+            vdi_records = json.load(def_file)["vdis"].values()
+        for vdi_record in vdi_records:
+            for file_key, checksum_key in (("backup_base_file", "backup_base_checksum"), ("backup_file", "checksum")):
+                if file_key not in vdi_record:
+                    continue
+                file_name = os.path.join(base_folder, vdi_record[file_key])
+                if not os.path.exists(file_name):
+                    missing.append(file_name)
+                elif chunkstore.is_manifest(file_name):
+                    chunk_files.update(get_chunk_files(file_name))
+                elif vdi_record.get(checksum_key) is not None:
+                    checksums[file_name] = vdi_record[checksum_key]
+                elif file_name not in checksums:
+                    # Full exports have a sidecar, the definition exporting them may be gone
+                    file_checksum = checksum.read_sidecar(file_name)
+                    if file_checksum is None:
+                        unverified.append(file_name)
+                    else:
+                        checksums[file_name] = file_checksum
+
+    corrupted = {}
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        verifications = {file_name: checksum.submit_verification(executor, file_name, file_checksum)
+                         for file_name, file_checksum in checksums.items()}
+        chunk_files = sorted(chunk_files)
+        for chunk_file_name, valid in zip(chunk_files, executor.map(check_chunk, chunk_files)):
+            if valid is None:
+                missing.append(chunk_file_name)
+            elif not valid:
+                corrupted[chunk_file_name] = ["chunk content doesn't match its hash"]
+        for file_name, get_problems in verifications.items():
+            problems = get_problems()
+            if problems:
+                corrupted[file_name] = problems
+
+    verified = [file_name for file_name in checksums if file_name not in corrupted] + \
+               [chunk_file_name for chunk_file_name in chunk_files if chunk_file_name not in corrupted]
+    return verified, corrupted, sorted(set(missing)), sorted(set(unverified) - set(checksums))
+
+
+def get_chunk_files(manifest_file):
+    manifest = chunkstore.read_manifest(manifest_file)
+    with ChunkStore.from_manifest(manifest_file, manifest) as store:
+        return {store.get_chunk_file(bytes.fromhex(digest)) for digest, _ in manifest["chunks"]}
+
+
+def check_chunk(chunk_file_name):
+    try:
+        return checksum.verify_chunk(chunk_file_name)
+    except FileNotFoundError:
+        return None
+
+
+def verify(args):
+    base_folder = args.base_dir
+    if base_folder is None:
+        try:
+            with open(args.config, "r") as config_file:
+                config = yaml.load(config_file)
+        except OSError as e:
+            logger.error("Error opening config file : %s", e)
+            raise e
+        base_folder = config[args.type + "_backup_dir"]
+
+    logger.info("Verifying backups in %s", base_folder)
+    verified, corrupted, missing, unverified = verify_backups(base_folder, args.workers)
+
+    for file_name, problems in corrupted.items():
+        logger.error("Corrupted: %s (%s)", file_name, ", ".join(problems))
+    for file_name in missing:
+        logger.error("Missing: %s", file_name)
+    for file_name in unverified:
+        logger.warning("No checksum: %s", file_name)
+    logger.info("%d files verified, %d corrupted, %d missing, %d without checksum",
+                len(verified), len(corrupted), len(missing), len(unverified))
+
+    if corrupted or missing:
+        raise ValueError("Backup verification failed")
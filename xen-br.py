@@ -6,9 +6,11 @@ import sys
 from backup import backup
 from clean import clean
 from export import export
+from find import find, list_backups
 from lib import XenAPI
 from restore import restore
 from transfer import transfer
+from verify import verify
 
 
 def exit_gracefully(signum, _):
@@ -20,7 +22,10 @@ actions = {
     "export": export,
     "restore": restore,
     "transfer": transfer,
-    "clean": clean
+    "clean": clean,
+    "verify": verify,
+    "list": list_backups,
+    "find": find
 }
 
 if __name__ == "__main__":
@@ -39,6 +44,7 @@ if __name__ == "__main__":
     parser.add_argument("-U", "--username", type=str, help="Username")
     parser.add_argument("-P", "--password", type=str, help="Password")
     parser.add_argument("-d", "--base-dir", type=str, help="Backups directory")
+    parser.add_argument("--cache-dir", type=str, help="Directory of the persistent pool inventory cache")
     parser.add_argument("-f", "--file", type=str, help="Backup XVA file or VM definition")
     parser.add_argument("-t", "--type", type=str, help="Type of backup to perform", default="delta")
     parser.add_argument("-n", "--new-snapshot", type=bool, help="Always perform new snapshot to backup")
@@ -47,6 +53,17 @@ if __name__ == "__main__":
     parser.add_argument("-b", "--backups-to-retain", type=int, help="Number of backups to retain")
     parser.add_argument("-r", "--restore", action='store_true', help="Perform full restore")
     parser.add_argument("-s", "--shutdown", action='store_true', help="Shutdown vm before exporting")
+    parser.add_argument("--no-merge", action='store_true',
+                        help="Upload the base and delta backups separately instead of merged when restoring")
+    parser.add_argument("--stream", action='store_true',
+                        help="Transfer VMs streaming the export to the destination pool instead of through a file")
+    parser.add_argument("--io-mode", type=str, choices=["buffered", "dontneed", "direct"],
+                        help="How backup files are written and read: through the page cache, dropping them from "
+                             "the page cache or with O_DIRECT writes")
+
+    parser.add_argument("--before", type=str, help="Find the backups taken before this time (e.g. 2020-01-31 23:59)")
+    parser.add_argument("--totals", action='store_true', help="List the size of every backup chain")
+    parser.add_argument("-w", "--workers", type=int, help="Threads hashing the files to verify (default: CPUs)")
 
     parser.add_argument("--network-map", type=str, action="append")
     parser.add_argument("--storage-map", type=str, action="append")